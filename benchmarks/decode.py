@@ -0,0 +1,127 @@
+import sys
+import time
+import random
+import tracemalloc
+from datetime import datetime
+from executors import ig_executor as ige
+from strategies import vix_roll_trader as vrt
+from records import Quote
+
+
+def order_images(n):
+    """Orders table NewImages of n IG VIX orders over 6 expiries, a third with a stop"""
+    random.seed(n)
+    images = []
+    for i in range(n):
+        order = {'Side': {'S': random.choice(['BUY', 'SELL'])}, 'Size': {'N': str(random.randint(1, 5))},
+                 'OrdType': {'S': 'MARKET'}}
+        if i % 3 == 0:
+            order['StopDistance'] = {'N': '2.5'}
+        images.append({'OrderId': {'S': 'order-%s' % i}, 'TransactionTime': {'S': '1520607600'},
+                       'Symbol': {'S': 'VX'}, 'Broker': {'S': 'IG'}, 'Maturity': {'S': '2018%02d' % (1 + i % 6)},
+                       'Status': {'S': 'PENDING'}, 'ProductType': {'S': 'SPREADBET'}, 'Order': {'M': order},
+                       'Strategy': {'M': {'Name': {'S': 'VIX ROLL'}, 'Reason': {'S': 'CONTANGO'}}}})
+    return images
+
+
+def quote_images(n):
+    return [{'Symbol': {'S': 'VX%s' % (i % 50)}, 'Date': {'S': '201803%02d' % (1 + i % 28)},
+             'Details': {'M': {'Open': {'N': '17.1'}, 'High': {'N': '17.9'}, 'Low': {'N': '16.8'},
+                               'Close': {'N': '17.45'}, 'Volume': {'N': '120311'}}}} for i in range(n)]
+
+
+SECURITIES = [{'Symbol': 'VX', 'Broker': 'IG', 'TradingEnabled': True,
+               'Description': {'Name': 'VIX', 'MarketGroup': 'INDICES'},
+               'Risk': {'RiskFactor': 0.5, 'MaxPosition': 40}}]
+
+
+class LegacyOrder(object):
+    """Order as it was before the records: a __dict__ per instance and a strptime per order"""
+
+    def __init__(self, orderId, transactionTime, symbol, side, size, ordType, maturity, name, group, risk, maxPos, stop):
+        self.OrderId = orderId
+        self.TransactionTime = transactionTime
+        self.Side = side
+        self.Size = float(size)
+        self.OrdType = ordType
+        self.Symbol = symbol
+        self.Maturity = datetime.strptime(maturity, '%Y%m').strftime('%b-%y').upper()
+        self.Name = name
+        self.MarketGroup = group
+        self.RiskFactor = risk
+        self.MaxPosition = maxPos
+        self.Epic = ''
+        self.Ccy = ''
+        self.FillTime = None
+        self.FillPrice = None
+        self.FillSize = None
+        self.Status = ige.OrderStatus.Pending
+        self.BrokerReferenceId = ''
+        self.StopDistance = stop
+        self.Stage = None
+
+
+def legacy_orders(images):
+    """ValidateOrders as it was: keys and orders read from the images in two passes"""
+    keys = [(x['Symbol']['S'], x['Broker']['S']) for x in images]
+    found = dict((x['Symbol'], x) for x in SECURITIES)
+    valid = []
+    for x in images:
+        f = found[x['Symbol']['S']]
+        order = x['Order']['M']
+        valid.append(LegacyOrder(x['OrderId']['S'], x['TransactionTime']['S'], x['Symbol']['S'], order['Side']['S'],
+                                 order['Size']['N'], order['OrdType']['S'], x['Maturity']['S'],
+                                 f['Description']['Name'], f['Description']['MarketGroup'], f['Risk']['RiskFactor'],
+                                 f['Risk']['MaxPosition'],
+                                 None if 'StopDistance' not in order else order['StopDistance']['N']))
+    return keys, valid
+
+
+def record_orders(images):
+    orders = [ige.Order.FromImage(x) for x in images]
+    return [(o.Symbol, o.Broker) for o in orders], ige.Scheduler.Validate(orders, SECURITIES)[0]
+
+
+def legacy_quotes(images):
+    """AddQuote as it was: a dict per quote with only the Close decoded"""
+    return [{'Symbol': x['Symbol']['S'], 'Date': x['Date']['S'],
+             'Details': {'Close': vrt.decimal.Decimal(x['Details']['M']['Close']['N'])}} for x in images]
+
+
+def record_quotes(images):
+    return [Quote.FromImage(x) for x in images]
+
+
+def measure(func, images, repeat=5):
+    """Best wall time of repeat runs, then the peak and the retained bytes allocated by one run"""
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(images)
+        best = min(best, time.perf_counter() - started)
+    tracemalloc.start()
+    result = func(images)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return best, peak, retained
+
+
+def main(n=1000):
+    """
+    Both sides decode what their code reads. Orders save mostly time: what an Order retains is its own slots
+    (232 B for the 25 of an executor Order) and its Decimals (104 B each), which no decoder avoids. Quotes, like
+    the legacy AddQuote, decode only the Close; the record saves the two dicts and refers to the image's details.
+    """
+    orders, quotes = order_images(n), quote_images(n)
+    print('records,path,seconds,peak_bytes,retained_bytes,retained_per_record')
+    for name, images, path, func in (('orders', orders, 'legacy', legacy_orders),
+                                     ('orders', orders, 'records', record_orders),
+                                     ('quotes', quotes, 'legacy', legacy_quotes),
+                                     ('quotes', quotes, 'records', record_quotes)):
+        elapsed, peak, retained = measure(func, images)
+        print('%s x%s,%s,%.6f,%s,%s,%s' % (name, n, path, elapsed, peak, retained, retained // n))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -0,0 +1,115 @@
+import os
+import sys
+import time
+import decimal
+import logging
+import datetime
+from dateutil.relativedelta import relativedelta
+from contracts import SecurityDefinition, Futures
+from notifier import Notifier
+from benchmarks.standins import MemoryDb, MemoryS3, FakeIG, SmtpStandIn
+from strategies import vix_roll_trader as vrt
+from executors import ig_executor as ige
+
+
+class Offline(object):
+    """
+    The quote -> strategy -> order stream -> executor pipeline on stand-ins: DynamoDB and S3 in memory, IG
+    and SMTP on localhost. Entering sets the environment both Lambdas read and points their backends at
+    the stand-ins; leaving restores them. limits replaces the executor's IG rate limiter while entered.
+    """
+
+    def __init__(self, latency=0, jitter=0, errorRate=0, seed=None, size=100, limits=None):
+        self.Limits = limits
+        self.SecDef = SecurityDefinition()
+        self.Db = MemoryDb()
+        self.S3 = MemoryS3()
+        self.Smtp = SmtpStandIn()
+        self.Size = size
+        months = [datetime.date.today() + relativedelta(months=+x) for x in range(4)]
+        self.IG = FakeIG(dict(('IN.D.VX.%s.IP' % m.strftime('%b%y').upper(),
+                               {'instrumentName': 'VX Volatility Index', 'instrumentType': 'INDICES',
+                                'expiry': m.strftime('%b-%y').upper()}) for m in months),
+                         latency=latency, jitter=jitter, errorRate=errorRate, seed=seed)
+        self.Db.Table('Securities').put_item(Item={
+            'Symbol': 'VX', 'Broker': 'IG', 'TradingEnabled': True,
+            'Description': {'Name': 'VX Volatility Index', 'MarketGroup': 'INDICES'},
+            'Risk': {'RiskFactor': decimal.Decimal('0.5'), 'MaxPosition': 10 * size}})
+        self.__environ = None
+
+    def __enter__(self):
+        url = self.IG.Start()
+        port = self.Smtp.Start()
+        self.__environ = dict(os.environ)
+        os.environ.update({
+            'QUOTES_TABLE': 'Quotes.EOD', 'SECURITIES_TABLE': 'Securities', 'ORDERS_TABLE': 'Orders',
+            'ROLL_TABLE': 'RollSignals', 'POSITIONS_TABLE': 'Positions', 'DEBUG_FOLDER': 'debug',
+            'ROLL_FILE': 'roll', 'BACK_TEST': 'False', 'STD_SIZE': str(self.Size),
+            'IG_URL': url, 'X_IG_API_KEY': 'key', 'IDENTIFIER': 'offline', 'PASSWORD': 'password',
+            'EMAIL_ADDRESS': 'reports@localhost', 'EMAIL_USER': '', 'EMAIL_PASSWORD': '', 'EMAIL_SMTP': 'localhost'})
+        vrt.SetResources(vrt.Resources(self.Db, self.S3))
+        ige.Db = self.Db
+        if self.Limits is not None:
+            self.Limits, ige.Limits = ige.Limits, self.Limits
+        ige.Notifications = Notifier('127.0.0.1', port, None, None, 'reports@localhost', ['reports@localhost'],
+                                     logging.getLogger(), starttls=False)
+        return self
+
+    def __exit__(self, *args):
+        ige.Notifications.Close()
+        ige.Notifications = None
+        ige.Db = None
+        if self.Limits is not None:
+            self.Limits, ige.Limits = ige.Limits, self.Limits
+        vrt.ResetResources()
+        os.environ.clear()
+        os.environ.update(self.__environ)
+        self.IG.Stop()
+        self.Smtp.Stop()
+
+    def TradingDay(self):
+        """A day ahead of a VX expiry far enough for the strategy to open a position, and its front future"""
+        expiry = self.SecDef.get_next_expiry_date(Futures.VX, datetime.date.today() + relativedelta(days=+10))
+        day = expiry - relativedelta(days=+8)
+        return day, self.SecDef.get_front_month_future('VX', day)
+
+    def Quotes(self, day, future, spot=15.0, roll=0.25):
+        """Store the day's EOD quotes, returns the Quotes.EOD stream event; the future trades roll a day over spot"""
+        expiry = self.SecDef.get_next_expiry_date(Futures.VX, day)
+        close = spot + roll * (expiry - day).days
+        table = self.Db.Table('Quotes.EOD')
+        for symbol, price in (('VIX', spot), (future, close)):
+            table.put_item(Item={'Symbol': symbol, 'Date': day.strftime('%Y%m%d'), 'Source': 'OFFLINE',
+                                 'Details': {'Close': decimal.Decimal(str(round(price, 2)))}})
+        return table.Drain()
+
+    def Run(self, spot=15.0, roll=0.25):
+        """One day through the pipeline, returns the seconds spent in each stage and the orders' statuses"""
+        day, future = self.TradingDay()
+        timings = {}
+        started = time.perf_counter()
+        quotes = self.Quotes(day, future, spot, roll)
+        vrt.lambda_handler(quotes, None)
+        timings['strategy'] = time.perf_counter() - started
+
+        orders = self.Db.Table('Orders').Drain()
+        started = time.perf_counter()
+        ige.lambda_handler(orders, None)
+        timings['executor'] = time.perf_counter() - started
+        timings['orders'] = sum(1 for x in orders['Records'] if x['eventName'] == 'INSERT')
+
+        items = self.Db.Table('Orders').scan()['Items']
+        return timings, sorted((x['OrderId'], x['Status']) for x in items)
+
+
+def main(latency=0.0):
+    logging.getLogger().setLevel(logging.WARNING)
+    with Offline(latency=latency) as offline:
+        timings, statuses = offline.Run()
+    print('latency_s,orders,strategy_s,executor_s,statuses')
+    print('%s,%s,%.6f,%.6f,%s' % (latency, timings['orders'], timings['strategy'], timings['executor'],
+                                  ' '.join(status for _, status in statuses)))
+
+
+if __name__ == '__main__':
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else 0.0)
@@ -0,0 +1,75 @@
+import sys
+import time
+import random
+import logging
+from executors import ig_executor as ige
+
+
+def positions(n):
+    """IG positions payload with n open positions spread over 12 expiries"""
+    return {'positions': [{'market': {'expiry': 'M%02d-18' % (i % 12), 'instrumentName': 'VIX %s' % (i % 50),
+                                      'instrumentType': 'INDICES'},
+                           'position': {'direction': 'BUY' if i % 2 else 'SELL', 'size': 1.0}}
+                          for i in range(n)]}
+
+
+def orders(n):
+    random.seed(n)
+    batch = []
+    for i in range(n):
+        order = ige.Order(str(i), '1520607600', 'VX', random.choice(['BUY', 'SELL']), random.randint(1, 5), 'MARKET',
+                          '201803', 'VIX %s' % (i % 50), 'INDICES', 0.5, 40, None)
+        order.Maturity = 'M%02d-18' % (i % 12)
+        batch.append(order)
+    return batch
+
+
+def naive(scheduler, batch, trades):
+    """The checks as they were: a scan of the payload per order and a quadratic split, no batch netting"""
+    def position(order):
+        found = [p['position'] for p in trades['positions']
+                 if p['market']['expiry'] == order.Maturity and p['market']['instrumentName'] == order.Name
+                 and p['market']['instrumentType'] == order.MarketGroup]
+        return sum(x['size'] for x in found if x['direction'] == 'BUY') - \
+            sum(x['size'] for x in found if x['direction'] == 'SELL')
+
+    def check(order):
+        p = position(order)
+        if order.Size / scheduler.Balance.Amount > order.RiskFactor or order.Size > order.MaxPosition:
+            return False
+        if order.Side == 'BUY':
+            return order.MaxPosition >= p + order.Size
+        return order.MaxPosition >= abs(p - order.Size)
+
+    passed = [o for o in batch if check(o)]
+    failed = [o for o in batch if o not in passed]
+    return passed, failed
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - started, result
+
+
+def main(sizes=(10, 1000, 10000), positionCount=500, naiveLimit=2000):
+    logging.getLogger().setLevel(logging.WARNING)
+    scheduler = ige.Scheduler(ige.IGParams(), logging.getLogger())
+    scheduler.Balance = ige.Money(100000.0, 'USD')
+    trades = positions(positionCount)
+
+    print('orders,positions,engine_s,passed,naive_s,naive_passed')
+    for n in sizes:
+        batch = orders(n)
+        elapsed, (passed, _) = timed(scheduler.RiskCheck, batch, trades)
+        line = '%s,%s,%.6f,%s' % (n, positionCount, elapsed, len(passed))
+        if n <= naiveLimit:
+            elapsed, (passed, _) = timed(naive, scheduler, batch, trades)
+            line += ',%.6f,%s' % (elapsed, len(passed))
+        else:
+            line += ',,'
+        print(line)
+
+
+if __name__ == '__main__':
+    main(tuple(int(x) for x in sys.argv[1:]) or (10, 1000, 10000))
@@ -0,0 +1,619 @@
+import io
+import re
+import time
+import uuid
+import random
+import asyncio
+import operator
+import threading
+import collections
+import socketserver
+from aiohttp import web
+from botocore.exceptions import ClientError
+from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
+
+
+class SmtpStandIn(object):
+    """
+    Plain SMTP server on localhost for tests and offline runs (no TLS, no AUTH). It keeps every message
+    it receives, can answer DATA after Latency seconds and can drop the connection after each message.
+    """
+
+    def __init__(self, latency=0, dropAfterMessage=False):
+        self.Latency = latency
+        self.DropAfterMessage = dropAfterMessage
+        self.Messages = []
+        self.Connections = 0
+        self.__server = None
+
+    def Start(self):
+        standIn = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line):
+                self.wfile.write(('%s\r\n' % line).encode('ascii'))
+
+            def handle(self):
+                standIn.Connections += 1
+                self.reply('220 localhost SMTP stand-in')
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    command = line.decode('ascii', 'replace').strip()[:4].upper()
+                    if command in ('EHLO', 'HELO'):
+                        self.reply('250 localhost')
+                    elif command in ('MAIL', 'RCPT', 'RSET', 'NOOP'):
+                        self.reply('250 OK')
+                    elif command == 'DATA':
+                        self.reply('354 End data with <CR><LF>.<CR><LF>')
+                        lines = []
+                        while True:
+                            data = self.rfile.readline().decode('utf-8', 'replace')
+                            if data in ('.\r\n', '.\n', ''):
+                                break
+                            lines.append(data[1:] if data.startswith('..') else data)
+                        time.sleep(standIn.Latency)
+                        standIn.Messages.append(''.join(lines))
+                        self.reply('250 OK')
+                        if standIn.DropAfterMessage:
+                            return
+                    elif command == 'QUIT':
+                        self.reply('221 Bye')
+                        return
+                    else:
+                        self.reply('502 Command not implemented')
+
+        self.__server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self.__server.daemon_threads = True
+        threading.Thread(target=self.__server.serve_forever, daemon=True).start()
+        return self.__server.server_address[1]
+
+    def Stop(self):
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__server = None
+
+
+def _error(code, message, status=400, **extra):
+    return ClientError(dict({'Error': {'Code': code, 'Message': message},
+                             'ResponseMetadata': {'HTTPStatusCode': status}}, **extra), 'StandIn')
+
+
+_serializer = TypeSerializer()
+_deserializer = TypeDeserializer()
+_compare = {'=': operator.eq, '<>': operator.ne, '<': operator.lt, '<=': operator.le, '>': operator.gt,
+            '>=': operator.ge}
+_missing = object()
+
+
+def _image(item):
+    """item in the typed stream form; raises TypeError for values DynamoDB rejects, e.g. floats"""
+    return dict((k, _serializer.serialize(v)) for k, v in item.items())
+
+
+def _stored(item):
+    """item as DynamoDB hands it back: a copy with every number a Decimal"""
+    return dict((k, _deserializer.deserialize(v)) for k, v in _image(item).items())
+
+
+def _evaluate(condition, item):
+    """A boto3.dynamodb.conditions Key or Attr condition against one item"""
+    expression = condition.get_expression()
+    op, values = expression['operator'], expression['values']
+    if op == 'AND':
+        return all(_evaluate(x, item) for x in values)
+    if op == 'OR':
+        return any(_evaluate(x, item) for x in values)
+    if op == 'NOT':
+        return not _evaluate(values[0], item)
+    value = item.get(values[0].name, _missing)
+    if op == 'attribute_exists':
+        return value is not _missing
+    if op == 'attribute_not_exists':
+        return value is _missing
+    if value is _missing:
+        return False
+    if op in _compare:
+        return _compare[op](value, values[1])
+    if op == 'IN':
+        return value in values[1]
+    if op == 'BETWEEN':
+        return values[1] <= value <= values[2]
+    if op == 'begins_with':
+        return value.startswith(values[1])
+    if op == 'contains':
+        return values[1] in value
+    raise _error('ValidationException', 'Unsupported condition operator: %s' % op)
+
+
+class _Expression(object):
+    """The string expressions the repo writes: SET/ADD/REMOVE updates and AND-ed comparison conditions"""
+    Clause = re.compile(r'^\s*(?:(attribute_exists|attribute_not_exists)\s*\(\s*([#\w.]+)\s*\)'
+                        r'|([#\w.]+)\s*(=|<>|<=|>=|<|>)\s*(:\w+))\s*$')
+
+    def __init__(self, names, values):
+        self.__names = names or {}
+        self.__values = values or {}
+
+    def Name(self, token):
+        return self.__names.get(token, token)
+
+    def Value(self, token):
+        if token not in self.__values:
+            raise _error('ValidationException', 'Value %s is not defined' % token)
+        return self.__values[token]
+
+    def Check(self, condition, item):
+        if condition is None:
+            return True
+        if not isinstance(condition, str):
+            return _evaluate(condition, item)
+        for clause in re.split(r'\s+AND\s+', condition.strip(), flags=re.IGNORECASE):
+            match = self.Clause.match(clause)
+            if match is None:
+                raise _error('ValidationException', 'Unsupported condition expression: %s' % clause)
+            function, name, attribute, op, value = match.groups()
+            if function is not None:
+                if (self.Name(name) in item) != (function == 'attribute_exists'):
+                    return False
+            else:
+                found = item.get(self.Name(attribute), _missing)
+                if found is _missing or not _compare[op](found, self.Value(value)):
+                    return False
+        return True
+
+    def Update(self, expression, item):
+        """Apply expression to item, returns the names it set"""
+        updated = []
+        for action, body in re.findall(r'(?i)\b(set|add|remove)\b\s+(.*?)(?=\b(?:set|add|remove)\b\s|$)',
+                                       expression.strip()):
+            for part in (x.strip() for x in body.split(',') if x.strip()):
+                action = action.upper()
+                if action == 'SET':
+                    name, value = [x.strip() for x in part.split('=')]
+                    item[self.Name(name)] = self.Value(value)
+                elif action == 'ADD':
+                    name, value = part.split()
+                    item[self.Name(name)] = item.get(self.Name(name), 0) + self.Value(value)
+                else:
+                    name = part
+                    item.pop(self.Name(name), None)
+                updated.append(self.Name(name))
+        return updated
+
+    def Project(self, projection, item):
+        if projection is None:
+            return item
+        names = [self.Name(x.strip()) for x in projection.split(',')]
+        return dict((k, v) for k, v in item.items() if k in names)
+
+
+class MemoryTable(object):
+    """
+    In-memory DynamoDB table with the boto3 Table calls the repo makes. Writes are type checked the
+    way boto3 does it and read back with numbers as Decimal. Query and Scan return PageSize items per
+    page. Every write is added to Stream as a stream record, so the table can feed a Lambda handler.
+    """
+    PageSize = 100
+
+    def __init__(self, name, keys, indexes=None):
+        self.name = name
+        self.Keys = [x for x in keys if x is not None]
+        self.Indexes = dict((k, [x for x in v if x is not None]) for k, v in (indexes or {}).items())
+        self.Stream = []
+        self.__items = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __Key(self, key):
+        if sorted(key.keys()) != sorted(self.Keys):
+            raise _error('ValidationException', 'The provided key element does not match the schema')
+        return tuple(key[x] for x in self.Keys)
+
+    def __Record(self, event, old, new):
+        key = dict((x, new[x] if new is not None else old[x]) for x in self.Keys)
+        record = {'eventName': event, 'dynamodb': {'Keys': _image(key), 'StreamViewType': 'NEW_AND_OLD_IMAGES'}}
+        if old is not None:
+            record['dynamodb']['OldImage'] = _image(old)
+        if new is not None:
+            record['dynamodb']['NewImage'] = _image(new)
+        self.Stream.append(record)
+
+    def Drain(self):
+        """The stream records written since the last Drain, as a Lambda event"""
+        with self.__lock:
+            records, self.Stream = self.Stream, []
+        return {'Records': records}
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None,
+                 **kwargs):
+        item = _stored(Item)
+        key = self.__Key(dict((x, item.get(x)) for x in self.Keys))
+        expression = _Expression(ExpressionAttributeNames, ExpressionAttributeValues)
+        with self.__lock:
+            old = self.__items.get(key)
+            if not expression.Check(ConditionExpression, old or {}):
+                raise _error('ConditionalCheckFailedException', 'The conditional request failed')
+            self.__items[key] = item
+            self.__Record('INSERT' if old is None else 'MODIFY', old, item)
+        return {}
+
+    def get_item(self, Key, ConsistentRead=False, **kwargs):
+        with self.__lock:
+            item = self.__items.get(self.__Key(Key))
+        return {} if item is None else {'Item': _stored(item)}
+
+    def delete_item(self, Key, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, **kwargs):
+        expression = _Expression(ExpressionAttributeNames, ExpressionAttributeValues)
+        key = self.__Key(Key)
+        with self.__lock:
+            if not expression.Check(ConditionExpression, self.__items.get(key, {})):
+                raise _error('ConditionalCheckFailedException', 'The conditional request failed')
+            old = self.__items.pop(key, None)
+            if old is not None:
+                self.__Record('REMOVE', old, None)
+        return {}
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ReturnValues='NONE', **kwargs):
+        expression = _Expression(ExpressionAttributeNames, _stored(ExpressionAttributeValues or {}))
+        key = self.__Key(Key)
+        with self.__lock:
+            old = self.__items.get(key)
+            if not expression.Check(ConditionExpression, old or {}):
+                raise _error('ConditionalCheckFailedException', 'The conditional request failed')
+            item = _stored(dict(old or Key))
+            updated = expression.Update(UpdateExpression, item)
+            self.__items[key] = item
+            self.__Record('INSERT' if old is None else 'MODIFY', old, item)
+        if ReturnValues == 'UPDATED_NEW':
+            return {'Attributes': _stored(dict((k, item[k]) for k in updated if k in item))}
+        if ReturnValues == 'ALL_NEW':
+            return {'Attributes': _stored(item)}
+        return {}
+
+    def __Page(self, items, keys, kwargs):
+        expression = _Expression(kwargs.get('ExpressionAttributeNames'), kwargs.get('ExpressionAttributeValues'))
+        start = kwargs.get('ExclusiveStartKey')
+        if start is not None:
+            position = [i for i, x in enumerate(items) if all(x.get(k) == start[k] for k in start)]
+            items = items[position[0] + 1:] if len(position) > 0 else []
+        limit = min(self.PageSize, kwargs.get('Limit', self.PageSize))
+        page, more = items[:limit], len(items) > limit
+        found = [expression.Project(kwargs.get('ProjectionExpression'), _stored(x)) for x in page
+                 if expression.Check(kwargs.get('FilterExpression'), x)]
+        response = {'Items': found, 'Count': len(found), 'ScannedCount': len(page)}
+        if more:
+            response['LastEvaluatedKey'] = dict((k, page[-1][k]) for k in set(keys + self.Keys))
+        return response
+
+    def query(self, KeyConditionExpression, IndexName=None, **kwargs):
+        keys = self.Keys if IndexName is None else self.Indexes[IndexName]
+        with self.__lock:
+            items = [x for x in self.__items.values()
+                     if all(k in x for k in keys) and _evaluate(KeyConditionExpression, x)]
+        if len(keys) > 1:
+            items.sort(key=lambda x: x[keys[1]], reverse=kwargs.get('ScanIndexForward') is False)
+        return self.__Page(items, keys, kwargs)
+
+    def scan(self, **kwargs):
+        with self.__lock:
+            items = list(self.__items.values())
+        return self.__Page(items, self.Keys, kwargs)
+
+    def batch_writer(self, **kwargs):
+        return _Batch(self)
+
+    def __len__(self):
+        return len(self.__items)
+
+
+class _Batch(object):
+    def __init__(self, table):
+        self.__table = table
+
+    def put_item(self, Item):
+        self.__table.put_item(Item=Item)
+
+    def delete_item(self, Key):
+        self.__table.delete_item(Key=Key)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class MemoryDb(object):
+    """
+    In-memory stand-in of the boto3 DynamoDB resource holding the repo's tables (see Schemas).
+    BatchGetItem takes at most 100 keys; Unprocessed keys of the next calls can be held back to
+    exercise the retry loops. meta.client takes transactions over its tables.
+    """
+    Schemas = {
+        'Orders': (('OrderId', 'TransactionTime'), {'SymbolMaturity': ('Symbol', 'Maturity')}),
+        'Positions': (('Symbol', 'Contract'), None),
+        'RollSignals': (('Date', 'Contract'), None),
+        'IGSessions': (('SessionKey', None), None),
+        'IGEpics': (('Market', None), None),
+        'Securities': (('Symbol', 'Broker'), None),
+        'Quotes.EOD': (('Symbol', 'Date'), None)
+    }
+
+    def __init__(self, schemas=None):
+        self.__tables = dict((name, MemoryTable(name, keys, indexes))
+                             for name, (keys, indexes) in (schemas or self.Schemas).items())
+        self.Unprocessed = 0
+        self.meta = _Meta(_Client(self))
+        for table in self.__tables.values():
+            table.meta = self.meta
+
+    def Table(self, name):
+        if name not in self.__tables:
+            raise _error('ResourceNotFoundException', 'Requested resource not found: Table: %s not found' % name)
+        return self.__tables[name]
+
+    def batch_get_item(self, RequestItems):
+        if sum(len(x['Keys']) for x in RequestItems.values()) > 100:
+            raise _error('ValidationException', 'Too many items requested for the BatchGetItem call')
+        responses, unprocessed = {}, {}
+        for name, request in RequestItems.items():
+            if self.Unprocessed > 0:
+                self.Unprocessed -= 1
+                unprocessed[name] = request
+                continue
+            table = self.Table(name)
+            expression = _Expression(request.get('ExpressionAttributeNames'), None)
+            found = [table.get_item(Key=key).get('Item') for key in request['Keys']]
+            responses[name] = [expression.Project(request.get('ProjectionExpression'), x)
+                               for x in found if x is not None]
+        return {'Responses': responses, 'UnprocessedKeys': unprocessed}
+
+
+class _Meta(object):
+    def __init__(self, client):
+        self.client = client
+
+
+class _Client(object):
+    """The low-level client calls of MemoryDb: all-or-nothing TransactWriteItems"""
+
+    def __init__(self, db):
+        self.__db = db
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def __Plain(values):
+        return dict((k, _deserializer.deserialize(v)) for k, v in (values or {}).items())
+
+    def transact_write_items(self, TransactItems, **kwargs):
+        with self.__lock:
+            actions, reasons = [], []
+            for item in TransactItems:
+                (kind, request), = item.items()
+                if kind not in ('Update', 'Put', 'Delete', 'ConditionCheck'):
+                    raise _error('ValidationException', 'Unsupported TransactWriteItems action: %s' % kind)
+                table = self.__db.Table(request['TableName'])
+                values = self.__Plain(request.get('ExpressionAttributeValues'))
+                record = self.__Plain(request['Item']) if kind == 'Put' else None
+                key = dict((k, record[k]) for k in table.Keys) if kind == 'Put' else self.__Plain(request['Key'])
+                current = table.get_item(Key=key).get('Item', {})
+                expression = _Expression(request.get('ExpressionAttributeNames'), values)
+                passed = expression.Check(request.get('ConditionExpression'), current)
+                reasons.append({'Code': 'None' if passed else 'ConditionalCheckFailed'})
+                actions.append((kind, table, key, record, request, values))
+            if any(x['Code'] != 'None' for x in reasons):
+                raise _error('TransactionCanceledException',
+                             'Transaction cancelled, please refer cancellation reasons for specific reasons [%s]'
+                             % ', '.join(x['Code'] for x in reasons), CancellationReasons=reasons)
+            for kind, table, key, record, request, values in actions:
+                if kind == 'Update':
+                    table.update_item(Key=key, UpdateExpression=request['UpdateExpression'],
+                                      ExpressionAttributeNames=request.get('ExpressionAttributeNames'),
+                                      ExpressionAttributeValues=values)
+                elif kind == 'Put':
+                    table.put_item(Item=record)
+                elif kind == 'Delete':
+                    table.delete_item(Key=key)
+        return {}
+
+
+class _Object(object):
+    def __init__(self, bucket, key):
+        self.__bucket = bucket
+        self.key = key
+
+    def load(self):
+        if self.key not in self.__bucket.Objects:
+            raise _error('404', 'Not Found', 404)
+
+    def get(self):
+        if self.key not in self.__bucket.Objects:
+            raise _error('NoSuchKey', 'The specified key does not exist.', 404)
+        return {'Body': io.BytesIO(self.__bucket.Objects[self.key])}
+
+
+class _Objects(object):
+    def __init__(self, bucket):
+        self.__bucket = bucket
+
+    def filter(self, Prefix=''):
+        return [_Object(self.__bucket, k) for k in sorted(self.__bucket.Objects) if k.startswith(Prefix)]
+
+    def all(self):
+        return self.filter()
+
+
+class MemoryBucket(object):
+    """In-memory S3 bucket with the boto3 Bucket calls the repo makes, IfNoneMatch included"""
+
+    def __init__(self, name):
+        self.name = name
+        self.Objects = {}
+        self.objects = _Objects(self)
+        self.__lock = threading.Lock()
+
+    def put_object(self, Key, Body, IfNoneMatch=None, **kwargs):
+        body = Body.encode('utf-8') if isinstance(Body, str) else bytes(Body)
+        with self.__lock:
+            if IfNoneMatch == '*' and Key in self.Objects:
+                raise _error('PreconditionFailed', 'At least one of the pre-conditions you specified did not hold',
+                             412)
+            self.Objects[Key] = body
+        return {}
+
+    def Object(self, key):
+        return _Object(self, key)
+
+
+class MemoryS3(object):
+    """In-memory stand-in of the boto3 S3 resource"""
+
+    def __init__(self):
+        self.__buckets = {}
+
+    def Bucket(self, name):
+        return self.__buckets.setdefault(name, MemoryBucket(name))
+
+
+class FakeIG(object):
+    """
+    IG REST API on localhost for tests and offline runs: login, accounts, market search, OTC deals with
+    their confirms, positions and activities. Markets maps each epic to its instrumentName, instrumentType
+    and expiry; a search finds the markets whose epic or name contains the term. Every request waits Latency seconds (plus up to Jitter) and
+    fails with a 503 at ErrorRate; Fail queues specific failures. The server runs on its own thread and
+    loop, so it also serves code that runs its own event loop.
+    """
+
+    def __init__(self, markets, balance=100000.0, ccy='USD', price=15.0, latency=0, jitter=0, errorRate=0,
+                 seed=None):
+        self.Markets = markets
+        self.Balance = balance
+        self.Ccy = ccy
+        self.Price = price
+        self.Latency = latency
+        self.Jitter = jitter
+        self.ErrorRate = errorRate
+        self.Requests = collections.Counter()
+        self.Deals = collections.OrderedDict()
+        self.__random = random.Random(seed)
+        self.__failures = []
+        self.__tokens = {}
+        self.__loop = None
+        self.__runner = None
+        self.__thread = None
+
+    def Fail(self, method, path, status, times=1, errorCode=None):
+        """The next times requests to method path get status, with errorCode in a json body if given"""
+        self.__failures.extend([(method.upper(), path, status, errorCode)] * times)
+
+    def Position(self, deal):
+        market = self.Markets[deal['epic']]
+        return {'market': dict(market, epic=deal['epic']),
+                'position': {'dealReference': deal['dealReference'], 'dealId': deal['dealId'],
+                             'direction': deal['direction'], 'size': deal['size'], 'level': deal['level'],
+                             'createdDateUTC': deal['date'], 'currency': self.Ccy}}
+
+    @web.middleware
+    async def __Middleware(self, request, handler):
+        self.Requests[(request.method, request.path)] += 1
+        await asyncio.sleep(self.Latency + self.__random.uniform(0, self.Jitter))
+        for failure in self.__failures:
+            method, path, status, errorCode = failure
+            if method == request.method and path == request.path:
+                self.__failures.remove(failure)
+                if errorCode is None:
+                    return web.Response(status=status)
+                return web.json_response({'errorCode': errorCode}, status=status)
+        if self.ErrorRate > 0 and self.__random.random() < self.ErrorRate:
+            return web.Response(status=503)
+        if request.path != '/session' or request.method != 'POST':
+            if self.__tokens.get(request.headers.get('CST')) != request.headers.get('X-SECURITY-TOKEN'):
+                return web.json_response({'errorCode': 'error.security.client-token-invalid'}, status=401)
+        return await handler(request)
+
+    async def __Login(self, request):
+        cst, token = uuid.uuid4().hex, uuid.uuid4().hex
+        self.__tokens[cst] = token
+        return web.json_response({'currentAccountId': 'FAKE', 'accountInfo': {'available': self.Balance},
+                                  'currencyIsoCode': self.Ccy}, headers={'CST': cst, 'X-SECURITY-TOKEN': token})
+
+    async def __Logout(self, request):
+        self.__tokens.pop(request.headers.get('CST'), None)
+        return web.Response(status=204)
+
+    async def __Accounts(self, request):
+        return web.json_response({'accounts': [{'accountId': 'FAKE', 'currency': self.Ccy,
+                                                'balance': {'available': self.Balance}}]})
+
+    async def __Markets(self, request):
+        term = request.query.get('searchTerm', '').upper()
+        return web.json_response({'markets': [dict(m, epic=epic) for epic, m in self.Markets.items()
+                                              if term in epic.upper() or term in m['instrumentName'].upper()]})
+
+    async def __Create(self, request):
+        body = await request.json()
+        reference = uuid.uuid4().hex[:15].upper()
+        accepted = body.get('epic') in self.Markets
+        self.Deals[reference] = {'dealReference': reference, 'dealId': 'DI%s' % reference, 'epic': body.get('epic'),
+                                 'direction': body['direction'], 'size': body['size'], 'level': self.Price,
+                                 'status': 'ACCEPTED' if accepted else 'REJECTED',
+                                 'date': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime())}
+        return web.json_response({'dealReference': reference})
+
+    async def __Confirm(self, request):
+        deal = self.Deals.get(request.match_info['reference'])
+        if deal is None:
+            return web.json_response({'errorCode': 'error.confirms.deal-not-found'}, status=404)
+        return web.json_response({'dealReference': deal['dealReference'], 'dealId': deal['dealId'],
+                                  'dealStatus': deal['status'], 'date': deal['date'], 'level': deal['level'],
+                                  'size': deal['size']})
+
+    async def __Positions(self, request):
+        return web.json_response({'positions': [self.Position(x) for x in self.Deals.values()
+                                                if x['status'] == 'ACCEPTED']})
+
+    async def __Activities(self, request):
+        return web.json_response({'activities': [
+            {'date': x['date'], 'dealId': x['dealId'], 'status': x['status'], 'epic': x['epic'],
+             'details': {'dealReference': x['dealReference'], 'level': x['level'], 'size': x['size'],
+                         'direction': x['direction']}} for x in self.Deals.values()]})
+
+    def Start(self):
+        """Serve on a free localhost port, returns the base url"""
+        started = threading.Event()
+        app = web.Application(middlewares=[self.__Middleware])
+        app.router.add_post('/session', self.__Login)
+        app.router.add_delete('/session', self.__Logout)
+        app.router.add_get('/accounts', self.__Accounts)
+        app.router.add_get('/markets', self.__Markets)
+        app.router.add_post('/positions/otc', self.__Create)
+        app.router.add_get('/confirms/{reference}', self.__Confirm)
+        app.router.add_get('/positions', self.__Positions)
+        app.router.add_get('/history/activity', self.__Activities)
+
+        def serve():
+            self.__loop = asyncio.new_event_loop()
+            self.__runner = web.AppRunner(app)
+            self.__loop.run_until_complete(self.__runner.setup())
+            site = web.TCPSite(self.__runner, '127.0.0.1', 0)
+            self.__loop.run_until_complete(site.start())
+            self.Port = self.__runner.addresses[0][1]
+            started.set()
+            self.__loop.run_forever()
+            self.__loop.run_until_complete(self.__runner.cleanup())
+            self.__loop.close()
+
+        self.__thread = threading.Thread(target=serve, name='FakeIG', daemon=True)
+        self.__thread.start()
+        started.wait()
+        return 'http://127.0.0.1:%s' % self.Port
+
+    def Stop(self):
+        if self.__loop is not None:
+            self.__loop.call_soon_threadsafe(self.__loop.stop)
+            self.__thread.join()
+            self.__loop = None
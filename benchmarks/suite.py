@@ -0,0 +1,238 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import decimal
+import logging
+import argparse
+import datetime
+import platform
+import statistics
+import subprocess
+from dateutil.relativedelta import relativedelta
+from contracts import SecurityDefinition, Futures
+from benchmarks.standins import MemoryDb, MemoryS3
+from strategies import vix_roll_trader as vrt
+from executors import ig_executor as ige
+from benchmarks import decode, risk_check, pipeline
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINES = os.path.join(HERE, 'baselines')
+RESULTS = os.path.join(HERE, 'results.json')
+CALIBRATION = 'calibration'
+
+
+def measure(func, repeat, setup=None):
+    """Best and median wall time of repeat calls of func(*setup()); setup is not timed"""
+    times = []
+    for _ in range(repeat):
+        args = () if setup is None else setup()
+        started = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - started)
+    return {'best': min(times), 'median': statistics.median(times), 'repeat': repeat}
+
+
+def calibration(repeat):
+    """Fixed pure Python work; its time relates timings taken on different hosts"""
+    def work():
+        total = 0
+        for i in range(200000):
+            total += i % 7
+        return total
+    yield CALIBRATION, work, repeat, None
+
+
+def expiries(sizes, repeat):
+    secDef = SecurityDefinition()
+    for n in sizes:
+        dates = [datetime.date(2018, 1, 1) + relativedelta(days=+i % 2900) for i in range(n)]
+        yield 'expiry/next_expiry_date/%s' % n, \
+            lambda: [secDef.get_next_expiry_date(Futures.VX, x) for x in dates], repeat, None
+        yield 'expiry/front_month_future/%s' % n, \
+            lambda: [secDef.get_front_month_future(Futures.VX, x) for x in dates], repeat, None
+        yield 'expiry/front_month_futures_batch/%s' % n, \
+            lambda: secDef.get_front_month_futures(Futures.VX, dates), repeat, None
+
+
+def decoding(sizes, repeat):
+    for n in sizes:
+        orders, quotes = decode.order_images(n), decode.quote_images(n)
+        event = {'Records': [{'eventName': 'INSERT', 'dynamodb': {'Keys': {'Symbol': x['Symbol'], 'Date': x['Date']},
+                                                                 'NewImage': x}} for x in quotes]}
+        yield 'decode/orders/%s' % n, lambda: [ige.Order.FromImage(x) for x in orders], repeat, None
+        yield 'decode/quotes/%s' % n, lambda: [vrt.Quote.FromImage(x) for x in quotes], repeat, None
+        yield 'decode/quote_event/%s' % n, lambda: vrt.CoalesceRecords(event, logging.getLogger()), repeat, None
+
+
+def checks(scheduler, loop, sizes, repeat):
+    trades = risk_check.positions(100)
+    for n in sizes:
+        images = decode.order_images(n)
+        batch = risk_check.orders(n)
+        yield 'validate_orders/%s' % n, lambda: loop.run_until_complete(scheduler.ValidateOrders(images)), repeat, None
+        yield 'balance_check/%s' % n, lambda: [scheduler.BalanceCheck(x, trades) for x in batch], repeat, None
+        yield 'risk_check/%s' % n, lambda: scheduler.RiskCheck(batch, trades), repeat, None
+
+
+def positions(sizes, repeat):
+    """GetCurrentPosition from the Orders index over n filled orders of the front maturity, and from the ledger"""
+    today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+    expiry = SecurityDefinition().get_next_expiry_date(Futures.VX, today.date()).strftime('%Y%m')
+    for n in sizes:
+        db = MemoryDb()
+        orders = db.Table('Orders')
+        # about what fits in DynamoDB's 1 MB page
+        orders.PageSize = 1000
+        for i in range(n):
+            orders.put_item(Item={'OrderId': str(i), 'TransactionTime': str(1520607600 + i), 'Symbol': 'VX',
+                                  'Maturity': expiry, 'Broker': 'IG', 'Status': 'FILLED',
+                                  'Trade': {'Side': 'BUY' if i % 2 else 'SELL', 'FilledSize': 1 + i % 3}})
+        resources = vrt.Resources(db, MemoryS3())
+        resources.Positions = None
+        trader = vrt.VixTrader(logging.getLogger(), today, resources)
+        yield 'current_position/orders/%s' % n, lambda: trader.GetCurrentPosition(today.date()), repeat, None
+    resources = vrt.Resources(MemoryDb(), MemoryS3())
+    trader = vrt.VixTrader(logging.getLogger(), today, resources)
+    yield 'current_position/ledger', lambda: trader.GetCurrentPosition(today.date()), repeat, None
+
+
+def end_to_end(offline, loop, sizes, repeat):
+    """executors.ig_executor.main on n new orders over three maturities against the fake broker"""
+    maturities = [(datetime.date.today() + relativedelta(months=+m)).strftime('%Y%m') for m in (1, 2, 3)]
+    table = offline.Db.Table('Orders')
+    batches = iter(range(1000000))
+
+    def orders(n):
+        batch = next(batches)
+        table.Drain()
+        for i in range(n):
+            table.put_item(Item={'OrderId': '%s-%s' % (batch, i), 'TransactionTime': str(time.time()), 'Symbol': 'VX',
+                                 'Broker': 'IG', 'Maturity': maturities[i % 3], 'Status': 'PENDING',
+                                 'ProductType': 'SPREAD', 'Trade': {},
+                                 'Order': {'Side': 'BUY' if i % 2 else 'SELL', 'Size': 1, 'OrdType': 'MARKET'},
+                                 'Strategy': {'Name': 'BENCHMARK', 'Reason': 'OPEN'}})
+        return table.Drain(),
+
+    for n in sizes:
+        yield 'executor_main/%s' % n, \
+            lambda event: loop.run_until_complete(ige.main(loop, logging.getLogger(), event)), \
+            repeat, lambda n=n: orders(n)
+
+
+def run(quick=False, latency=0.001):
+    """{case: {'best', 'median', 'repeat'}} for every case of the suite"""
+    sizes, repeat = ((10, 1000), 3) if quick else ((10, 1000, 10000), 5)
+    results = {}
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    logging.disable(logging.INFO)
+    try:
+        offline = pipeline.Offline(latency=latency, limits=ige.RateLimiter(600000, 600000))
+        offline.Db.Table('Securities').put_item(Item={
+            'Symbol': 'VX', 'Broker': 'IG', 'TradingEnabled': True,
+            'Description': {'Name': 'VX Volatility Index', 'MarketGroup': 'INDICES'},
+            'Risk': {'RiskFactor': decimal.Decimal('0.5'), 'MaxPosition': 1000000}})
+        with offline:
+            params = ige.IGParams()
+            params.Url, params.Identifier = os.environ['IG_URL'], os.environ['IDENTIFIER']
+            scheduler = ige.Scheduler(params, logging.getLogger(), loop)
+            loop.run_until_complete(scheduler.__aenter__())
+            cases = [calibration(repeat), expiries(sizes, repeat), decoding(sizes, repeat),
+                     checks(scheduler, loop, sizes, repeat), positions(sizes[1:], repeat),
+                     end_to_end(offline, loop, (10, 100), repeat)]
+            for generator in cases:
+                for name, func, times, setup in generator:
+                    results[name] = measure(func, times, setup)
+            loop.run_until_complete(scheduler.__aexit__(None, None, None))
+            ige.Notifications.Flush(5)
+    finally:
+        logging.disable(logging.NOTSET)
+        loop.close()
+    return results
+
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def host():
+    """What the timings depend on besides the code"""
+    return {'python': '%s %s' % (platform.python_implementation(), platform.python_version()),
+            'machine': platform.platform(), 'processor': platform.processor() or platform.machine(),
+            'cpus': os.cpu_count()}
+
+
+def save(results, path):
+    created = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    report = {'commit': commit(), 'created': created, 'host': host(), 'results': results}
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    return report
+
+
+def compare(results, baseline, threshold):
+    """
+    (case, baseline best, best, ratio, regressed) for the cases in both runs. When both ran the
+    calibration case, the ratios are divided by its ratio, so a slower host is not a regression.
+    """
+    speed = 1.0
+    if CALIBRATION in results and CALIBRATION in baseline and baseline[CALIBRATION]['best'] > 0:
+        speed = results[CALIBRATION]['best'] / baseline[CALIBRATION]['best']
+    rows = []
+    for name in sorted(results):
+        if name in baseline and name != CALIBRATION:
+            base, now = baseline[name]['best'], results[name]['best']
+            ratio = now / base / speed if base > 0 else float('inf')
+            rows.append((name, base, now, ratio, ratio > threshold))
+    return rows
+
+
+def differences(baseline):
+    """The host details of the baseline that differ from this host, as 'name: baseline != current'"""
+    current = host()
+    recorded = baseline.get('host', {})
+    return ['%s: %s != %s' % (name, recorded.get(name), current[name])
+            for name in sorted(current) if recorded.get(name) != current[name]]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Timings of the trading hot paths')
+    parser.add_argument('--quick', action='store_true', help='10 and 1k sizes only, 3 repeats')
+    parser.add_argument('--output', default=RESULTS, help='results file, default benchmarks/results.json')
+    parser.add_argument('--baseline', default='baseline', help='baseline to compare with, in benchmarks/baselines')
+    parser.add_argument('--save-baseline', metavar='NAME', help='also save the results as baseline NAME')
+    parser.add_argument('--threshold', type=float, default=1.5, help='slowdown ratio reported as a regression')
+    args = parser.parse_args(argv)
+
+    results = run(args.quick)
+    save(results, args.output)
+    if args.save_baseline:
+        save(results, os.path.join(BASELINES, '%s.json' % args.save_baseline))
+
+    path = os.path.join(BASELINES, '%s.json' % args.baseline)
+    if not os.path.exists(path):
+        print('case,best_s,median_s')
+        for name in sorted(results):
+            print('%s,%.6f,%.6f' % (name, results[name]['best'], results[name]['median']))
+        return 0
+    with open(path) as f:
+        baseline = json.load(f)
+    for difference in differences(baseline):
+        print('warning: baseline %s was taken on another host, %s' % (args.baseline, difference), file=sys.stderr)
+    if CALIBRATION not in baseline['results']:
+        print('warning: baseline %s has no calibration, the ratios are raw' % args.baseline, file=sys.stderr)
+    print('case,baseline_s,best_s,ratio,status  (baseline %s at %s)' % (args.baseline, baseline.get('commit')))
+    rows = compare(results, baseline['results'], args.threshold)
+    for name, base, now, ratio, regressed in rows:
+        print('%s,%.6f,%.6f,%.2f,%s' % (name, base, now, ratio, 'REGRESSED' if regressed else 'ok'))
+    return 1 if any(x[4] for x in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,20 +1,178 @@
 import logging
 import datetime
-from dateutil.relativedelta import relativedelta
+import functools
+from dateutil.easter import easter
+from dateutil.relativedelta import relativedelta, MO, TH
+try:
+    import numpy as np
+except ImportError:  # only the batch lookups need numpy
+    np = None
 
 
 class Futures:
     VX = 'VX'
 
 
+MONTH_CODES = {1: "F", 2: "G", 3: "H", 4: "J", 5: "K", 6: "M", 7: "N", 8: "Q", 9: "U", 10: "V", 11: "X", 12: "Z"}
+
+
+# one-off CBOE closures (national days of mourning, market emergencies)
+CBOE_SPECIAL_CLOSURES = frozenset([
+    datetime.date(1994, 4, 27), datetime.date(2001, 9, 11), datetime.date(2001, 9, 12),
+    datetime.date(2001, 9, 13), datetime.date(2001, 9, 14), datetime.date(2004, 6, 11),
+    datetime.date(2007, 1, 2), datetime.date(2012, 10, 29), datetime.date(2012, 10, 30),
+    datetime.date(2018, 12, 5), datetime.date(2025, 1, 9)
+])
+
+
+def _observed(day):
+    if day.weekday() == 5:
+        return day - datetime.timedelta(days=1)
+    if day.weekday() == 6:
+        return day + datetime.timedelta(days=1)
+    return day
+
+
+@functools.lru_cache(maxsize=None)
+def cboe_holidays(year):
+    """
+    Full-day CBOE holidays for a calendar year: the NYSE holiday rules plus
+    Good Friday and the special closures listed above.
+    """
+    jan1 = datetime.date(year, 1, 1)
+    holidays = {
+        jan1 + relativedelta(month=2, weekday=MO(+3)),       # Washington's Birthday
+        easter(year) - datetime.timedelta(days=2),             # Good Friday
+        jan1 + relativedelta(month=5, day=31, weekday=MO(-1)),  # Memorial Day
+        _observed(datetime.date(year, 7, 4)),
+        jan1 + relativedelta(month=9, weekday=MO(+1)),       # Labor Day
+        jan1 + relativedelta(month=11, weekday=TH(+4)),      # Thanksgiving
+        _observed(datetime.date(year, 12, 25))
+    }
+    # New Year's Day falling on a Saturday is not observed on the Friday before
+    if jan1.weekday() != 5:
+        holidays.add(_observed(jan1))
+    if year >= 1998:
+        holidays.add(jan1 + relativedelta(weekday=MO(+3)))  # Martin Luther King Jr. Day
+    if year >= 2022:
+        holidays.add(_observed(datetime.date(year, 6, 19)))  # Juneteenth
+    holidays.update(d for d in CBOE_SPECIAL_CLOSURES if d.year == year)
+    return frozenset(holidays)
+
+
+def is_cboe_business_day(date):
+    return date.weekday() < 5 and date not in cboe_holidays(date.year)
+
+
+def previous_cboe_business_day(date):
+    one_day = datetime.timedelta(days=1)
+    date = date - one_day
+    while not is_cboe_business_day(date):
+        date = date - one_day
+    return date
+
+
+def vix_settlement_date(year, month):
+    """
+    Final settlement date of the VIX future expiring in the given contract month.
+    See SecurityDefinition.get_vix_expiry_date for the exchange rule.
+    """
+    # Date of third friday of the following month
+    if month == 12:
+        third_friday_next_month = datetime.date(year + 1, 1, 15)
+    else:
+        third_friday_next_month = datetime.date(year, month + 1, 15)
+
+    one_day = datetime.timedelta(days=1)
+    thirty_days = datetime.timedelta(days=30)
+    while third_friday_next_month.weekday() != 4:
+        # Using += results in a timedelta object
+        third_friday_next_month = third_friday_next_month + one_day
+
+    # a holiday on the 3rd Friday moves the reference back to the previous business day
+    if not is_cboe_business_day(third_friday_next_month):
+        third_friday_next_month = previous_cboe_business_day(third_friday_next_month)
+    settlement = third_friday_next_month - thirty_days
+    # and a holiday on the settlement date itself moves it back as well
+    if not is_cboe_business_day(settlement):
+        settlement = previous_cboe_business_day(settlement)
+    return settlement
+
+
+class VixCalendar(object):
+    """
+    Table of VIX final settlement dates and contract codes, one entry per contract
+    month, built once per process and shared by all SecurityDefinition instances.
+    Lookups index the table by month, so they are O(1).
+    """
+    FirstYear = 1990
+    LastYear = 2060
+    __instance = None
+
+    def __init__(self, firstYear=FirstYear, lastYear=LastYear):
+        self.FirstYear = firstYear
+        self.LastYear = lastYear
+        self.__arrays = None
+        self.Expiries = []
+        self.Codes = []
+        for year in range(firstYear, lastYear + 1):
+            for month in range(1, 13):
+                self.Expiries.append(vix_settlement_date(year, month))
+                self.Codes.append("%s%s%s" % (Futures.VX, MONTH_CODES[month], str(year)[-1:]))
+
+    @classmethod
+    def instance(cls):
+        if cls.__instance is None:
+            cls.__instance = cls()
+        return cls.__instance
+
+    @classmethod
+    def reset(cls):
+        cls.__instance = None
+
+    def month_index(self, date):
+        """Index of the contract expiring in the calendar month of date, None if out of range"""
+        index = (date.year - self.FirstYear) * 12 + date.month - 1
+        return index if 0 <= index < len(self.Expiries) else None
+
+    def next_index(self, date):
+        """Index of the first contract expiring strictly after date, None if out of range"""
+        index = self.month_index(date)
+        if index is None:
+            return None
+        if not date < self.Expiries[index]:
+            index += 1
+        return index if index < len(self.Expiries) else None
+
+    def arrays(self):
+        """Expiries as datetime64[D] and contract codes as numpy arrays, built on first use"""
+        if self.__arrays is None:
+            if np is None:
+                raise Exception('numpy is required for batch lookups')
+            self.__arrays = (np.array(self.Expiries, dtype='datetime64[D]'), np.array(self.Codes))
+        return self.__arrays
+
+    def next_indices(self, dates):
+        """Vectorized next_index over a datetime64[D] array. Raises if any date is out of range"""
+        expiries, _ = self.arrays()
+        months = dates.astype('datetime64[M]').astype('int64') - (self.FirstYear - 1970) * 12
+        if len(months) > 0 and (months.min() < 0 or months.max() >= len(expiries)):
+            raise Exception('Dates outside the expiry calendar %s-%s' % (self.FirstYear, self.LastYear))
+        indices = months + (dates >= expiries[months])
+        if len(indices) > 0 and indices.max() >= len(expiries):
+            raise Exception('Dates outside the expiry calendar %s-%s' % (self.FirstYear, self.LastYear))
+        return indices
+
+
 class SecurityDefinition(object):
     def __init__(self):
         self.Logger = logging.getLogger()
         self.Logger.setLevel(logging.INFO)
         logging.basicConfig(format='%(asctime)s - %(levelname)s - %(threadName)s - %(message)s')
         self.Logger.info('Security Created.')
-        self.__M = {1: "F", 2: "G", 3: "H", 4: "J", 5: "K", 6: "M", 7: "N", 8: "Q", 9: "U", 10: "V", 11: "X", 12: "Z"}
+        self.__M = MONTH_CODES
         self.__Supported = {'VX': 'VX'}  # symbols and future prefix
+        self.__Calendar = VixCalendar.instance()
 
     # lifted from https://github.com/conor10/examples/blob/master/python/expiries/vix.py
     @staticmethod
@@ -36,22 +194,11 @@ class SecurityDefinition(object):
         CBOE holiday, the Final Settlement Date for the contract shall be thirty
         days prior to the CBOE business day immediately preceding that Friday.
         """
-        # Date of third friday of the following month
-        if date.month == 12:
-            third_friday_next_month = datetime.date(date.year + 1, 1, 15)
-        else:
-            third_friday_next_month = datetime.date(date.year,
-                                                    date.month + 1, 15)
-
-        one_day = datetime.timedelta(days=1)
-        thirty_days = datetime.timedelta(days=30)
-        while third_friday_next_month.weekday() != 4:
-            # Using += results in a timedelta object
-            third_friday_next_month = third_friday_next_month + one_day
-
-        # TODO: Incorporate check that it's a trading day, if so move the 3rd
-        # Friday back by one day before subtracting
-        return third_friday_next_month - thirty_days
+        calendar = VixCalendar.instance()
+        index = calendar.month_index(date)
+        if index is None:
+            return vix_settlement_date(date.year, date.month)
+        return calendar.Expiries[index]
 
     def __get_vix(self, date):
         return "%s%s%s" % (self.__Supported[Futures.VX], self.__M[date.month], str(date.year)[-1:])
@@ -62,6 +209,9 @@ class SecurityDefinition(object):
                 raise Exception('Symbol %s not supported' % symbol)
             # TODO: add support for more contracts
             if symbol == Futures.VX:
+                index = self.__Calendar.next_index(today)
+                if index is not None:
+                    return self.__Calendar.Expiries[index]
                 expiry = self.get_vix_expiry_date(today)
                 return expiry if today < expiry else self.get_vix_expiry_date(today + relativedelta(months=+1))
 
@@ -75,6 +225,9 @@ class SecurityDefinition(object):
                 raise Exception('Symbol %s not supported' % symbol)
             # TODO: add support for more contracts
             if symbol == Futures.VX:
+                index = self.__Calendar.next_index(today)
+                if index is not None:
+                    return self.__Calendar.Codes[index]
                 expiry = self.get_vix_expiry_date(today)
                 return self.__get_vix(today if today < expiry else today + relativedelta(months=+1))
 
@@ -92,10 +245,14 @@ class SecurityDefinition(object):
             if symbol not in self.__Supported:
                 raise Exception('Symbol %s not supported' % symbol)
             today = datetime.datetime.today().date() if date is None else date
+            # TODO: add support for more contracts
+            if symbol == Futures.VX:
+                index = self.__Calendar.next_index(today)
+                if index is not None and index + n <= len(self.__Calendar.Codes):
+                    return self.__Calendar.Codes[index:index + n]
             futures = []
             front = self.get_next_expiry(symbol, today)
             futures.append(front)
-            # TODO: add support for more contracts
             if symbol == Futures.VX:
                 expiry = self.get_vix_expiry_date(today)
             else:
@@ -111,3 +268,60 @@ class SecurityDefinition(object):
         except Exception as e:
             self.Logger.error(e)
             return None
+
+    @staticmethod
+    def __as_days(dates):
+        # accepts datetime64 arrays, pandas DatetimeIndex/Series and sequences of dates
+        if np is None:
+            raise Exception('numpy is required for batch lookups')
+        return np.asarray(dates, dtype='datetime64[D]')
+
+    def get_next_expiry_dates(self, symbol, dates):
+        """Batch get_next_expiry_date: datetime64[D] array of the next expiry for each date"""
+        try:
+            if symbol not in self.__Supported:
+                raise Exception('Symbol %s not supported' % symbol)
+            days = self.__as_days(dates)
+            expiries, _ = self.__Calendar.arrays()
+            return expiries[self.__Calendar.next_indices(days)]
+
+        except Exception as e:
+            self.Logger.error(e)
+            return None
+
+    def get_front_month_futures(self, symbol, dates):
+        """
+        Batch get_front_month_future. Returns a tuple of arrays aligned with dates:
+        expiries (datetime64[D]), calendar days to expiry (int64) and contract codes (VXF8 style)
+        """
+        try:
+            if symbol not in self.__Supported:
+                raise Exception('Symbol %s not supported' % symbol)
+            days = self.__as_days(dates)
+            expiries, codes = self.__Calendar.arrays()
+            indices = self.__Calendar.next_indices(days)
+            front = expiries[indices]
+            return front, (front - days).astype('int64'), codes[indices]
+
+        except Exception as e:
+            self.Logger.error(e)
+            return None
+
+    def get_futures_batch(self, symbol, n, dates):
+        """Batch get_futures: array of shape (len(dates), n) with the next n contract codes per date"""
+        try:
+            if n < 1:
+                raise Exception('n must be positive')
+            if symbol not in self.__Supported:
+                raise Exception('Symbol %s not supported' % symbol)
+            days = self.__as_days(dates)
+            _, codes = self.__Calendar.arrays()
+            indices = self.__Calendar.next_indices(days)[:, None] + np.arange(n)
+            if indices.size > 0 and indices.max() >= len(codes):
+                raise Exception('Dates outside the expiry calendar %s-%s'
+                                % (self.__Calendar.FirstYear, self.__Calendar.LastYear))
+            return codes[indices]
+
+        except Exception as e:
+            self.Logger.error(e)
+            return None
@@ -24,8 +24,40 @@ def create_order():
                 'AttributeName': 'TransactionTime',
                 'AttributeType': 'S'
             },
+            {
+                'AttributeName': 'Symbol',
+                'AttributeType': 'S'
+            },
+            {
+                'AttributeName': 'Maturity',
+                'AttributeType': 'S'
+            },
 
         ],
+        GlobalSecondaryIndexes=[
+            {
+                # position lookups read the orders of one contract instead of scanning the history
+                'IndexName': 'SymbolMaturity',
+                'KeySchema': [
+                    {
+                        'AttributeName': 'Symbol',
+                        'KeyType': 'HASH'
+                    },
+                    {
+                        'AttributeName': 'Maturity',
+                        'KeyType': 'RANGE'
+                    }
+                ],
+                'Projection': {
+                    'ProjectionType': 'INCLUDE',
+                    'NonKeyAttributes': ['Status', 'Broker', 'Trade']
+                },
+                'ProvisionedThroughput': {
+                    'ReadCapacityUnits': 10,
+                    'WriteCapacityUnits': 10
+                }
+            }
+        ],
         ProvisionedThroughput={
             'ReadCapacityUnits': 10,
             'WriteCapacityUnits': 10
@@ -38,17 +70,150 @@ def create_order():
     print("Table status:", table)
 
 
+def create_positions():
+    table = client.create_table(
+        TableName='Positions',
+        KeySchema=[
+            {
+                'AttributeName': 'Symbol',
+                'KeyType': 'HASH'  # Partition key
+            },
+            {
+                'AttributeName': 'Contract',
+                'KeyType': 'RANGE'  # Sort key: Maturity#Broker
+            }
+        ],
+        AttributeDefinitions=[
+            {
+                'AttributeName': 'Symbol',
+                'AttributeType': 'S'
+            },
+            {
+                'AttributeName': 'Contract',
+                'AttributeType': 'S'
+            },
+
+        ],
+        ProvisionedThroughput={
+            'ReadCapacityUnits': 5,
+            'WriteCapacityUnits': 5
+        }
+    )
+
+    w = client.get_waiter('table_exists')
+    w.wait(TableName='Positions')
+    print("table Positions created")
+    print("Table status:", table)
+
+
+def create_roll_signals():
+    table = client.create_table(
+        TableName='RollSignals',
+        KeySchema=[
+            {
+                'AttributeName': 'Date',
+                'KeyType': 'HASH'  # Partition key
+            },
+            {
+                'AttributeName': 'Contract',
+                'KeyType': 'RANGE'  # Sort key
+            }
+        ],
+        AttributeDefinitions=[
+            {
+                'AttributeName': 'Date',
+                'AttributeType': 'S'
+            },
+            {
+                'AttributeName': 'Contract',
+                'AttributeType': 'S'
+            },
+
+        ],
+        ProvisionedThroughput={
+            'ReadCapacityUnits': 5,
+            'WriteCapacityUnits': 5
+        }
+    )
+
+    w = client.get_waiter('table_exists')
+    w.wait(TableName='RollSignals')
+    print("table RollSignals created")
+    print("Table status:", table)
+
+
+def create_ig_sessions():
+    table = client.create_table(
+        TableName='IGSessions',
+        KeySchema=[
+            {
+                'AttributeName': 'SessionKey',
+                'KeyType': 'HASH'  # Partition key: identifier@url
+            }
+        ],
+        AttributeDefinitions=[
+            {
+                'AttributeName': 'SessionKey',
+                'AttributeType': 'S'
+            },
+
+        ],
+        ProvisionedThroughput={
+            'ReadCapacityUnits': 5,
+            'WriteCapacityUnits': 5
+        }
+    )
+
+    w = client.get_waiter('table_exists')
+    w.wait(TableName='IGSessions')
+    print("table IGSessions created")
+    print("Table status:", table)
+
+
+def create_ig_epics():
+    table = client.create_table(
+        TableName='IGEpics',
+        KeySchema=[
+            {
+                'AttributeName': 'Market',
+                'KeyType': 'HASH'  # Partition key: symbol#instrumentName#instrumentType#expiry
+            }
+        ],
+        AttributeDefinitions=[
+            {
+                'AttributeName': 'Market',
+                'AttributeType': 'S'
+            },
+
+        ],
+        ProvisionedThroughput={
+            'ReadCapacityUnits': 5,
+            'WriteCapacityUnits': 5
+        }
+    )
+
+    w = client.get_waiter('table_exists')
+    w.wait(TableName='IGEpics')
+    print("table IGEpics created")
+    print("Table status:", table)
+
+
 client = boto3.client('dynamodb', region_name='us-east-1')
 
-try:
+for name in ['Orders', 'Positions', 'RollSignals', 'IGSessions', 'IGEpics']:
+    try:
 
-    if 'Orders' in client.list_tables()['TableNames']:
-        client.delete_table(TableName='Orders')
-        waiter = client.get_waiter('table_not_exists')
-        waiter.wait(TableName='Orders')
-        print("table Orders deleted")
+        if name in client.list_tables()['TableNames']:
+            client.delete_table(TableName=name)
+            waiter = client.get_waiter('table_not_exists')
+            waiter.wait(TableName=name)
+            print("table %s deleted" % name)
 
-except Exception as e:
-    print(e)
+    except Exception as e:
+        print(e)
 
 create_order()
+create_positions()
+create_roll_signals()
+create_ig_sessions()
+create_ig_epics()
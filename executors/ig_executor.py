@@ -6,15 +6,16 @@ import os
 import boto3
 import logging
 from botocore.exceptions import ClientError
-from boto3.dynamodb.conditions import Key
 import functools
-import smtplib
-from utils import Connection
-from datetime import datetime
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from functools import reduce
-import copy
+import collections
+import concurrent.futures
+from utils import Connection, RetryableError, FatalError, TokenBucket, BatchGet
+from ledger import PositionLedger
+from notifier import Notifier
+import records
+from contracts import SecurityDefinition, Futures
+from datetime import datetime, timezone
+from dateutil.relativedelta import relativedelta
 import time
 import decimal
 
@@ -30,6 +31,13 @@ class OrderStatus(object):
     Failed = 'FAILED'
 
 
+class Stage(object):
+    Lookup = 'lookup'
+    Create = 'create'
+    Confirm = 'confirm'
+    Persist = 'persist'
+
+
 class IGParams(object):
     def __init__(self):
         self.Url = ''
@@ -42,7 +50,24 @@ class IGParams(object):
         self.ESmtp = ''
 
 
-class Order(object):
+@functools.lru_cache(maxsize=128)
+def IGMaturity(maturity):
+    """'201806' as IG writes expiries, 'JUN-18'"""
+    return datetime.strptime(maturity, '%Y%m').strftime('%b-%y').upper()
+
+
+class Order(records.Order):
+    """
+    An order of the batch: the decoded stream record with its Maturity in IG's form, the security
+    definition it was validated against and its execution state.
+    """
+    __slots__ = ('Name', 'MarketGroup', 'RiskFactor', 'MaxPosition', 'Epic', 'Ccy', 'FillTime', 'FillPrice',
+                 'FillSize', 'BrokerReferenceId', 'Stage')
+    # an order in flight is an identity, not a value
+    __eq__ = object.__eq__
+    __ne__ = object.__ne__
+    __hash__ = object.__hash__
+
     def __init__(self, orderId, transactionTime, symbol, side, size, ordType, maturity, name, group, risk, maxPos, stop):
         self.OrderId = orderId
         self.TransactionTime = transactionTime
@@ -50,11 +75,29 @@ class Order(object):
         self.Size = float(size)
         self.OrdType = ordType
         self.Symbol = symbol
-        self.Maturity = datetime.strptime(maturity, '%Y%m').strftime('%b-%y').upper()
+        self.Maturity = IGMaturity(maturity)
+        self.StopDistance = None if stop is None else float(stop)
+        self.Broker = self.ProductType = self.Strategy = self.Reason = self.Trade = None
+        self.Define(name, group, risk, maxPos)
+        self.__Pending()
+
+    @classmethod
+    def FromImage(cls, image):
+        order = cls.__new__(cls).Decode(image)
+        order.Size = float(order.Size)
+        order.Maturity = IGMaturity(order.Maturity)
+        order.StopDistance = None if order.StopDistance is None else float(order.StopDistance)
+        order.Define(None, None, None, None)
+        order.__Pending()
+        return order
+
+    def Define(self, name, group, risk, maxPos):
         self.Name = name
         self.MarketGroup = group
         self.RiskFactor = risk
         self.MaxPosition = maxPos
+
+    def __Pending(self):
         self.Epic = ''
         self.Ccy = ''
         self.FillTime = None
@@ -62,7 +105,7 @@ class Order(object):
         self.FillSize = None
         self.Status = OrderStatus.Pending
         self.BrokerReferenceId = ''
-        self.StopDistance = stop
+        self.Stage = None
 
 
 class Money(object):
@@ -71,13 +114,358 @@ class Money(object):
         self.Amount = amount
 
 
+class IGSession(object):
+    """
+    Tokens and account details of one IG login. IG keeps the CST/X-SECURITY-TOKEN pair alive for
+    Lifetime seconds after the last request and at most MaxAge seconds after the login; the session
+    is treated as expired Margin seconds before either limit. Times are epoch seconds, so a session
+    can be shared between containers.
+    """
+    Lifetime = 6 * 3600
+    MaxAge = 72 * 3600
+    Margin = 300
+
+    def __init__(self, tokens, accountId, balance, created=None, used=None, balanceTime=None):
+        now = time.time()
+        self.Tokens = tokens
+        self.AccountId = accountId
+        self.Balance = balance
+        self.Created = now if created is None else created
+        self.Used = self.Created if used is None else used
+        self.BalanceTime = self.Created if balanceTime is None else balanceTime
+
+    @classmethod
+    def FromLogin(cls, tokens, payload):
+        return cls(tokens, payload.get('currentAccountId'),
+                   Money(payload['accountInfo']['available'], payload['currencyIsoCode']))
+
+    @property
+    def Expires(self):
+        return min(self.Used + self.Lifetime, self.Created + self.MaxAge) - self.Margin
+
+    def IsValid(self, now=None):
+        return (time.time() if now is None else now) < self.Expires
+
+    def Touch(self):
+        self.Used = time.time()
+
+    def SetBalance(self, balance):
+        self.Balance = balance
+        self.BalanceTime = time.time()
+
+    def ExpireBalance(self):
+        self.BalanceTime = 0
+
+    def IsBalanceFresh(self, ttl, now=None):
+        return (time.time() if now is None else now) - self.BalanceTime < ttl
+
+    def ToItem(self, key):
+        return {
+            'SessionKey': key,
+            'Tokens': self.Tokens,
+            'AccountId': self.AccountId,
+            'Balance': {'Amount': decimal.Decimal(str(self.Balance.Amount)), 'Ccy': self.Balance.Ccy},
+            'Created': decimal.Decimal(str(self.Created)),
+            'Used': decimal.Decimal(str(self.Used)),
+            'BalanceTime': decimal.Decimal(str(self.BalanceTime))
+        }
+
+    @classmethod
+    def FromItem(cls, item):
+        return cls(dict(item['Tokens']), item['AccountId'],
+                   Money(float(item['Balance']['Amount']), item['Balance']['Ccy']),
+                   float(item['Created']), float(item['Used']), float(item['BalanceTime']))
+
+
+class DynamoSessionStore(object):
+    """Sessions shared by all containers in a table keyed by SessionKey"""
+
+    def __init__(self, table):
+        self.__Sessions = table
+
+    def Get(self, key):
+        response = self.__Sessions.get_item(Key={'SessionKey': key}, ConsistentRead=True)
+        if 'Item' not in response:
+            return None
+        return IGSession.FromItem(response['Item'])
+
+    def Put(self, key, session):
+        self.__Sessions.put_item(Item=session.ToItem(key))
+
+    def Delete(self, key):
+        self.__Sessions.delete_item(Key={'SessionKey': key})
+
+
+class SessionCache(object):
+    """
+    IG sessions kept for the life of the container, keyed by identifier and API url. With a store
+    the sessions are also shared, so a cold container can skip the login too.
+    """
+
+    def __init__(self, store=None):
+        self.Store = store
+        self.__sessions = {}
+
+    def Get(self, key):
+        session = self.__sessions.get(key)
+        if session is None and self.Store is not None:
+            session = self.Store.Get(key)
+        if session is None or not session.IsValid():
+            self.__sessions.pop(key, None)
+            return None
+        self.__sessions[key] = session
+        return session
+
+    def Put(self, key, session):
+        self.__sessions[key] = session
+        if self.Store is not None:
+            self.Store.Put(key, session)
+
+    def Invalidate(self, key):
+        self.__sessions.pop(key, None)
+        if self.Store is not None:
+            self.Store.Delete(key)
+
+    def __len__(self):
+        return len(self.__sessions)
+
+
+class DynamoEpicStore(object):
+    """Resolved epics persisted in a table keyed by Market = 'symbol#instrumentName#instrumentType#expiry'"""
+
+    def __init__(self, table):
+        self.__Epics = table
+
+    def Load(self):
+        items = []
+        query = {}
+        while True:
+            response = self.__Epics.scan(**query)
+            items.extend(response.get('Items', []))
+            if 'LastEvaluatedKey' not in response:
+                break
+            query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        return [((x['Symbol'], x['InstrumentName'], x['InstrumentType'], x['Expiry']), x['Epic'], float(x['Stored']))
+                for x in items]
+
+    def Put(self, entries):
+        with self.__Epics.batch_writer() as batch:
+            for key, epic, stored in entries:
+                batch.put_item(Item={
+                    'Market': '#'.join(key),
+                    'Symbol': key[0],
+                    'InstrumentName': key[1],
+                    'InstrumentType': key[2],
+                    'Expiry': key[3],
+                    'Epic': epic,
+                    'Stored': decimal.Decimal(str(stored))
+                })
+
+
+class EpicCache(object):
+    """
+    IG epics keyed by (symbol, instrumentName, instrumentType, expiry). One SearchMarkets call resolves
+    every contract of a symbol and orders arriving together share it. A dated contract's epic is dropped
+    after the contract expires (SecurityDefinition expiry for VX, the end of the expiry month otherwise),
+    an undated one after Ttl seconds. With a store the epics survive the container.
+    """
+    Ttl = 24 * 3600
+
+    def __init__(self, store=None, logger=None, clock=time.time):
+        self.Store = store
+        self.__logger = logger if logger is not None else logging.getLogger()
+        self.__clock = clock
+        self.__epics = {}
+        self.__pending = {}
+        self.__warm = False
+
+    @staticmethod
+    def Expires(symbol, expiry):
+        try:
+            month = datetime.strptime(expiry, '%b-%y').date()
+        except ValueError:
+            return None
+        if symbol == Futures.VX:
+            return SecurityDefinition.get_vix_expiry_date(month)
+        return month + relativedelta(months=+1, days=-1)
+
+    def IsValid(self, key, stored):
+        now = self.__clock()
+        expires = self.Expires(key[0], key[3])
+        if expires is None:
+            return now - stored < self.Ttl
+        return datetime.fromtimestamp(now, timezone.utc).date() <= expires
+
+    def Get(self, key):
+        if key not in self.__epics:
+            return None
+        epic, stored = self.__epics[key]
+        if not self.IsValid(key, stored):
+            del self.__epics[key]
+            return None
+        return epic
+
+    def Put(self, key, epic, stored=None):
+        self.__epics[key] = (epic, self.__clock() if stored is None else stored)
+
+    def Warm(self):
+        """Load the persisted epics once per container, returns the number loaded"""
+        if self.__warm or self.Store is None:
+            return 0
+        loaded = 0
+        for key, epic, stored in self.Store.Load():
+            if self.IsValid(key, stored):
+                self.Put(key, epic, stored)
+                loaded += 1
+        self.__warm = True
+        return loaded
+
+    async def Resolve(self, symbol, name, group, expiry, search):
+        """The epic of the contract, searching the markets of symbol with search(symbol) on a miss"""
+        key = (symbol, name, group, expiry)
+        epic = self.Get(key)
+        if epic is not None:
+            return epic
+        pending = self.__pending.get(symbol)
+        if pending is None:
+            pending = asyncio.ensure_future(self.__Search(symbol, search))
+            self.__pending[symbol] = pending
+        await asyncio.shield(pending)
+        return self.Get(key)
+
+    async def __Search(self, symbol, search):
+        try:
+            lookup = await search(symbol)
+            if lookup is None:
+                return
+            found = {}
+            for market in lookup.get('markets', []):
+                if 'epic' in market and 'expiry' in market:
+                    key = (symbol, market['instrumentName'], market['instrumentType'], market['expiry'])
+                    found.setdefault(key, set()).add(market['epic'])
+            # a contract matching several markets is ambiguous and stays unresolved
+            entries = [(key, epics.pop(), self.__clock()) for key, epics in found.items() if len(epics) == 1]
+            for key, epic, stored in entries:
+                self.Put(key, epic, stored)
+            if self.Store is not None and len(entries) > 0:
+                try:
+                    await asyncio.get_event_loop().run_in_executor(None, self.Store.Put, entries)
+                except Exception as e:
+                    self.__logger.error('EpicCache: %s' % e)
+        finally:
+            self.__pending.pop(symbol, None)
+
+    def __len__(self):
+        return len(self.__epics)
+
+
+class RateLimiter(object):
+    """
+    Client side of the IG allowances, shared by every IGClient of the container: one bucket for dealing
+    requests and one for everything else. A bucket may send Capacity requests at once and then refills
+    so that Capacity plus a minute of refill stays within the allowance per minute.
+    """
+    TradingPerMinute = 100
+    NonTradingPerMinute = 30
+
+    def __init__(self, tradingPerMinute=TradingPerMinute, nonTradingPerMinute=NonTradingPerMinute):
+        self.Trading = self.Bucket(tradingPerMinute)
+        self.NonTrading = self.Bucket(nonTradingPerMinute)
+
+    @staticmethod
+    def Bucket(perMinute):
+        capacity = max(1, perMinute // 10)
+        return TokenBucket((perMinute - capacity) / 60.0, capacity)
+
+    def Metrics(self):
+        return {'trading': self.Trading.Metrics(), 'nonTrading': self.NonTrading.Metrics()}
+
+
+Sessions = SessionCache()
+Epics = EpicCache()
+Limits = RateLimiter()
+Notifications = None
+Db = None
+Writers = None
+
+
+def GetDb():
+    """The DynamoDB resource of the container; set Db to run against a stand-in such as benchmarks.standins.MemoryDb"""
+    global Db
+    if Db is None:
+        Db = boto3.resource('dynamodb', region_name='us-east-1')
+    return Db
+
+
+def GetWriters():
+    """
+    The StoreManager threads of the container. They outlive an invocation, so a write still hung at
+    its end holds a thread, not the event loop.
+    """
+    global Writers
+    if Writers is None:
+        Writers = concurrent.futures.ThreadPoolExecutor(max_workers=StoreManager.Writers, thread_name_prefix='Writer')
+    return Writers
+
+
+def GetNotifier(params, logger):
+    """The notifier of the container, its SMTP connection is reused by the following invocations"""
+    global Notifications
+    if Notifications is None:
+        Notifications = Notifier(params.ESmtp, 587, params.EUser, params.EPassword, params.EAddress,
+                                 [params.EAddress], logger, window=DigestWindow)
+    return Notifications
+
+
 class StoreManager(object):
-    def __init__(self, logger, loop=None):
+    """
+    Status updates are written behind: Enqueue hands the conditional update to the container's pool of
+    Writers threads (GetWriters) and returns at once, Flush waits for the queued writes and reports each
+    order's result.
+    """
+    Writers = 8
+
+    def __init__(self, logger, loop=None, db=None, executor=None):
         self.__timeout = 10
         self.__logger = logger
+        self.__db = db
+        self.__executor = executor
+        self.__writes = collections.OrderedDict()
         self.__loop = loop if loop is not None else asyncio.get_event_loop()
 
+    def Enqueue(self, order):
+        """Queue the status update of order; the write starts as soon as a writer is free"""
+        self.__writes[order.OrderId] = self.__loop.run_in_executor(self.__executor, self.Write, order)
+
+    async def Flush(self, timeout=None):
+        """
+        Wait up to timeout seconds for the queued writes, returns {OrderId: (saved, update)} in the order
+        they were queued. Writes still running at the timeout are reported as not saved.
+        """
+        writes, self.__writes = self.__writes, collections.OrderedDict()
+        if len(writes) > 0:
+            await asyncio.wait(writes.values(), timeout=timeout)
+        updates = collections.OrderedDict()
+        for orderId, write in writes.items():
+            if not write.done():
+                updates[orderId] = (False, 'UpdateStatus: timed out after %ss.' % timeout)
+            elif write.exception() is not None:
+                updates[orderId] = (False, 'UpdateStatus: %s' % write.exception())
+            else:
+                updates[orderId] = write.result()
+            if not updates[orderId][0]:
+                self.__logger.error('OrderId: %s. Status not saved. %s' % (orderId, updates[orderId][1]))
+        return updates
+
     def UpdateStatus(self, order):
+        return self.Write(order)[1]
+
+    def Write(self, order):
+        """
+        The conditional update of a PENDING order, returns (saved, update). A fill is written in the same
+        transaction as its position in the ledger, so the two cannot drift apart.
+        """
+        saved = False
         update = 'UpdateStatus: '
         try:
             if order.Status == OrderStatus.Filled:
@@ -87,27 +475,33 @@ class StoreManager(object):
                   "FilledSize": decimal.Decimal(str(order.FillSize)),
                   "Price": decimal.Decimal(str(order.FillPrice)),
                   "Broker": {"Name": "IG", "RefType": "dealId", "Ref": order.BrokerReferenceId},
-                  "StopDistance": order.StopDistance
+                  "StopDistance": None if order.StopDistance is None else decimal.Decimal(str(order.StopDistance))
                 }
             if order.Status == OrderStatus.Failed:
                 trade = {}
 
-            response = self.__Orders.update_item(
-                Key={
+            request = {
+                'Key': {
                     'OrderId': order.OrderId,
                     'TransactionTime': order.TransactionTime,
                 },
-                UpdateExpression="set #s = :s, Trade = :t",
-                ConditionExpression="#s = :p",
-                ExpressionAttributeNames={
+                'UpdateExpression': "set #s = :s, Trade = :t",
+                'ConditionExpression': "#s = :p",
+                'ExpressionAttributeNames': {
                     '#s': 'Status'
                 },
-                ExpressionAttributeValues={
+                'ExpressionAttributeValues': {
                     ':s': order.Status,
                     ':t': trade,
                     ':p': 'PENDING'
-                },
-                ReturnValues="UPDATED_NEW")
+                }
+            }
+            if order.Status == OrderStatus.Filled:
+                position = self.RecordFill(order, request)
+                response = {'Attributes': {'Status': order.Status, 'Trade': trade}}
+            else:
+                position = ''
+                response = self.__Orders.update_item(ReturnValues="UPDATED_NEW", **request)
             update += '%s' % response['Attributes']
 
         except ClientError as e:
@@ -115,49 +509,59 @@ class StoreManager(object):
             update += e.response['Error']['Message']
         except Exception as e:
             self.__logger.error(e)
-            update += e
+            update += '%s' % e
         else:
-            update += ". UpdateItem succeeded."
+            saved = True
+            update += ". UpdateItem succeeded." + position
             self.__logger.info(response)
 
         self.__logger.info('Update: %s', update)
-        return update
+        return saved, update
+
+    def RecordFill(self, order, request):
+        """Write the order update request and the fill to the ledger in one transaction"""
+        maturity = datetime.strptime(order.Maturity, '%b-%y').strftime('%Y%m')
+        change = self.__Positions.RecordWith(dict(request, TableName=self.__Orders.name), order.Symbol, maturity,
+                                             'IG', order.Side, order.FillSize)
+        return ' Position %s %s changed by %s.' % (order.Symbol, maturity, change)
 
-    @Connection.ioreliable
     async def GetSecurities(self, securities):
+        """The Securities rows of the distinct (Symbol, Broker) keys read with BatchGetItem, None if it keeps failing"""
+        keys = list(collections.OrderedDict.fromkeys(securities))
+        self.__logger.info('Calling securities batch get %s ...' % keys)
+        batch = BatchGet(self.__Db, self.__Securities.name,
+                         [{'Symbol': symbol, 'Broker': broker} for symbol, broker in keys])
         try:
-            self.__logger.info('Calling securities query ...')
-            pairs = list(map(lambda x: Key('Symbol').eq(x[0]) & Key('Broker').eq(x[1]), securities))
-            keyCondition = reduce(lambda x, y: x | y, pairs) if len(pairs) > 1 else pairs[0]
-
-            with async_timeout.timeout(self.__timeout):
-                response = await self.__loop.run_in_executor(None,
-                                                             functools.partial(self.__Securities.scan,
-                                                                               FilterExpression=keyCondition))
-                return response['Items']
-
-        except ClientError as e:
-            self.__logger.error(e.response['Error']['Message'])
-            return None
-        except Exception as e:
-            self.__logger.error(e)
-            return None
+            async with async_timeout.timeout(self.__timeout):
+                items = await batch.RunAsync(self.__loop)
+        except asyncio.TimeoutError:
+            items = None
+        if items is None:
+            self.__logger.error('Securities batch get %s failed' % keys)
+        return items
 
     async def __aenter__(self):
-        db = boto3.resource('dynamodb', region_name='us-east-1')
+        db = self.__db if self.__db is not None else boto3.resource('dynamodb', region_name='us-east-1')
+        self.__Db = db
         self.__Securities = db.Table('Securities')
         self.__Orders = db.Table('Orders')
+        self.__Positions = PositionLedger(db.Table('Positions'))
+        if self.__executor is None:
+            self.__executor = GetWriters()
         self.__logger.info('StoreManager created')
         return self
 
     async def __aexit__(self, *args, **kwargs):
+        # the pool is not shut down: it is shared, and waiting on a hung write would block the loop
+        if len(self.__writes) > 0:
+            await self.Flush(self.__timeout)
         self.__logger.info('StoreManager destroyed')
 
 
 class IGClient:
     """IG client."""
 
-    def __init__(self, params, logger, loop=None):
+    def __init__(self, params, logger, loop=None, sessions=None, limits=None):
         self.__timeout = 10
         self.__logger = logger
         self.__id = params.Identifier
@@ -165,26 +569,67 @@ class IGClient:
         self.__url = params.Url
         self.__key = params.Key
         self.__tokens = None
+        self.__sessions = sessions
+        self.__limits = limits if limits is not None else Limits
+        self.__login = asyncio.Lock()
+        self.Session = None
         self.__loop = loop if loop is not None else asyncio.get_event_loop()
 
+    @property
+    def SessionKey(self):
+        return '%s@%s' % (self.__id, self.__url)
+
+    async def Connect(self):
+        """Resume the cached session if it is still valid, otherwise log in. Returns the IGSession or None"""
+        if self.__sessions is not None:
+            try:
+                session = await self.__loop.run_in_executor(None, self.__sessions.Get, self.SessionKey)
+            except Exception as e:
+                self.__logger.error('Connect: session cache, %s' % e)
+                session = None
+            if session is not None:
+                self.__logger.info('Reusing IG session of account %s, valid for %d s'
+                                   % (session.AccountId, session.Expires - time.time()))
+                self.Session = session
+                self.__tokens = session.Tokens
+                return session
+        payload = await self.Login()
+        return None if payload is None else self.Session
+
+    async def RefreshBalance(self):
+        """Reload the available balance of the session account, keeping the cached one on failure"""
+        payload = await self.GetAccounts()
+        found = [] if payload is None else [a for a in payload.get('accounts', [])
+                                            if a['accountId'] == self.Session.AccountId]
+        if len(found) == 1:
+            self.Session.SetBalance(Money(found[0]['balance']['available'], found[0]['currency']))
+        else:
+            self.__logger.error('RefreshBalance: account %s not found, using the cached balance'
+                                % self.Session.AccountId)
+        return self.Session.Balance
+
     @Connection.ioreliable
     async def Logout(self):
         try:
             url = '%s/%s' % (self.__url, 'session')
-            with async_timeout.timeout(self.__timeout):
-                self.__logger.info('Calling Logout ...')
-                response = await self.__connection.delete(url=url, headers=self.__tokens)
-                self.__logger.info('Logout Response Code: {}'.format(response.status))
-                return True
+            self.__logger.info('Calling Logout ...')
+            response = await self.__Send('delete', url)
+            self.__logger.info('Logout Response Code: {}'.format(response.status))
+            await self.__Check(response)
+            if self.__sessions is not None:
+                await self.__loop.run_in_executor(None, self.__sessions.Invalidate, self.SessionKey)
+            self.Session = None
+            return True
         except Exception as e:
             self.__logger.error('Logout: %s, %s' % (self.__url, e))
-            return False
+            raise
 
     @Connection.ioreliable
     async def Login(self):
         try:
             url = '%s/%s' % (self.__url, 'session')
-            with async_timeout.timeout(self.__timeout):
+            await self.__limits.NonTrading.Acquire()
+            async with async_timeout.timeout(self.__timeout):
                 authenticationRequest = {
                     'identifier': self.__id,
                     'password': self.__password,
@@ -193,111 +638,200 @@ class IGClient:
                 self.__logger.info('Calling authenticationRequest ...')
                 response = await self.__connection.post(url=url, json=authenticationRequest)
                 self.__logger.info('Login Response Code: {}'.format(response.status))
+                await self.__Check(response)
                 self.__tokens = {'X-SECURITY-TOKEN': response.headers['X-SECURITY-TOKEN'],
                                  'CST': response.headers['CST']}
                 payload = await response.json()
-                return payload
+            self.Session = IGSession.FromLogin(self.__tokens, payload)
+            if self.__sessions is not None:
+                try:
+                    await self.__loop.run_in_executor(None, self.__sessions.Put, self.SessionKey, self.Session)
+                except Exception as e:
+                    self.__logger.error('Login: session cache, %s' % e)
+            return payload
         except Exception as e:
             self.__logger.error('Login: %s, %s' % (self.__url, e))
-            return None
+            raise
 
     @Connection.ioreliable
     async def CreatePosition(self, order):
         try:
             url = '%s/%s' % (self.__url, 'positions/otc')
-            with async_timeout.timeout(self.__timeout):
-                request = {
-                    "currencyCode": order.Ccy,
-                    "direction": order.Side,
-                    "epic": order.Epic,
-                    "expiry": order.Maturity,
-                    "forceOpen": False if order.StopDistance is None else True,
-                    "guaranteedStop": False if order.StopDistance is None else True,
-                    "level": None,
-                    "limitDistance": None,
-                    "limitLevel": None,
-                    "orderType": order.OrdType,
-                    "quoteId": None,
-                    "size": order.Size,
-                    "stopDistance": order.StopDistance,
-                    "stopLevel": None,
-                    "timeInForce": "FILL_OR_KILL",
-                    "trailingStop": None,
-                    "trailingStopIncrement": None,
-                }
-                self.__logger.info('Calling CreatePosition ...')
-                tokens = copy.deepcopy(self.__tokens)
-                tokens['Version'] = "2"
-                response = await self.__connection.post(url=url, headers=tokens, json=request)
-                self.__logger.info('CreatePosition Response Code: {}'.format(response.status))
-                payload = await response.json()
-                return payload
+            request = {
+                "currencyCode": order.Ccy,
+                "direction": order.Side,
+                "epic": order.Epic,
+                "expiry": order.Maturity,
+                "forceOpen": False if order.StopDistance is None else True,
+                "guaranteedStop": False if order.StopDistance is None else True,
+                "level": None,
+                "limitDistance": None,
+                "limitLevel": None,
+                "orderType": order.OrdType,
+                "quoteId": None,
+                "size": order.Size,
+                "stopDistance": order.StopDistance,
+                "stopLevel": None,
+                "timeInForce": "FILL_OR_KILL",
+                "trailingStop": None,
+                "trailingStopIncrement": None,
+            }
+            self.__logger.info('Calling CreatePosition ...')
+            response = await self.__Send('post', url, version='2', body=request, trading=True)
+            self.__logger.info('CreatePosition Response Code: {}'.format(response.status))
+            await self.__Check(response, idempotent=False)
+            payload = await response.json()
+            return payload
         except Exception as e:
             self.__logger.error('CreatePosition: %s, %s' % (self.__url, e))
-            return None
+            if isinstance(e, RetryableError):
+                raise
+            # only a throttled request is known not to have reached the dealing engine
+            raise FatalError('CreatePosition: %s' % e)
+
+    @Connection.ioreliable
+    async def GetAccounts(self):
+        try:
+            url = '%s/accounts' % self.__url
+            self.__logger.info('Calling GetAccounts ...')
+            response = await self.__Send('get', url)
+            self.__logger.info('GetAccounts Response Code: {}'.format(response.status))
+            await self.__Check(response)
+            payload = await response.json()
+            return payload
+        except Exception as e:
+            self.__logger.error('GetAccounts: %s, %s' % (self.__url, e))
+            raise
+
+    @Connection.ioreliable
+    async def GetConfirm(self, dealReference):
+        try:
+            url = '%s/confirms/%s' % (self.__url, dealReference)
+            self.__logger.info('Calling GetConfirm ...')
+            response = await self.__Send('get', url)
+            self.__logger.info('GetConfirm Response Code: {}'.format(response.status))
+            await self.__Check(response)
+            if response.status == 404:
+                # not confirmed yet
+                return {}
+            payload = await response.json()
+            return payload
+        except Exception as e:
+            self.__logger.error('GetConfirm: %s, %s' % (self.__url, e))
+            raise
 
     @Connection.ioreliable
     async def GetPositions(self):
         try:
             url = '%s/positions' % self.__url
-            with async_timeout.timeout(self.__timeout):
-                self.__logger.info('Calling GetPositions ...')
-                tokens = copy.deepcopy(self.__tokens)
-                tokens['Version'] = "2"
-                response = await self.__connection.get(url=url, headers=tokens)
-                self.__logger.info('GetPositions Response Code: {}'.format(response.status))
-                payload = await response.json()
-                return payload
+            self.__logger.info('Calling GetPositions ...')
+            response = await self.__Send('get', url, version='2')
+            self.__logger.info('GetPositions Response Code: {}'.format(response.status))
+            await self.__Check(response)
+            payload = await response.json()
+            return payload
         except Exception as e:
             self.__logger.error('GetPositions: %s, %s' % (self.__url, e))
-            return None
+            raise
 
     @Connection.ioreliable
     async def GetActivities(self, fromDate, details=False):
         try:
             url = '%s/history/activity?from=%s&detailed=%s' % (self.__url, fromDate, details)
-            with async_timeout.timeout(self.__timeout):
-                self.__logger.info('Calling GetActivities ...')
-                tokens = copy.deepcopy(self.__tokens)
-                tokens['Version'] = "3"
-                response = await self.__connection.get(url=url, headers=tokens)
-                self.__logger.info('GetActivities Response Code: {}'.format(response.status))
-                payload = await response.json()
-                return payload
+            self.__logger.info('Calling GetActivities ...')
+            response = await self.__Send('get', url, version='3')
+            self.__logger.info('GetActivities Response Code: {}'.format(response.status))
+            await self.__Check(response)
+            payload = await response.json()
+            return payload
         except Exception as e:
             self.__logger.error('GetActivities: %s, %s' % (self.__url, e))
-            return None
+            raise
 
     @Connection.ioreliable
     async def GetPosition(self, dealId):
         try:
             url = '%s/positions/%s' % (self.__url, dealId)
-            with async_timeout.timeout(self.__timeout):
-                self.__logger.info('Calling GetPosition ...')
-                response = await self.__connection.get(url=url, headers=self.__tokens)
-                self.__logger.info('GetPosition Response Code: {}'.format(response.status))
-                payload = await response.json()
-                return payload
+            self.__logger.info('Calling GetPosition ...')
+            response = await self.__Send('get', url)
+            self.__logger.info('GetPosition Response Code: {}'.format(response.status))
+            await self.__Check(response)
+            payload = await response.json()
+            return payload
         except Exception as e:
             self.__logger.error('GetPosition: %s, %s' % (self.__url, e))
-            return None
+            raise
 
     @Connection.ioreliable
     async def SearchMarkets(self, term):
         try:
             url = '%s/markets?searchTerm=%s' % (self.__url, term)
-            with async_timeout.timeout(self.__timeout):
-                self.__logger.info('Calling SearchMarkets ...')
-                response = await self.__connection.get(url=url, headers=self.__tokens)
-                self.__logger.info('SearchMarkets Response Code: {}'.format(response.status))
-                payload = await response.json()
-                return payload
+            self.__logger.info('Calling SearchMarkets ...')
+            response = await self.__Send('get', url)
+            self.__logger.info('SearchMarkets Response Code: {}'.format(response.status))
+            await self.__Check(response)
+            payload = await response.json()
+            return payload
         except Exception as e:
             self.__logger.error('SearchMarkets: %s, %s' % (self.__url, e))
-            return None
+            raise
+
+    async def __Send(self, method, url, version=None, body=None, trading=False):
+        """
+        Authenticated request with the body read, paced by the trading or non-trading bucket. An allowance
+        error slows that bucket down. A 401 means the cached tokens have expired: log in once (concurrent
+        requests share that login) and repeat the request with the new tokens.
+        """
+        bucket = self.__limits.Trading if trading else self.__limits.NonTrading
+        for attempt in range(2):
+            waited = await bucket.Acquire()
+            if waited > 0:
+                self.__logger.info('%s %s: queued %.3fs by the rate limiter' % (method.upper(), url, waited))
+            tokens = self.__tokens
+            headers = dict(tokens or {})
+            if version is not None:
+                headers['Version'] = version
+            async with async_timeout.timeout(self.__timeout):
+                response = await self.__connection.request(method, url, headers=headers, json=body)
+                await response.read()
+            if await self.__IsThrottled(response):
+                self.__logger.info('%s %s: allowance exceeded, slowing down' % (method.upper(), url))
+                bucket.Slow()
+            if response.status != 401:
+                if self.Session is not None:
+                    self.Session.Touch()
+                return response
+            if attempt > 0:
+                break
+            self.__logger.info('%s %s: session expired, logging in again' % (method.upper(), url))
+            async with self.__login:
+                if self.__tokens is tokens and await self.Login() is None:
+                    raise FatalError('Login failed')
+        return response
+
+    @staticmethod
+    async def __IsThrottled(response):
+        if response.status == 429:
+            return True
+        if response.status == 403 and response.content_type == 'application/json':
+            payload = await response.json()
+            return payload.get('errorCode') in Connection.throttling
+        return False
+
+    @staticmethod
+    async def __Check(response, idempotent=True):
+        """Raise RetryableError for throttling and server errors so ioreliable retries them"""
+        if response.status >= 500 and not idempotent:
+            raise FatalError('HTTP %s %s' % (response.status, response.reason))
+        if response.status == 429 or response.status >= 500:
+            raise RetryableError('HTTP %s %s' % (response.status, response.reason))
+        if response.status == 403 and response.content_type == 'application/json':
+            payload = await response.json()
+            if payload.get('errorCode') in Connection.throttling:
+                raise RetryableError(payload['errorCode'])
 
     async def __aenter__(self):
-        connector = aiohttp.TCPConnector(verify_ssl=False)
+        connector = aiohttp.TCPConnector(ssl=False)
         self.__session = aiohttp.ClientSession(loop=self.__loop, connector=connector,
                                                headers={'X-IG-API-KEY': self.__key})
         self.__connection = await self.__session.__aenter__()
@@ -309,9 +843,84 @@ class IGClient:
         self.__logger.info('Session destroyed')
 
 
+class Confirmations(object):
+    """
+    Fill confirmation for the deals of one batch. Each deal polls /confirms with exponential backoff;
+    deals still unconfirmed fall back to one positions snapshot and then one activities snapshot
+    shared by the batch. A snapshot is reused only by deals sent before it was taken.
+    """
+    Polls = 5
+    Backoff = 0.2
+
+    def __init__(self, client, logger):
+        self.__client = client
+        self.__logger = logger
+        self.__snapshots = {}
+
+    async def Confirm(self, order, dealReference):
+        """Fill or fail order from its deal, returns 'confirm', 'positions', 'activities' or None if not found"""
+        sent = time.monotonic()
+        for poll in range(self.Polls):
+            confirm = await self.__client.GetConfirm(dealReference)
+            if confirm and confirm.get('dealStatus') in ('ACCEPTED', 'REJECTED'):
+                order.FillTime = confirm['date']
+                order.FillPrice = confirm['level']
+                order.FillSize = confirm['size']
+                order.Status = OrderStatus.Filled if confirm['dealStatus'] == 'ACCEPTED' else OrderStatus.Failed
+                order.BrokerReferenceId = confirm['dealId']
+                return 'confirm'
+            if poll < self.Polls - 1:
+                await asyncio.sleep(self.Backoff * 2 ** poll)
+
+        positions = await self.__Snapshot('positions', sent, self.__client.GetPositions)
+        fill = [p['position'] for p in (positions or {}).get('positions', [])
+                if p['position']['dealReference'] == dealReference]
+        if len(fill) == 1:
+            order.FillTime = fill[0]['createdDateUTC']
+            order.FillPrice = fill[0]['level']
+            order.FillSize = fill[0]['size']
+            order.Status = OrderStatus.Filled
+            order.BrokerReferenceId = fill[0]['dealId']
+            return 'positions'
+
+        sd = time.localtime(float(order.TransactionTime))
+        fromDate = '%s-%s-%s' % (sd.tm_year, sd.tm_mon, sd.tm_mday)
+        activities = await self.__Snapshot(('activities', fromDate), sent,
+                                           lambda: self.__client.GetActivities(fromDate, True))
+        fill = [a for a in (activities or {}).get('activities', [])
+                if a['details']['dealReference'] == dealReference]
+        if len(fill) == 1:
+            order.FillTime = fill[0]['date']
+            order.FillPrice = fill[0]['details']['level']
+            order.FillSize = fill[0]['details']['size']
+            order.Status = OrderStatus.Filled if fill[0]['status'] == 'ACCEPTED' else OrderStatus.Failed
+            order.BrokerReferenceId = fill[0]['dealId']
+            return 'activities'
+
+        order.Status = OrderStatus.Failed
+        return None
+
+    async def __Snapshot(self, key, since, fetch):
+        taken, pending = self.__snapshots.get(key, (None, None))
+        if pending is None or taken < since:
+            taken, pending = time.monotonic(), asyncio.ensure_future(fetch())
+            self.__snapshots[key] = (taken, pending)
+        snapshot = await asyncio.shield(pending)
+        self.__logger.info('%s snapshot: %s' % (key, snapshot))
+        return snapshot
+
+
 class Scheduler:
+    """
+    The IG session is reused across invocations through Sessions and is not logged out on exit, and
+    contracts are resolved to epics through Epics.
+    The cached balance is reloaded when it is older than BalanceTtl seconds or an order has filled since.
+    """
+    BalanceTtl = 300
+
     def __init__(self, params, logger, loop=None):
-        self.Timeout = 10
+        self.Timeout = 60
+        self.Deadlines = {Stage.Lookup: 5, Stage.Create: 10, Stage.Confirm: 15, Stage.Persist: 10}
         self.__logger = logger
         self.__params = params
         self.__store = None
@@ -320,166 +929,222 @@ class Scheduler:
         self.__loop = loop if loop is not None else asyncio.get_event_loop()
 
     async def __aenter__(self):
-        self.__store = StoreManager(self.__logger, self.__loop)
+        self.__store = StoreManager(self.__logger, self.__loop, GetDb())
         await self.__store.__aenter__()
-        self.__client = IGClient(self.__params, self.__logger, self.__loop)
+        try:
+            warmed = await self.__loop.run_in_executor(None, Epics.Warm)
+            self.__logger.info('%s epics loaded, %s cached' % (warmed, len(Epics)))
+        except Exception as e:
+            self.__logger.error('Epics: %s' % e)
+        self.__client = IGClient(self.__params, self.__logger, self.__loop, Sessions)
         self.__connection = await self.__client.__aenter__()
-        auth = await self.__connection.Login()
-        self.Balance = Money(auth['accountInfo']['available'], auth['currencyIsoCode'])
-        self.__logger.info('{}'.format(auth))
+        session = await self.__connection.Connect()
+        if session is None:
+            raise Exception('IG login failed')
+        if not session.IsBalanceFresh(self.BalanceTtl):
+            await self.__connection.RefreshBalance()
+        self.Balance = session.Balance
+        self.__logger.info('Account %s, available %s %s' % (session.AccountId, self.Balance.Amount, self.Balance.Ccy))
+        self.__confirmations = Confirmations(self.__connection, self.__logger)
         self.__logger.info('Scheduler created')
         return self
 
     async def __aexit__(self, *args, **kwargs):
-        await self.__connection.Logout()
+        self.__logger.info('Rate limits: %s' % Limits.Metrics())
         await self.__client.__aexit__(*args, **kwargs)
         await self.__store.__aexit__(*args, **kwargs)
         self.__logger.info('Scheduler destroyed')
 
-    async def ValidateOrders(self, orders):
-        keys = [(x['Symbol']['S'], x['Broker']['S']) for x in orders]
-        securities = await self.__store.GetSecurities(keys)
+    async def ValidateOrders(self, images):
+        orders = [Order.FromImage(x) for x in images]
+        securities = await self.__store.GetSecurities([(o.Symbol, o.Broker) for o in orders])
         self.__logger.info('Securities %s' % securities)
-
-        found = [(x['Symbol'], x['Description']['Name'], x['Description']['MarketGroup'],
-                  x['Risk']['RiskFactor'], x['Risk']['MaxPosition']) for x in securities
-                 if x['TradingEnabled'] is True and x['Broker'] == 'IG']
-
-        pending = [(x['OrderId']['S'], x['TransactionTime']['S'], x['Symbol']['S'], x['Order']['M']['Side']['S'],
-                    x['Order']['M']['Size']['N'], x['Order']['M']['OrdType']['S'], x['Maturity']['S'],
-                    None if 'StopDistance' not in x['Order']['M'] else x['Order']['M']['StopDistance']['N'])
-                   for x in orders if x['Broker']['S'] == 'IG']
-
-        valid = [Order(p[0], p[1], p[2], p[3], p[4], p[5], p[6], f[1], f[2], f[3], f[4], p[7])
-                 for f in found for p in pending if f[0] == p[2]]
-
-        invalid = [key for key in keys if key not in map(lambda y: (y[0], 'IG'), found)]
+        return self.Validate(orders, securities)
+
+    @staticmethod
+    def Validate(orders, securities):
+        """Join the IG orders to their tradable securities by Symbol, returns the valid Orders and the unmatched keys"""
+        found = dict((x['Symbol'], x) for x in securities or []
+                     if x['TradingEnabled'] is True and x['Broker'] == 'IG')
+
+        valid = []
+        invalid = []
+        for order in orders:
+            if order.Broker != 'IG' or order.Symbol not in found:
+                invalid.append((order.Symbol, order.Broker))
+                continue
+            f = found[order.Symbol]
+            order.Define(f['Description']['Name'], f['Description']['MarketGroup'], f['Risk']['RiskFactor'],
+                         f['Risk']['MaxPosition'])
+            valid.append(order)
         return valid, invalid
 
     @Connection.reliable
     def GetCurrentPosition(self, order, trades):
-
-        if trades is None or 'positions' not in trades or len(trades['positions']) == 0:
-            self.__logger.info('OrderId: %s. No positions have been found' % order.OrderId)
-            return 0
-
-        found = [p['position'] for p in trades['positions']
-                if p['market']['expiry'] == order.Maturity
-                 and p['market']['instrumentName'] == order.Name and p['market']['instrumentType'] == order.MarketGroup]
-
-        if len(found) == 0:
-            self.__logger.info('OrderId: %s. No open positions have been found' % order.OrderId)
-            return 0
-
-        long = reduce(lambda x, y: x + y,
-                      map(lambda x: x['size'], filter(lambda x: x['direction'] == 'BUY', found)), 0)
-        short = reduce(lambda x, y: x + y,
-                       map(lambda x: x['size'], filter(lambda x: x['direction'] == 'SELL', found)), 0)
-
-        return long - short
+        return RiskEngine(trades, self.Balance, self.__logger).Position(order)
 
     def BalanceCheck(self, order, trades):
-        try:
-            position = self.GetCurrentPosition(order, trades)
-
-            self.__logger.info('OrderId {}, symbol {}, riskFactor {}, risk{}, maxPosition {}, size {}, currentOpnPos {}'
-                    .format(order.OrderId, order.Symbol, order.RiskFactor, order.Size/self.Balance.Amount,
-                            order.MaxPosition, order.Size, position))
-            if order.Size/self.Balance.Amount > order.RiskFactor:
-                return order, False
-            if order.Size > order.MaxPosition:
-                return order, False
-
-            if order.Side == Side.Buy and order.MaxPosition < float(position) + order.Size:
-                return order, False
-            if order.Side == Side.Sell and order.MaxPosition < abs(float(position) - order.Size):
-                return order, False
-            return order, True
-        except Exception as e:
-            self.__logger.error('BalanceCheck Error: %s' % e)
-            return order, False
+        return order, RiskEngine(trades, self.Balance, self.__logger).Check(order)
+
+    def RiskCheck(self, orders, trades):
+        """Orders that pass and fail the pre-trade checks, applied cumulatively in batch order"""
+        return RiskEngine(trades, self.Balance, self.__logger).Run(orders)
 
     def SendEmail(self, text):
-        msg = MIMEMultipart('alternative')
-        msg['Subject'] = 'IG EXECUTOR RESULTS'
-        msg['From'] = self.__params.EAddress
-        msg['To'] = self.__params.EAddress
-        mime_text = MIMEText(text, 'html')
-        msg.attach(mime_text)
-
-        server = smtplib.SMTP(self.__params.ESmtp, 587, timeout=10)
-        # server.set_debuglevel(10)
-        server.starttls()
-        server.ehlo()
-        server.login(self.__params.EUser, self.__params.EPassword)
-        server.sendmail(self.__params.EAddress,  self.__params.EAddress, msg.as_string())
-        res = server.quit()
-        self.__logger.info(res)
+        """Queue the report on the container's notifier, it is mailed off the event loop"""
+        GetNotifier(self.__params, self.__logger).Notify(text)
 
     async def GetPositions(self):
         positions = await self.__client.GetPositions()
         self.__logger.info('GetPositions: %s' % positions)
         return positions
 
+    async def Flush(self):
+        return await self.__store.Flush(self.Deadlines[Stage.Persist])
+
     async def SendOrder(self, order):
+        result = ''
         try:
-            lookup = await self.__client.SearchMarkets(order.Symbol)
-            contract = [o for o in lookup['markets']
-                     if o['instrumentName'] == order.Name and o['instrumentType'] == order.MarketGroup
-                     and o['expiry'] == order.Maturity]
-            self.__logger.info('OrderId: %s. Search for %s, %s returned %s'
-                               % (order.OrderId, order.Symbol, order.Maturity, contract))
-
-            if len(contract) == 1 and 'epic' in contract[0] and 'expiry' in contract[0]:
-                order.Epic = contract[0]['epic']
+            order.Stage = Stage.Lookup
+            epic = await asyncio.wait_for(Epics.Resolve(order.Symbol, order.Name, order.MarketGroup, order.Maturity,
+                                                        self.__client.SearchMarkets), self.Deadlines[Stage.Lookup])
+            self.__logger.info('OrderId: %s. Epic of %s, %s is %s' % (order.OrderId, order.Symbol, order.Maturity, epic))
+
+            if epic is not None:
+                order.Epic = epic
                 order.Ccy = self.Balance.Ccy
-                deal = await self.__client.CreatePosition(order)
+                order.Stage = Stage.Create
+                deal = await asyncio.wait_for(self.__client.CreatePosition(order), self.Deadlines[Stage.Create])
                 self.__logger.info('OrderId: %s. CreatePosition: %s' % (order.OrderId, deal))
                 result = 'Sent %s %s to IG. Received: %s. ' % (order.Symbol, order.Maturity, deal)
+                if deal is None:
+                    # CreatePosition gave up without an answer, the deal may still have been placed
+                    self.__logger.error('OrderId: %s. CreatePosition outcome is unknown' % order.OrderId)
+                    return order.OrderId, result + self.Unfinished(order)
                 if 'errorCode' in deal:
                     return order.OrderId, result
 
-                # confirm by position
-                positions = await self.__client.GetPositions()
-                self.__logger.info('GetPositions: %s' % positions)
-                fill = [p['position'] for p in positions['positions']
-                       if p['position']['dealReference'] == deal['dealReference']]
-                if len(fill) == 1:
-                    order.FillTime = fill[0]['createdDateUTC']
-                    order.FillPrice = fill[0]['level']
-                    order.FillSize = fill[0]['size']
-                    order.Status = OrderStatus.Filled
-                    order.BrokerReferenceId = fill[0]['dealId']
-                    update = self.__store.UpdateStatus(order)
-                    result += update
-                else:
-                    # confirm by activity
-                    time.sleep(1)
-                    sd = time.localtime(float(order.TransactionTime))
-                    activities = await self.__client.GetActivities('%s-%s-%s' % (sd.tm_year, sd.tm_mon, sd.tm_mday), True)
-                    self.__logger.info('GetActivities: %s' % activities)
-                    fill = [a for a in activities['activities']
-                        if a['details']['dealReference'] == deal['dealReference']]
-                    if len(fill) == 1:
-                        order.FillTime = fill[0]['date']
-                        order.FillPrice = fill[0]['details']['level']
-                        order.FillSize = fill[0]['details']['size']
-                        order.Status = OrderStatus.Filled if fill[0]['status'] == 'ACCEPTED' else OrderStatus.Failed
-                        order.BrokerReferenceId = fill[0]['dealId']
-                        update = self.__store.UpdateStatus(order)
-                        result += update
-                    else:
-                        order.Status = OrderStatus.Failed
-                        update = self.__store.UpdateStatus(order)
-                        result += 'Order Failed. %s' % update
+                order.Stage = Stage.Confirm
+                source = await asyncio.wait_for(self.__confirmations.Confirm(order, deal['dealReference']),
+                                                self.Deadlines[Stage.Confirm])
+                self.__logger.info('OrderId: %s. %s, confirmed by %s' % (order.OrderId, order.Status, source))
+                order.Stage = Stage.Persist
+                self.__store.Enqueue(order)
+                if source is None:
+                    result += 'Order Failed. '
             else:
                 result = 'Contract for %s %s could not be found' % (order.Symbol, order.Maturity)
+            if order.Status == OrderStatus.Filled:
+                self.__client.Session.ExpireBalance()
             return order.OrderId, result
 
+        except asyncio.TimeoutError:
+            self.__logger.error('OrderId: %s. %s timed out' % (order.OrderId, order.Stage))
+            return order.OrderId, result + self.Unfinished(order)
         except Exception as e:
             self.__logger.error('SendOrder Error: %s' % e)
             return order.OrderId, 'There was critical exception processing Order: %s' % order.OrderId
 
+    @staticmethod
+    def Unfinished(order):
+        """What is known about an order whose processing stopped in order.Stage"""
+        if order.Stage in (None, Stage.Lookup):
+            return 'Order not sent, stopped at %s.' % (order.Stage or 'start')
+        # the deal may have reached IG, so the order stays PENDING for reconciliation
+        return 'Order stopped at %s, it may have been executed and is left PENDING.' % order.Stage
+
+
+class RiskEngine(object):
+    """
+    Pre-trade checks of a batch against one positions snapshot, indexed once by (expiry, instrumentName,
+    instrumentType). An order that passes is added to the net position of its contract, so later orders
+    in the batch are checked against it.
+    """
+
+    def __init__(self, trades, balance, logger):
+        self.Balance = balance
+        self.__logger = logger
+        self.__positions = {}
+        for p in (trades or {}).get('positions', []):
+            key = (p['market']['expiry'], p['market']['instrumentName'], p['market']['instrumentType'])
+            size = p['position']['size'] if p['position']['direction'] == Side.Buy else -p['position']['size']
+            self.__positions[key] = self.__positions.get(key, 0) + size
+
+    @staticmethod
+    def Key(order):
+        return order.Maturity, order.Name, order.MarketGroup
+
+    def Position(self, order):
+        return self.__positions.get(self.Key(order), 0)
+
+    def Check(self, order):
+        """True if order passes, in which case it is applied to the position"""
+        try:
+            position = self.Position(order)
+            risk = order.Size / self.Balance.Amount
+            self.__logger.info('OrderId %s, symbol %s, riskFactor %s, risk %s, maxPosition %s, size %s, currentOpnPos %s',
+                               order.OrderId, order.Symbol, order.RiskFactor, risk, order.MaxPosition, order.Size,
+                               position)
+            if risk > order.RiskFactor or order.Size > order.MaxPosition:
+                return False
+            after = float(position) + order.Size if order.Side == Side.Buy else float(position) - order.Size
+            if (order.Side == Side.Buy and order.MaxPosition < after) or \
+                    (order.Side == Side.Sell and order.MaxPosition < abs(after)):
+                return False
+            self.__positions[self.Key(order)] = after
+            return True
+        except Exception as e:
+            self.__logger.error('BalanceCheck Error: %s' % e)
+            return False
+
+    def Run(self, orders):
+        passed, failed = [], []
+        for order in orders:
+            (passed if self.Check(order) else failed).append(order)
+        return passed, failed
+
+
+class Dispatcher(object):
+    """
+    Sends a batch through Scheduler.SendOrder with at most Concurrency orders in flight. Orders for the
+    same contract run one after another in arrival order. Whatever is not finished after Timeout seconds
+    is cancelled and reported with the stage it stopped at.
+    """
+
+    def __init__(self, scheduler, logger, concurrency=10, timeout=60):
+        self.Concurrency = concurrency
+        self.Timeout = timeout
+        self.__scheduler = scheduler
+        self.__logger = logger
+
+    async def Run(self, orders):
+        """Returns [(OrderId, result)] for every order in the batch and the OrderIds that did not finish"""
+        semaphore = asyncio.Semaphore(self.Concurrency)
+        results = collections.OrderedDict((o.OrderId, None) for o in orders)
+        contracts = collections.OrderedDict()
+        for order in orders:
+            contracts.setdefault((order.Symbol, order.Name, order.MarketGroup, order.Maturity), []).append(order)
+
+        async def send(contract):
+            for order in contract:
+                async with semaphore:
+                    orderId, result = await self.__scheduler.SendOrder(order)
+                results[orderId] = result
+
+        tasks = [asyncio.ensure_future(send(x)) for x in contracts.values()]
+        if len(tasks) > 0:
+            _, pending = await asyncio.wait(tasks, timeout=self.Timeout)
+            for task in pending:
+                task.cancel()
+            if len(pending) > 0:
+                await asyncio.wait(pending)
+
+        unfinished = [o for o in orders if results[o.OrderId] is None]
+        for order in unfinished:
+            self.__logger.error('OrderId: %s. Cancelled at %s' % (order.OrderId, order.Stage))
+            results[order.OrderId] = 'Cancelled. %s' % self.__scheduler.Unfinished(order)
+        return list(results.items()), [o.OrderId for o in unfinished]
+
 
 async def main(loop, logger, event):
     try:
@@ -492,6 +1157,10 @@ async def main(loop, logger, event):
         params.EUser = os.environ['EMAIL_USER']
         params.EPassword = os.environ['EMAIL_PASSWORD']
         params.ESmtp = os.environ['EMAIL_SMTP']
+        if 'IG_SESSION_TABLE' in os.environ and Sessions.Store is None:
+            Sessions.Store = DynamoSessionStore(GetDb().Table(os.environ['IG_SESSION_TABLE']))
+        if 'IG_EPIC_TABLE' in os.environ and Epics.Store is None:
+            Epics.Store = DynamoEpicStore(GetDb().Table(os.environ['IG_EPIC_TABLE']))
 
         orders = []
         for record in event['Records']:
@@ -515,32 +1184,36 @@ async def main(loop, logger, event):
 
             trades = await scheduler.GetPositions()
 
-            passRisk = [order for order in valid if scheduler.BalanceCheck(order, trades)[1]]
-            failedRisk = [order for order in valid if order not in passRisk]
+            passRisk, failedRisk = scheduler.RiskCheck(valid, trades)
             if len(passRisk) == 0:
                 scheduler.SendEmail('No Security has been accepted by Risk Manager.')
                 return
             logger.info('all passRisk orders %s' % [o.OrderId for o in passRisk])
 
-            futures = [scheduler.SendOrder(o) for o in passRisk]
-            done, _ = await asyncio.wait(futures, timeout=scheduler.Timeout)
-
-            results = []
-            for fut in done:
-                name, payload = fut.result()
-                results.append((name, payload))
+            dispatcher = Dispatcher(scheduler, logger, int(os.environ.get('IG_CONCURRENCY', 10)),
+                                    float(os.environ.get('IG_BATCH_TIMEOUT', scheduler.Timeout)))
+            sent, unfinished = await dispatcher.Run(passRisk)
+            updates = await scheduler.Flush()
+            results = [(name, payload + updates[name][1] if name in updates else payload) for name, payload in sent]
 
             text = '<br>Orders where definition has not been found, not enabled for trading or not IG order %s\n' \
                    % invalid
             text += '<br>Orders where MaxPosition or RiskFactor in Securities table is exceeded %s\n' \
                     % [o.OrderId for o in failedRisk]
             text += '<br>The results of the trades sent to the IG REST API %s\n' % results
+            text += '<br>Orders cancelled before they finished %s\n' % unfinished
+            text += '<br>Orders whose status could not be saved %s\n' \
+                    % [orderId for orderId, (saved, _) in updates.items() if not saved]
             scheduler.SendEmail(text)
 
     except Exception as e:
         logger.error(e)
 
 
+FlushTimeout = 5
+DigestWindow = 60
+
+
 def lambda_handler(event, context):
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
@@ -558,6 +1231,12 @@ def lambda_handler(event, context):
     app_loop = asyncio.get_event_loop()
     app_loop.run_until_complete(main(app_loop, logger, event))
 
+    # reports wait DigestWindow seconds for the following invocations and go out from the notifier's thread;
+    # a digest past its window was frozen with the container and is sent now, before it can be frozen again
+    if Notifications is not None and Notifications.Overdue and not Notifications.Flush(FlushTimeout):
+        logger.error('Execution report still queued after %ss' % FlushTimeout)
+
+    Connection.EmitMetrics('IGExecutor')
     return json.dumps({'State': 'OK'})
 
 
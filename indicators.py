@@ -0,0 +1,72 @@
+import collections
+import math
+try:
+    import numpy as np
+except ImportError:  # only the batch mode needs numpy
+    np = None
+
+
+class Momersion(object):
+    """
+    Streaming port of momersion() in R/momersion/Momersion.R:
+
+        momentum <- sign(R * lag(R, returnLag)); momentum[momentum < 0] <- 0
+        momersion <- runSum(momentum, n = n)/n * 100
+
+    The last n momentum flags sit in a ring buffer next to their running sum, so each
+    return costs O(1). A missing return (None/NaN) is kept in its place: the flags that pair it
+    are missing, as NA propagates through R's product, and the momersion is None until the window
+    holds n valid flags again. momersion() applies the same rule.
+    """
+
+    def __init__(self, n, returnLag=1):
+        if n < 1 or returnLag < 1:
+            raise Exception('Momersion needs n >= 1 and returnLag >= 1')
+        self.N = n
+        self.ReturnLag = returnLag
+        self.Value = None
+        self.__returns = collections.deque(maxlen=returnLag)
+        self.__flags = [0] * n
+        self.__missing = [0] * n
+        self.__next = 0
+        self.__count = 0
+        self.__sum = 0
+        self.__gaps = 0
+
+    def Update(self, ret):
+        """Add the next return, returns the momersion or None while the window is filling or has a gap"""
+        if ret is None or math.isnan(ret):
+            ret = None
+        if len(self.__returns) == self.ReturnLag:
+            previous = self.__returns[0]
+            missing = 1 if ret is None or previous is None else 0
+            flag = 1 if not missing and ret * previous > 0 else 0
+            self.__sum += flag - self.__flags[self.__next]
+            self.__gaps += missing - self.__missing[self.__next]
+            self.__flags[self.__next] = flag
+            self.__missing[self.__next] = missing
+            self.__next = (self.__next + 1) % self.N
+            self.__count = min(self.__count + 1, self.N)
+            self.Value = self.__sum * 100.0 / self.N if self.__count == self.N and self.__gaps == 0 else None
+        self.__returns.append(ret)
+        return self.Value
+
+
+def momersion(returns, n, returnLag=1):
+    """Batch momersion over a history of returns, NaN where the window is not yet full or has a gap"""
+    if np is None:
+        raise Exception('numpy is required for the batch momersion')
+    returns = np.asarray(returns, dtype=float)
+    result = np.full(len(returns), np.nan)
+    if len(returns) <= returnLag:
+        return result
+    product = returns[returnLag:] * returns[:-returnLag]
+    missing = np.isnan(product)
+    flags = np.concatenate(([0], np.cumsum(np.where(missing, 0, product > 0))))
+    gaps = np.concatenate(([0], np.cumsum(missing)))
+    if len(product) < n:
+        return result
+    total = flags[n:] - flags[:-n]
+    full = (gaps[n:] - gaps[:-n]) == 0
+    result[returnLag + n - 1:] = np.where(full, total * 100.0 / n, np.nan)
+    return result
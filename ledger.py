@@ -0,0 +1,117 @@
+import decimal
+from botocore.exceptions import ClientError
+from boto3.dynamodb.conditions import Attr, Key
+from boto3.dynamodb.types import TypeSerializer
+
+
+class PositionLedger(object):
+    """
+    Net position per symbol, maturity and broker, materialized in the Positions table
+    (hash Symbol, range Contract = 'maturity#broker'). Fills are applied with atomic ADD
+    updates, so reading a position is a single GetItem. RecordWith applies a fill in one
+    transaction with the order update that records it. Reconcile rebuilds the ledger
+    from the Orders table.
+    """
+    Filled = ['FILLED', 'PART_FILLED']
+
+    def __init__(self, table):
+        self.__Positions = table
+
+    @staticmethod
+    def Key(symbol, maturity, broker):
+        return {'Symbol': symbol, 'Contract': '%s#%s' % (maturity, broker)}
+
+    @staticmethod
+    def Signed(side, size):
+        size = decimal.Decimal(str(size))
+        return size if side == 'BUY' else -size
+
+    def Record(self, symbol, maturity, broker, side, size):
+        """Apply a fill and return the new net position"""
+        response = self.__Positions.update_item(
+            Key=self.Key(symbol, maturity, broker),
+            UpdateExpression="add NetPosition :q set Maturity = :m, Broker = :b",
+            ExpressionAttributeValues={
+                ':q': self.Signed(side, size),
+                ':m': maturity,
+                ':b': broker
+            },
+            ReturnValues="UPDATED_NEW")
+        return response['Attributes']['NetPosition']
+
+    def RecordWith(self, update, symbol, maturity, broker, side, size):
+        """
+        Apply a fill in one transaction with update, the update_item arguments of another table plus its
+        TableName. Neither is written if the condition of update fails. A transaction returns no values,
+        so this returns the signed change applied to the position; Get reads the new net position.
+        """
+        change = self.Signed(side, size)
+        fill = {
+            'TableName': self.__Positions.name,
+            'Key': self.Key(symbol, maturity, broker),
+            'UpdateExpression': "add NetPosition :q set Maturity = :m, Broker = :b",
+            'ExpressionAttributeValues': {':q': change, ':m': maturity, ':b': broker}
+        }
+        self.__Positions.meta.client.transact_write_items(
+            TransactItems=[{'Update': self.Typed(update)}, {'Update': self.Typed(fill)}])
+        return change
+
+    @staticmethod
+    def Typed(update):
+        """update_item arguments in the typed form of the low-level client"""
+        serializer = TypeSerializer()
+        typed = dict(update)
+        for name in ('Key', 'ExpressionAttributeValues'):
+            if name in update:
+                typed[name] = dict((k, serializer.serialize(v)) for k, v in update[name].items())
+        return typed
+
+    def Get(self, symbol, maturity, broker):
+        response = self.__Positions.get_item(Key=self.Key(symbol, maturity, broker), ConsistentRead=True)
+        if 'Item' not in response:
+            return 0
+        return response['Item']['NetPosition']
+
+    def Reconcile(self, orders, symbol, broker):
+        """
+        Recompute every maturity of symbol/broker from the filled orders and overwrite the ledger;
+        maturities without fills are removed from it. The scan is not a snapshot and the overwrite is not
+        conditional, so a fill landing meanwhile can be lost: run it only while no orders are executing.
+        A removal is skipped if the maturity changed since it was read.
+        """
+        query = {
+            'FilterExpression': Attr('Symbol').eq(symbol) & Attr('Broker').eq(broker) & Attr('Status').is_in(self.Filled),
+            'ProjectionExpression': 'Maturity, Trade'
+        }
+        positions = {}
+        while True:
+            response = orders.scan(**query)
+            for order in response.get('Items', []):
+                trade = order['Trade']
+                positions[order['Maturity']] = positions.get(order['Maturity'], 0) + \
+                    self.Signed(trade['Side'], trade['FilledSize'])
+            if 'LastEvaluatedKey' not in response:
+                break
+            query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+        for maturity, net in positions.items():
+            item = self.Key(symbol, maturity, broker)
+            item.update({'NetPosition': net, 'Maturity': maturity, 'Broker': broker})
+            self.__Positions.put_item(Item=item)
+
+        query = {'KeyConditionExpression': Key('Symbol').eq(symbol)}
+        while True:
+            response = self.__Positions.query(**query)
+            for item in response.get('Items', []):
+                maturity, _, itemBroker = item['Contract'].partition('#')
+                if itemBroker == broker and maturity not in positions:
+                    try:
+                        self.__Positions.delete_item(Key=self.Key(symbol, maturity, broker),
+                                                     ConditionExpression=Attr('NetPosition').eq(item['NetPosition']))
+                    except ClientError as e:
+                        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                            raise
+            if 'LastEvaluatedKey' not in response:
+                break
+            query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        return positions
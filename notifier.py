@@ -0,0 +1,146 @@
+import time
+import queue
+import collections
+import smtplib
+import threading
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+
+class Notifier(object):
+    """
+    Execution reports mailed from one worker thread over a reused SMTP connection, so the event loop
+    only queues them. Reports queued while a message is being sent, or within Window seconds of the
+    first one, go out as one digest; the queue lives as long as the process, so in a warm Lambda
+    container it spans invocations. Overdue is True once the oldest queued report has waited longer
+    than Window, e.g. because the process was frozen; Flush then sends the queue straight away and
+    waits until the server has taken it.
+    """
+    Window = 0
+    __flush = object()
+
+    def __init__(self, host, port, user, password, sender, recipients, logger, subject='IG EXECUTOR RESULTS',
+                 starttls=True, timeout=10, window=None):
+        self.Host = host
+        self.Port = port
+        self.User = user
+        self.Password = password
+        self.Sender = sender
+        self.Recipients = recipients
+        self.Subject = subject
+        self.StartTls = starttls
+        self.Timeout = timeout
+        if window is not None:
+            self.Window = window
+        self.Sent = 0
+        self.Failed = 0
+        self.__logger = logger
+        self.__queue = queue.Queue()
+        self.__pending = 0
+        # when each queued report was queued, oldest first
+        self.__queued = collections.deque()
+        self.__done = threading.Condition()
+        self.__smtp = None
+        self.__thread = None
+
+    def Notify(self, text):
+        """Queue a report, returns at once"""
+        with self.__done:
+            self.__pending += 1
+            self.__queued.append(time.monotonic())
+            if self.__thread is None or not self.__thread.is_alive():
+                self.__thread = threading.Thread(target=self.__Run, name='Notifier', daemon=True)
+                self.__thread.start()
+        self.__queue.put((time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime()), text))
+
+    @property
+    def Pending(self):
+        """Reports queued and not yet handed to the server"""
+        with self.__done:
+            return self.__pending
+
+    @property
+    def Overdue(self):
+        """True if the oldest queued report has waited longer than Window"""
+        with self.__done:
+            return len(self.__queued) > 0 and time.monotonic() - self.__queued[0] > self.Window
+
+    def Flush(self, timeout=None):
+        """Send the queued reports now, True if all were handed to the server (or failed) within timeout"""
+        with self.__done:
+            if self.__pending == 0:
+                return True
+        self.__queue.put(self.__flush)
+        with self.__done:
+            return self.__done.wait_for(lambda: self.__pending == 0, timeout)
+
+    def Close(self):
+        if self.__smtp is not None:
+            try:
+                self.__smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.__smtp = None
+
+    def __Run(self):
+        while True:
+            item = self.__queue.get()
+            reports = [] if item is self.__flush else [item]
+            end = time.monotonic() + self.Window
+            while item is not self.__flush:
+                # past the window, only what is already queued joins the digest
+                remaining = end - time.monotonic()
+                try:
+                    item = self.__queue.get(timeout=remaining) if remaining > 0 else self.__queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not self.__flush:
+                    reports.append(item)
+            if len(reports) > 0:
+                self.__Deliver(reports)
+            with self.__done:
+                self.__pending -= len(reports)
+                for _ in reports:
+                    self.__queued.popleft()
+                self.__done.notify_all()
+
+    def __Message(self, reports):
+        msg = MIMEMultipart('alternative')
+        msg['Subject'] = self.Subject if len(reports) == 1 else '%s (%s reports)' % (self.Subject, len(reports))
+        msg['From'] = self.Sender
+        msg['To'] = ', '.join(self.Recipients)
+        body = '<hr>'.join('<p>%s UTC</p>%s' % (sent, text) for sent, text in reports)
+        msg.attach(MIMEText(body, 'html'))
+        return msg.as_string()
+
+    def __Connection(self):
+        if self.__smtp is not None:
+            try:
+                if self.__smtp.noop()[0] == 250:
+                    return self.__smtp
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.Close()
+        smtp = smtplib.SMTP(self.Host, self.Port, timeout=self.Timeout)
+        if self.StartTls:
+            smtp.starttls()
+            smtp.ehlo()
+        if self.User:
+            smtp.login(self.User, self.Password)
+        self.__smtp = smtp
+        self.__logger.info('Notifier connected to %s:%s' % (self.Host, self.Port))
+        return smtp
+
+    def __Deliver(self, reports):
+        message = self.__Message(reports)
+        for attempt in range(2):
+            try:
+                self.__Connection().sendmail(self.Sender, self.Recipients, message)
+                self.Sent += 1
+                self.__logger.info('Notifier sent %s reports' % len(reports))
+                return
+            except (smtplib.SMTPException, OSError) as e:
+                self.__logger.error('Notifier: %s' % e)
+                self.Close()
+        self.Failed += len(reports)
+        self.__logger.error('Notifier could not send: %s' % [text for _, text in reports])
@@ -0,0 +1,160 @@
+import decimal
+
+
+def plain(attribute):
+    """One typed attribute ({'N': '1.5'}, {'M': {...}}, ...) as a Python value, numbers as Decimal like boto3"""
+    (kind, value), = attribute.items()
+    if kind == 'S' or kind == 'BOOL':
+        return value
+    if kind == 'N':
+        return decimal.Decimal(value)
+    if kind == 'M':
+        return dict((k, plain(v)) for k, v in value.items())
+    if kind == 'L':
+        return [plain(v) for v in value]
+    if kind == 'NULL':
+        return None
+    if kind == 'SS':
+        return set(value)
+    if kind == 'NS':
+        return set(decimal.Decimal(v) for v in value)
+    return value
+
+
+def _number(attribute):
+    return None if attribute is None else decimal.Decimal(attribute['N'])
+
+
+def _string(attribute):
+    return None if attribute is None else attribute['S']
+
+
+class Record(object):
+    """
+    Base of the stream records: fixed __slots__, numbers decoded once to Decimal, missing
+    attributes None. Records compare by value.
+    """
+    __slots__ = ()
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(getattr(self, x, None) == getattr(other, x, None)
+                                                 for x in self.Fields())
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__,
+                           ', '.join('%s=%r' % (x, getattr(self, x, None)) for x in self.Fields()))
+
+    @classmethod
+    def Fields(cls):
+        return [x for c in reversed(cls.__mro__) for x in getattr(c, '__slots__', ())]
+
+
+class Quote(Record):
+    """
+    An EOD quote of the Quotes.EOD table. Only Close, the price the strategies read, is decoded up front;
+    Open, High, Low, Volume and Count stay in the details map they came in and are decoded when read.
+    """
+    __slots__ = ('Symbol', 'Date', 'Close', 'Source', '_Details')
+    Details = ('Open', 'High', 'Low', 'Volume', 'Count')
+
+    def __init__(self, symbol, date=None, close=0.0, open=None, high=None, low=None, volume=None, count=None,
+                 source=None):
+        self.Symbol = symbol
+        self.Date = date
+        self.Close = close
+        self.Source = source
+        self._Details = dict((k, v) for k, v in zip(self.Details, (open, high, low, volume, count)) if v is not None)
+
+    def Detail(self, name):
+        """One of the Details, decoded from the stream map on every read, None if absent"""
+        value = self._Details.get(name)
+        return _number(value) if isinstance(value, dict) else value
+
+    Open = property(lambda self: self.Detail('Open'))
+    High = property(lambda self: self.Detail('High'))
+    Low = property(lambda self: self.Detail('Low'))
+    Volume = property(lambda self: self.Detail('Volume'))
+    Count = property(lambda self: self.Detail('Count'))
+
+    @classmethod
+    def Fields(cls):
+        return ['Symbol', 'Date', 'Open', 'High', 'Low', 'Close', 'Volume', 'Count', 'Source']
+
+    @classmethod
+    def FromImage(cls, image):
+        """From a stream NewImage (or Keys, which leave the prices None); the details map is kept, not copied"""
+        details = image['Details']['M'] if 'Details' in image else {}
+        record = cls.__new__(cls)
+        record.Symbol = image['Symbol']['S']
+        record.Date = image['Date']['S']
+        record.Close = _number(details.get('Close'))
+        record.Source = image['Source']['S'] if 'Source' in image else None
+        record._Details = details
+        return record
+
+    @classmethod
+    def FromItem(cls, item):
+        """From a table item as returned by the boto3 resource"""
+        details = item.get('Details', {})
+        record = cls.__new__(cls)
+        record.Symbol = item['Symbol']
+        record.Date = item['Date']
+        record.Close = details.get('Close')
+        record.Source = item.get('Source')
+        record._Details = details
+        return record
+
+
+class Trade(Record):
+    """The fill of an order, the Trade map the executors write to the Orders table"""
+    __slots__ = ('FillTime', 'Side', 'FilledSize', 'Price', 'Broker', 'RefType', 'Ref', 'StopDistance')
+
+    @classmethod
+    def FromImage(cls, trade):
+        """From the M value of a Trade attribute, None if the order has no fill yet"""
+        if len(trade) == 0:
+            return None
+        record = cls.__new__(cls)
+        record.FillTime = _string(trade.get('FillTime'))
+        record.Side = _string(trade.get('Side'))
+        record.FilledSize = _number(trade.get('FilledSize'))
+        record.Price = _number(trade.get('Price'))
+        broker = trade['Broker']['M'] if 'Broker' in trade else {}
+        record.Broker = _string(broker.get('Name'))
+        record.RefType = _string(broker.get('RefType'))
+        record.Ref = _string(broker.get('Ref'))
+        record.StopDistance = _number(trade['StopDistance']) if 'N' in trade.get('StopDistance', {}) else None
+        return record
+
+
+class Order(Record):
+    """An order of the Orders table"""
+    __slots__ = ('OrderId', 'TransactionTime', 'Symbol', 'Broker', 'Maturity', 'Status', 'ProductType', 'Side',
+                 'Size', 'OrdType', 'StopDistance', 'Strategy', 'Reason', 'Trade')
+
+    def Decode(self, image):
+        """Fill the slots from a stream NewImage in one pass"""
+        order = image['Order']['M'] if 'Order' in image else {}
+        strategy = image['Strategy']['M'] if 'Strategy' in image else {}
+        self.OrderId = image['OrderId']['S']
+        self.TransactionTime = image['TransactionTime']['S']
+        self.Symbol = _string(image.get('Symbol'))
+        self.Broker = _string(image.get('Broker'))
+        self.Maturity = _string(image.get('Maturity'))
+        self.Status = _string(image.get('Status'))
+        self.ProductType = _string(image.get('ProductType'))
+        self.Side = _string(order.get('Side'))
+        self.Size = _number(order.get('Size'))
+        self.OrdType = _string(order.get('OrdType'))
+        self.StopDistance = _number(order.get('StopDistance'))
+        self.Strategy = _string(strategy.get('Name'))
+        self.Reason = _string(strategy.get('Reason'))
+        self.Trade = Trade.FromImage(image['Trade']['M']) if 'Trade' in image else None
+        return self
+
+    @classmethod
+    def FromImage(cls, image):
+        return cls.__new__(cls).Decode(image)
@@ -0,0 +1,105 @@
+import collections
+import numpy as np
+
+
+class OnlineLeastSquares(object):
+    """
+    Least squares fitted from running sufficient statistics (X'X and X'y), so each new
+    observation costs O(k^2) regardless of how many came before.
+
+    window:     keep only the last `window` observations, downdating the oldest one
+    forgetting: exponential forgetting factor in (0, 1]; 1 weights all observations equally
+    """
+
+    def __init__(self, k, window=None, forgetting=1.0):
+        if window is not None and window < k:
+            raise Exception('Window %s is too short for %s coefficients' % (window, k))
+        if not 0 < forgetting <= 1:
+            raise Exception('Forgetting factor %s is not in (0, 1]' % forgetting)
+        self.K = k
+        self.Window = window
+        self.Forgetting = forgetting
+        self.Count = 0
+        self.__xx = np.zeros((k, k))
+        self.__xy = np.zeros(k)
+        self.__history = collections.deque()
+
+    def Update(self, x, y):
+        x = np.asarray(x, dtype=float)
+        self.__xx *= self.Forgetting
+        self.__xy *= self.Forgetting
+        self.__xx += np.outer(x, x)
+        self.__xy += x * y
+        self.Count += 1
+        if self.Window is not None:
+            self.__history.append((x, y))
+            if len(self.__history) > self.Window:
+                old, oldY = self.__history.popleft()
+                weight = self.Forgetting ** self.Window
+                self.__xx -= weight * np.outer(old, old)
+                self.__xy -= weight * old * oldY
+                self.Count -= 1
+
+    def Coefficients(self):
+        """Current coefficients, None until the system is identified"""
+        if self.Count < self.K:
+            return None
+        try:
+            return np.linalg.solve(self.__xx, self.__xy)
+        except np.linalg.LinAlgError:
+            return None
+
+
+def expanding_coefficients(x, y):
+    """
+    Coefficients of the expanding-window fit ending at every row of x (n x k), computed
+    from cumulative sufficient statistics in one pass. Rows before the fit is identified are NaN.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n, k = x.shape
+    xx = np.cumsum(x[:, :, None] * x[:, None, :], axis=0)
+    xy = np.cumsum(x * y[:, None], axis=0)
+    coefficients = np.full((n, k), np.nan)
+    if n < k:
+        return coefficients
+    try:
+        coefficients[k - 1:] = np.linalg.solve(xx[k - 1:], xy[k - 1:, :, None])[:, :, 0]
+    except np.linalg.LinAlgError:
+        coefficients[k - 1:] = np.matmul(np.linalg.pinv(xx[k - 1:]), xy[k - 1:, :, None])[:, :, 0]
+    return coefficients
+
+
+class HedgeRatioModel(object):
+    """
+    The SPX hedge of R/vix/vix_trader_backtest.R: lm(vix ~ spx + I(VIX_TTS*spx)) on daily returns,
+    turned into SPX points per VIX future point as (b1*100 + b2*TTS*100)/(0.01*SP_CLOSE).
+    """
+
+    def __init__(self, window=None, forgetting=1.0):
+        self.Fit = OnlineLeastSquares(3, window, forgetting)
+
+    @staticmethod
+    def Features(spx, tts):
+        return np.stack((np.ones_like(spx), spx, tts * spx), axis=-1)
+
+    @staticmethod
+    def Ratio(b1, b2, tts, spClose):
+        return (b1 * 100 + b2 * tts * 100) / (0.01 * spClose)
+
+    def Update(self, spx, vix, tts):
+        self.Fit.Update((1.0, spx, tts * spx), vix)
+
+    def HedgeRatio(self, tts, spClose):
+        coefficients = self.Fit.Coefficients()
+        if coefficients is None:
+            return None
+        return self.Ratio(coefficients[1], coefficients[2], tts, spClose)
+
+    @classmethod
+    def Expanding(cls, spx, vix, tts, spClose):
+        """Expanding-window hedge ratio for every row, in linear time"""
+        spx = np.asarray(spx, dtype=float)
+        tts = np.asarray(tts, dtype=float)
+        b = expanding_coefficients(cls.Features(spx, tts), vix)
+        return cls.Ratio(b[:, 1], b[:, 2], tts, np.asarray(spClose, dtype=float))
@@ -0,0 +1,174 @@
+import os
+import decimal
+from botocore.exceptions import ClientError
+
+
+class RollSignal(object):
+    def __init__(self, date, contract, future, spot, daysLeft, roll):
+        self.Date = date
+        self.Contract = contract
+        self.Future = future
+        self.Spot = spot
+        self.DaysLeft = daysLeft
+        self.Roll = roll
+
+    @property
+    def Key(self):
+        return self.Date, self.Contract
+
+    def Line(self):
+        """The ROLL_FILE csv line: date,contract,future,spot,days_left,roll"""
+        return '%s,%s,%s,%s,%s,%s\n' % (self.Date, self.Contract, self.Future, self.Spot, self.DaysLeft, self.Roll)
+
+    @classmethod
+    def FromLine(cls, line):
+        date, contract, future, spot, daysLeft, roll = line.strip().split(',')
+        return cls(date, contract, future, spot, daysLeft, roll)
+
+
+class DynamoRollHistory(object):
+    """Roll signals keyed by (Date, Contract) with a conditional put, so the first run of a day wins"""
+
+    def __init__(self, table):
+        self.__Rolls = table
+
+    def Add(self, signal):
+        try:
+            self.__Rolls.put_item(
+                Item={
+                    'Date': signal.Date,
+                    'Contract': signal.Contract,
+                    'Future': decimal.Decimal(str(signal.Future)),
+                    'Spot': decimal.Decimal(str(signal.Spot)),
+                    'DaysLeft': int(signal.DaysLeft),
+                    'Roll': decimal.Decimal(str(signal.Roll))
+                },
+                ConditionExpression='attribute_not_exists(#d)',
+                ExpressionAttributeNames={'#d': 'Date'})
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise
+
+    def Contains(self, date, contract):
+        return 'Item' in self.__Rolls.get_item(Key={'Date': date, 'Contract': contract}, ConsistentRead=True)
+
+    def Export(self):
+        signals = []
+        query = {}
+        while True:
+            response = self.__Rolls.scan(**query)
+            signals.extend(RollSignal(x['Date'], x['Contract'], x['Future'], x['Spot'], x['DaysLeft'], x['Roll'])
+                           for x in response.get('Items', []))
+            if 'LastEvaluatedKey' not in response:
+                break
+            query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        return sorted(signals, key=lambda x: x.Key)
+
+
+class S3RollHistory(object):
+    """One S3 object per day and contract under prefix, written only if it does not exist yet"""
+
+    def __init__(self, bucket, prefix):
+        self.__bucket = bucket
+        self.__prefix = prefix
+
+    def ObjectKey(self, signal):
+        return '%s/%s/%s.csv' % (self.__prefix, signal.Date, signal.Contract)
+
+    def Contains(self, date, contract):
+        try:
+            self.__bucket.Object(self.ObjectKey(RollSignal(date, contract, None, None, None, None))).load()
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def Add(self, signal):
+        try:
+            self.__bucket.put_object(Key=self.ObjectKey(signal), Body=signal.Line().encode('utf-8'), IfNoneMatch='*')
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                return False
+            raise
+
+    def Export(self):
+        signals = [RollSignal.FromLine(o.get()['Body'].read().decode('utf-8'))
+                   for o in self.__bucket.objects.filter(Prefix='%s/' % self.__prefix)]
+        return sorted(signals, key=lambda x: x.Key)
+
+
+class LegacyRollFile(object):
+    """
+    The single ROLL_FILE object the strategy appended to before the per-day histories, read once.
+    Nothing writes it any more.
+    """
+
+    def __init__(self, bucket, key):
+        self.__bucket = bucket
+        self.__key = key
+        self.__signals = None
+
+    def Export(self):
+        if self.__signals is None:
+            try:
+                lines = self.__bucket.Object(self.__key).get()['Body'].read().decode('utf-8').splitlines()
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+                    raise
+                lines = []
+            self.__signals = dict((x.Key, x) for x in (RollSignal.FromLine(l) for l in lines if l.strip()))
+        return sorted(self.__signals.values(), key=lambda x: x.Key)
+
+    def Contains(self, date, contract):
+        self.Export()
+        return (date, contract) in self.__signals
+
+
+class FallbackRollHistory(object):
+    """A history read through to the legacy ROLL_FILE, so a day evaluated before the move is not rolled again"""
+
+    def __init__(self, history, legacy):
+        self.__history = history
+        self.__legacy = legacy
+
+    def Add(self, signal):
+        if self.__legacy.Contains(signal.Date, signal.Contract):
+            return False
+        return self.__history.Add(signal)
+
+    def Contains(self, date, contract):
+        return self.__legacy.Contains(date, contract) or self.__history.Contains(date, contract)
+
+    def Export(self):
+        signals = dict((x.Key, x) for x in self.__legacy.Export())
+        signals.update((x.Key, x) for x in self.__history.Export())
+        return sorted(signals.values(), key=lambda x: x.Key)
+
+
+class FileRollHistory(object):
+    """Local file backend in the ROLL_FILE format, for tests and offline runs"""
+
+    def __init__(self, path):
+        self.__path = path
+        self.__keys = set(x.Key for x in self.Export())
+
+    def Add(self, signal):
+        if signal.Key in self.__keys:
+            return False
+        with open(self.__path, 'a') as f:
+            f.write(signal.Line())
+        self.__keys.add(signal.Key)
+        return True
+
+    def Contains(self, date, contract):
+        return (date, contract) in self.__keys
+
+    def Export(self):
+        if not os.path.exists(self.__path):
+            return []
+        with open(self.__path, 'r') as f:
+            return sorted((RollSignal.FromLine(x) for x in f if x.strip()), key=lambda x: x.Key)
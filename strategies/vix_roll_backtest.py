@@ -0,0 +1,154 @@
+import os
+import sys
+import logging
+import numpy as np
+
+if __package__ in (None, ''):
+    # run as a script: the shared modules live in the repository root
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from regression import HedgeRatioModel
+
+HISTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'R', 'vix',
+                       'vix_sp500_front_futures.csv')
+
+
+class Action:
+    Open = -1   # sell the front future
+    Close = 1   # buy it back
+
+
+class VixRollBacktest(object):
+    """
+    Vectorized port of R/vix/vix_trader_backtest.R.
+
+    The roll is (future - spot)/days_left as in VixTrader.Run. A short is opened when the roll is
+    above MaxRoll with more than EntryDays left and closed when the roll drops below ExitRoll or
+    fewer than ExitDays are left. The defaults are the R script's rules; the commented-out live
+    variant (close one day before expiry, no roll exit) is ExitRoll=None, ExitDays=2, EntryDays=None.
+    """
+
+    def __init__(self, logger, path=HISTORY, start='2009-01-01', maxRoll=0.10, exitRoll=0.05,
+                 entryDays=10, exitDays=9):
+        self.Logger = logger
+        self.Start = np.datetime64(start, 'D')
+        self.MaxRoll = maxRoll
+        self.ExitRoll = exitRoll
+        self.EntryDays = entryDays
+        self.ExitDays = exitDays
+        self.Returns = self.Load(path)
+
+    @staticmethod
+    def Load(path):
+        """The R script's returns frame: every row but the first, with VIX future and SPX daily returns"""
+        raw = np.genfromtxt(path, delimiter=',', names=True, dtype=None, encoding='utf-8')
+        vix = raw['VIX_CLOSE'].astype(float)
+        spx = raw['SP_CLOSE'].astype(float)
+        return {
+            'DATE': raw['DATE'][1:].astype('datetime64[D]'),
+            'VIX_FUT': raw['VIX_NAME'][1:],
+            'VIX_TTS': raw['VIX_DAYS_LEFT'][1:].astype(float),
+            'SP_CLOSE': spx[1:],
+            'VIX_CLOSE': vix[1:],
+            'VIX_SPOT_CLOSE': raw['VIX_SPOT_CLOSE'][1:].astype(float),
+            'spx': np.diff(spx) / spx[:-1],
+            'vix': np.diff(vix) / vix[:-1]
+        }
+
+    def Roll(self):
+        r = self.Returns
+        return (r['VIX_CLOSE'] - r['VIX_SPOT_CLOSE']) / r['VIX_TTS']
+
+    def Signals(self):
+        """Row indices and actions of all trades, in the order the R loop would emit them"""
+        r = self.Returns
+        roll = self.Roll()
+        tts = r['VIX_TTS']
+        test = r['DATE'] >= self.Start
+
+        entry = test & (roll > self.MaxRoll)
+        if self.EntryDays is not None:
+            entry &= tts > self.EntryDays
+        exit = np.zeros(len(roll), dtype=bool)
+        if self.ExitRoll is not None:
+            exit |= roll < self.ExitRoll
+        if self.ExitDays is not None:
+            exit |= tts < self.ExitDays
+        exit &= test
+
+        # position state is the last entry/exit event carried forward
+        event = np.where(entry, 1, np.where(exit, 0, -1))
+        last = np.maximum.accumulate(np.where(event >= 0, np.arange(len(event)), -1))
+        state = np.where(last >= 0, event[np.maximum(last, 0)], 0)
+        prev = np.concatenate(([0], state[:-1]))
+
+        # the R loop checks the exit before the entry, so a row meeting both closes and reopens
+        both = entry & exit
+        closes = np.nonzero((prev == 1) & ((state == 0) | both))[0]
+        opens = np.nonzero((state == 1) & ((prev == 0) | both))[0]
+
+        rows = np.concatenate((closes, opens))
+        actions = np.concatenate((np.full(len(closes), Action.Close), np.full(len(opens), Action.Open)))
+        order = np.lexsort((-actions, rows))
+        return rows[order], actions[order]
+
+    def HedgeRatios(self):
+        """lm(vix ~ spx + I(VIX_TTS*spx)) refitted on the expanding window at every row, in linear time"""
+        r = self.Returns
+        return HedgeRatioModel.Expanding(r['spx'], r['vix'], r['VIX_TTS'], r['SP_CLOSE'])
+
+    def Run(self):
+        """Trade list with the unhedged and hedged PnL columns of the R results frame"""
+        r = self.Returns
+        rows, actions = self.Signals()
+        price = r['VIX_CLOSE'][rows]
+        sp = r['SP_CLOSE'][rows]
+        hr = np.round(self.HedgeRatios()[rows], 2)
+
+        ret = -np.round(np.diff(price, prepend=price[:1]), 2)
+        hedge = -np.round(np.diff(sp, prepend=sp[:1]), 2)
+        unhedged = np.round(np.cumsum(-100 * actions * price), 2)
+
+        opened = actions == Action.Open
+        ret[opened] = 0
+        hedge[opened] = np.nan
+        unhedged[opened] = np.nan
+
+        # every close is hedged with the ratio recorded when the position was opened
+        lastOpen = np.maximum.accumulate(np.where(opened, np.arange(len(rows)), -1))
+        ratio = np.where(lastOpen >= 0, np.abs(hr[np.maximum(lastOpen, 0)]), 0)
+        hedgedReturn = np.where(opened, 0, np.round(ret + np.nan_to_num(hedge) * ratio, 2))
+        total = hedgedReturn + ret * 100
+
+        results = np.zeros(len(rows), dtype=[('DATE', 'datetime64[D]'), ('ACTION', 'i8'), ('VIX_FUT', 'U16'),
+                                             ('VIX_FUT_PRICE', 'f8'), ('SP_PRICE', 'f8'), ('HR', 'f8'),
+                                             ('return', 'f8'), ('hedge', 'f8'), ('unhedgedPnL', 'f8'),
+                                             ('hedgedReturn', 'f8'), ('totalReturn', 'f8'), ('hedgedPnL', 'f8')])
+        results['DATE'] = r['DATE'][rows]
+        results['ACTION'] = actions
+        results['VIX_FUT'] = r['VIX_FUT'][rows]
+        results['VIX_FUT_PRICE'] = price
+        results['SP_PRICE'] = sp
+        results['HR'] = hr
+        results['return'] = ret
+        results['hedge'] = hedge
+        results['unhedgedPnL'] = unhedged
+        results['hedgedReturn'] = hedgedReturn
+        results['totalReturn'] = total
+        results['hedgedPnL'] = np.cumsum(total)
+        self.Logger.info('%s trades, hedged PnL %s' % (len(results), results['hedgedPnL'][-1] if len(results) else 0))
+        return results
+
+
+def main(path=HISTORY):
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(threadName)s - %(message)s')
+
+    results = VixRollBacktest(logger, path).Run()
+    print(','.join(results.dtype.names))
+    for trade in results:
+        print(','.join(str(v) for v in trade))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else HISTORY)
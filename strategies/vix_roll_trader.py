@@ -3,8 +3,11 @@ import logging
 from botocore.exceptions import ClientError
 from boto3.dynamodb.conditions import Key, Attr
 import json
-from utils import Connection, DecimalEncoder
+from utils import Connection, DecimalEncoder, TtlCache, BatchGet, RetryableError
 from contracts import SecurityDefinition, Futures
+from ledger import PositionLedger
+from roll_history import RollSignal, DynamoRollHistory, S3RollHistory, LegacyRollFile, FallbackRollHistory
+from records import Quote
 import datetime
 import decimal
 from dateutil.relativedelta import relativedelta
@@ -12,6 +15,12 @@ from functools import reduce
 import uuid
 import time
 import os
+import collections
+import asyncio
+import functools
+
+
+ORDERS_INDEX = 'SymbolMaturity'  # GSI on Orders, see db_scripts/create_tables.py
 
 
 class Side:
@@ -19,28 +28,68 @@ class Side:
     Sell = 'SELL'
 
 
-class Quote(object):
-    def __init__(self, symbol):
-        self.Symbol = symbol
-        self.Date = None
-        self.Close = 0.0
+class Resources(object):
+    """
+    AWS resources and the security definition, created once per warm Lambda container. db and s3 default to
+    the boto3 resources; pass stand-ins (benchmarks.standins.MemoryDb and MemoryS3) to run offline.
+    """
+    def __init__(self, db=None, s3=None):
+        db = boto3.resource('dynamodb', region_name='us-east-1') if db is None else db
+        self.Db = db
+        self.QuotesEod = db.Table(os.environ['QUOTES_TABLE'])
+        self.QuoteCache = TtlCache(maxSize=256, ttl=600)
+        self.Securities = db.Table(os.environ['SECURITIES_TABLE'])
+        self.Orders = db.Table(os.environ['ORDERS_TABLE'])
+        s3 = boto3.resource('s3') if s3 is None else s3
+        self.Debug = s3.Bucket(os.environ["DEBUG_FOLDER"])
+        # roll signals go to ROLL_TABLE when set, else one object per day under ROLL_FILE in the debug bucket;
+        # the days in the ROLL_FILE object written before either still count
+        rolls = DynamoRollHistory(db.Table(os.environ['ROLL_TABLE'])) if 'ROLL_TABLE' in os.environ \
+            else S3RollHistory(self.Debug, os.environ['ROLL_FILE'])
+        self.Rolls = FallbackRollHistory(rolls, LegacyRollFile(self.Debug, os.environ['ROLL_FILE']))
+        self.Positions = PositionLedger(db.Table(os.environ['POSITIONS_TABLE'])) \
+            if 'POSITIONS_TABLE' in os.environ else None
+        self.SecDef = SecurityDefinition()
+
+
+_resources = None
+
+
+def GetResources():
+    global _resources
+    if _resources is None:
+        _resources = Resources()
+    return _resources
+
+
+def ResetResources():
+    """Drop the container resources, e.g. after tests change the environment"""
+    global _resources
+    _resources = None
+
+
+def SetResources(resources):
+    """Use resources for the following invocations, e.g. Resources built on stand-ins"""
+    global _resources
+    _resources = resources
 
 
 class VixTrader(object):
-    def __init__(self, logger, today):
-        self.secDef = SecurityDefinition()
+    def __init__(self, logger, today, resources=None):
+        resources = GetResources() if resources is None else resources
+        self.secDef = resources.SecDef
         self.Logger = logger
-        db = boto3.resource('dynamodb', region_name='us-east-1')
         self.__isStopAttached = 'STOP_DISTANCE' in os.environ
         self.__stop = 0 if not self.__isStopAttached else int(os.environ['STOP_DISTANCE'])
 
         self.__isTest = False if os.environ['BACK_TEST'] == 'False' else True
-        self.__QuotesEod = db.Table(os.environ['QUOTES_TABLE'])
-        self.__Securities = db.Table(os.environ['SECURITIES_TABLE'])
-        self.__Orders = db.Table(os.environ['ORDERS_TABLE'])
-        s3 = boto3.resource('s3')
-        debug = os.environ["DEBUG_FOLDER"]
-        self.__debug = s3.Bucket(debug)
+        self.__db = resources.Db
+        self.__QuotesEod = resources.QuotesEod
+        self.__QuoteCache = resources.QuoteCache
+        self.__Securities = resources.Securities
+        self.__Orders = resources.Orders
+        self.__Rolls = resources.Rolls
+        self.__Positions = resources.Positions
         self.Today = today
 
         self.__FrontFuture = Quote(self.secDef.get_front_month_future('VX', today.date()))
@@ -49,43 +98,60 @@ class VixTrader(object):
         self.__StdSize = int(os.environ['STD_SIZE'])
         self.__VIX = Quote('VIX')
 
-    def S3Debug(self, line):
-        file = os.environ['ROLL_FILE']
-        self.__debug.download_file(file, '/tmp/%s' % file)
+    def RecordRoll(self, signal):
+        """Store the day's roll signal, False if this date and contract have already been evaluated"""
+        return self.__Rolls.Add(signal)
 
-        check = open('/tmp/%s' % file, 'r')
-        lines = check.readlines()
-        check.close()
-        if line in lines:
+    def AddQuote(self, image):
+        """
+        Seed the container quote cache from a stream NewImage, so BothQuotesArrived does not
+        query it again. Returns True if it is one of today's legs.
+        """
+        if 'Details' not in image:
+            return False
+        quote = Quote.FromImage(image)
+        self.__QuoteCache.Put((quote.Symbol, quote.Date), quote)
+        if quote.Date != self.Today.strftime('%Y%m%d'):
             return False
+        for leg in (self.__VIX, self.__FrontFuture):
+            if leg.Symbol == quote.Symbol:
+                self.__SetQuote(leg, quote)
+                return True
+        return False
 
-        f = open('/tmp/%s' % file, 'a')
-        f.write(line)
-        f.close()
-        self.__debug.upload_file('/tmp/%s' % file, file)
-        return True
+    def __SetQuote(self, leg, quote):
+        leg.Close = quote.Close
+        leg.Date = quote.Date
+        self.Logger.info('%s quote for EOD %s has arrived' % (leg.Symbol, leg.Date))
 
     def BothQuotesArrived(self):
         today = self.Today.strftime('%Y%m%d')
-        vix = self.GetQuotes(self.__VIX.Symbol, today)
-        if len(vix) > 0:
-            self.__VIX.Close = vix[0]['Details']['Close']
-            self.__VIX.Date = vix[0]['Date']
-            self.Logger.info('VIX quote for EOD %s has arrived' % today)
-        future = self.GetQuotes(self.__FrontFuture.Symbol, today)
-        if len(future) > 0:
-            self.__FrontFuture.Close = future[0]['Details']['Close']
-            self.__FrontFuture.Date = future[0]['Date']
-            self.Logger.info('%s quote for EOD %s has arrived' % (self.__FrontFuture.Symbol, today))
-        return len(vix) and len(future)
+        missing = {}
+        for quote in (self.__VIX, self.__FrontFuture):
+            if quote.Date == today:
+                continue
+            cached = self.__QuoteCache.Get((quote.Symbol, today))
+            if cached is not None:
+                self.__SetQuote(quote, cached)
+            else:
+                missing[quote.Symbol] = quote
+        if len(missing) > 0:
+            for item in self.GetQuotes(list(missing.keys()), today) or []:
+                cached = Quote.FromItem(item)
+                self.__QuoteCache.Put((cached.Symbol, cached.Date), cached)
+                self.__SetQuote(missing[cached.Symbol], cached)
+        return self.__VIX.Date == today and self.__FrontFuture.Date == today
 
     def GetCurrentPosition(self, date):
-        trades = filter(lambda x: x['Status'] == 'FILLED' or x['Status'] == 'PART_FILLED',
-                        self.GetOrders('VX', 'IG'))
-
         expiry = self.secDef.get_next_expiry_date(symbol=Futures.VX, today=date)
-        nextMonth = list(map(lambda x: x['Trade'],
-                             filter(lambda x: x['Maturity'] == expiry.strftime('%Y%m'), trades)))
+        if self.__Positions is not None:
+            return self.__Positions.Get('VX', expiry.strftime('%Y%m'), 'IG')
+
+        orders = self.GetOrders('VX', 'IG', expiry.strftime('%Y%m'))
+        if orders is None:
+            # trading on an unknown position could double it
+            raise RetryableError('Orders of VX %s could not be read' % expiry.strftime('%Y%m'))
+        nextMonth = list(map(lambda x: x['Trade'], orders))
 
         if len(nextMonth) == 0:
             self.Logger.info('No open positions have been found')
@@ -98,8 +164,8 @@ class VixTrader(object):
 
         return long - short
 
-    def IsExceeded(self, side, quantity, position):
-        vix = self.GetSecurities()
+    def IsExceeded(self, side, quantity, position, securities=None):
+        vix = self.GetSecurities() if securities is None else securities
         if vix is None or len(vix) == 0:
             self.Logger.error('No VX in security definition table')
             return True
@@ -150,13 +216,13 @@ class VixTrader(object):
                 "Reason": reason
             }
 
-            response = self.__Orders.update_item(
-                Key={
+            request = {
+                'Key': {
                     'OrderId': str(uuid.uuid4().hex),
                     'TransactionTime': str(time.time()),
                 },
-                UpdateExpression="set #st = :st, #s = :s, #m = :m, #p = :p, #b = :b, #o = :o, #t = :t, #str = :str",
-                ExpressionAttributeNames={
+                'UpdateExpression': "set #st = :st, #s = :s, #m = :m, #p = :p, #b = :b, #o = :o, #t = :t, #str = :str",
+                'ExpressionAttributeNames': {
                     '#st': 'Status',
                     '#s': 'Symbol',
                     '#m': 'Maturity',
@@ -166,7 +232,7 @@ class VixTrader(object):
                     '#t': 'Trade',
                     '#str': 'Strategy'
                 },
-                ExpressionAttributeValues={
+                'ExpressionAttributeValues': {
                     ':st': state,
                     ':s': symbol,
                     ':m': maturity,
@@ -175,8 +241,17 @@ class VixTrader(object):
                     ':o': order,
                     ':t': trade,
                     ':str': strategy
-                },
-                ReturnValues="UPDATED_NEW")
+                }
+            }
+
+            if self.__isTest and self.__Positions is not None:
+                # the filled order and its position are written together, or not at all
+                change = self.__Positions.RecordWith(dict(request, TableName=self.__Orders.name),
+                                                     symbol, maturity, 'IG', side, size)
+                self.Logger.info('Position %s %s changed by %s' % (symbol, maturity, change))
+                response = {'Attributes': {'Status': state, 'Trade': trade}}
+            else:
+                response = self.__Orders.update_item(ReturnValues="UPDATED_NEW", **request)
 
         except ClientError as e:
             self.Logger.error(e.response['Error']['Message'])
@@ -186,10 +261,33 @@ class VixTrader(object):
             self.Logger.info('Order Created')
             self.Logger.info(json.dumps(response, indent=4, cls=DecimalEncoder))
 
-    def Run(self, symbol):
-        self.Logger.info('Run for symbol %s, FrontFuture %s' % (symbol, self.__FrontFuture.Symbol))
-        if symbol != self.__VIX.Symbol and symbol != self.__FrontFuture.Symbol:
+    def IsRelevant(self, symbols):
+        symbols = [symbols] if isinstance(symbols, str) else list(symbols)
+        self.Logger.info('Run for symbols %s, FrontFuture %s' % (symbols, self.__FrontFuture.Symbol))
+        if self.__VIX.Symbol not in symbols and self.__FrontFuture.Symbol not in symbols:
             self.Logger.warn('Neither spot or Front Future')
+            return False
+        return True
+
+    def DaysLeft(self, date):
+        expiry = self.secDef.get_next_expiry_date(Futures.VX, date)
+        days_left = (expiry - date).days
+        if days_left <= 0:
+            self.Logger.warn('Expiry in the past. Expiry: %s. Today: %s' % (expiry, date))
+        return expiry, days_left
+
+    def Signal(self, date, days_left):
+        roll = (self.__FrontFuture.Close - self.__VIX.Close) / days_left
+        roll = round(roll, 2)
+        return RollSignal(date.strftime('%Y%m%d'), self.__FrontFuture.Symbol,
+                          self.__FrontFuture.Close, self.__VIX.Close, days_left, roll)
+
+    def HasRolled(self, date):
+        """True if today's roll has already been evaluated for the front future"""
+        return self.__Rolls.Contains(date.strftime('%Y%m%d'), self.__FrontFuture.Symbol)
+
+    def Run(self, symbols):
+        if not self.IsRelevant(symbols):
             return
 
         date = self.Today.date()
@@ -198,24 +296,23 @@ class VixTrader(object):
             self.Logger.warn('Need both spot and future to run the strategy')
             return
 
-        expiry = self.secDef.get_next_expiry_date(Futures.VX, date)
-        days_left = (expiry - date).days
+        expiry, days_left = self.DaysLeft(date)
         if days_left <= 0:
-            self.Logger.warn('Expiry in the past. Expiry: %s. Today: %s' % (expiry, date))
             return
 
-        roll = (self.__FrontFuture.Close - self.__VIX.Close) / days_left
-        roll = round(roll, 2)
-
-        if not self.S3Debug('%s,%s,%s,%s,%s,%s\n'
-                     % (date.strftime('%Y%m%d'), self.__FrontFuture.Symbol, self.__FrontFuture.Close,
-                        self.__VIX.Close, days_left, roll)):
-            self.Logger.info('Already ran for %s' % symbol)
+        signal = self.Signal(date, days_left)
+        if not self.RecordRoll(signal):
+            self.Logger.info('Already ran for %s' % symbols)
             return
 
+        self.Trade(date, expiry, signal.Roll, self.GetCurrentPosition(date))
+
+    def Trade(self, date, expiry, roll, position, securities=None):
+        """Act on the day's roll given the open position; securities are fetched if not given"""
+        days_left = (expiry - date).days
         self.Logger.info('The %s roll on %s with %s days left' % (roll, self.__FrontFuture.Symbol, days_left))
 
-        self.__OpenPosition = self.GetCurrentPosition(date)
+        self.__OpenPosition = position
         self.Logger.info('Found VX open position. Maturity %s. Size %s'
                          % (expiry.strftime('%Y%m'), self.__OpenPosition))
         if self.__OpenPosition != 0 and date == expiry - relativedelta(days=+1):
@@ -238,7 +335,8 @@ class VixTrader(object):
         if abs_roll >= self.__MaxRoll:
             self.Logger.info('Conditions have been met. Will create an order')
             side = Side.Sell if (self.__FrontFuture.Close - self.__VIX.Close) >= 0 else Side.Buy
-            if self.IsExceeded(side=side, quantity=self.__StdSize, position=self.__OpenPosition):
+            if self.IsExceeded(side=side, quantity=self.__StdSize, position=self.__OpenPosition,
+                               securities=securities):
                 self.Logger.warn('Exceeded MaxPosition size: %s, pos: %s' % (self.__StdSize, self.__OpenPosition))
                 return
 
@@ -253,46 +351,122 @@ class VixTrader(object):
                 KeyConditionExpression=Key('Symbol').eq('VX') & Key('Broker').eq('IG'))
         except ClientError as e:
             self.Logger.error(e.response['Error']['Message'])
-            return None
+            raise
         except Exception as e:
             self.Logger.error(e)
-            return None
+            raise
         else:
             if 'Items' in response:
                 return response['Items']
 
     @Connection.reliable
-    def GetOrders(self, symbol, broker):
+    def GetOrders(self, symbol, broker, maturity):
+        """Filled and part filled orders for one maturity, read page by page from the SymbolMaturity index"""
         try:
-            self.Logger.info('Calling orders scan attr: %s %s' % (symbol, broker))
-            response = self.__Orders.scan(FilterExpression=Attr('Symbol').eq(symbol) & Attr('Broker').eq(broker))
+            self.Logger.info('Calling orders query index: %s %s %s' % (symbol, broker, maturity))
+            query = {
+                'IndexName': ORDERS_INDEX,
+                'KeyConditionExpression': Key('Symbol').eq(symbol) & Key('Maturity').eq(maturity),
+                'FilterExpression': Attr('Broker').eq(broker) & Attr('Status').is_in(['FILLED', 'PART_FILLED']),
+                'ProjectionExpression': '#st, Trade',
+                'ExpressionAttributeNames': {'#st': 'Status'}
+            }
+            items = []
+            while True:
+                response = self.__Orders.query(**query)
+                items.extend(response.get('Items', []))
+                if 'LastEvaluatedKey' not in response:
+                    break
+                query['ExclusiveStartKey'] = response['LastEvaluatedKey']
 
         except ClientError as e:
             self.Logger.error(e.response['Error']['Message'])
-            return None
+            raise
         except Exception as e:
             self.Logger.error(e)
-            return None
+            raise
         else:
-            if 'Items' in response:
-                return response['Items']
+            return items
+
+    def GetQuotes(self, symbols, date):
+        """Quotes of all symbols for one date in a single BatchGetItem round trip, None if it keeps failing"""
+        self.Logger.info('Calling quotes batch get %s Date key: %s' % (symbols, date))
+        keys = [{'Symbol': symbol, 'Date': date} for symbol in symbols]
+        items = BatchGet(self.__db, self.__QuotesEod.name, keys).Run()
+        if items is None:
+            self.Logger.error('Quotes batch get %s %s failed' % (symbols, date))
+        return items
+
+
+class AsyncVixTrader(VixTrader):
+    """
+    VixTrader whose independent reads (both quotes, the open position, the securities risk row
+    and the roll history check) run concurrently on the loop's executor under one deadline.
+    """
+    def __init__(self, logger, today, resources=None, loop=None):
+        super(AsyncVixTrader, self).__init__(logger, today, resources)
+        self.Timeout = 10
+        self.__loop = loop if loop is not None else asyncio.get_event_loop()
+
+    def __Call(self, func, *args):
+        return self.__loop.run_in_executor(None, functools.partial(func, *args))
+
+    async def RunAsync(self, symbols):
+        if not self.IsRelevant(symbols):
+            return
+
+        date = self.Today.date()
+        expiry, days_left = self.DaysLeft(date)
+        if days_left <= 0:
+            return
 
-    @Connection.reliable
-    def GetQuotes(self, symbol, date):
         try:
-            self.Logger.info('Calling quotes query Date key: %s' % date)
-            response = self.__QuotesEod.query(
-                KeyConditionExpression=Key('Symbol').eq(symbol) & Key('Date').eq(date)
-            )
-        except ClientError as e:
-            self.Logger.error(e.response['Error']['Message'])
-            return None
-        except Exception as e:
-            self.Logger.error(e)
-            return None
+            arrived, position, securities, rolled = await asyncio.wait_for(
+                asyncio.gather(self.__Call(self.BothQuotesArrived), self.__Call(self.GetCurrentPosition, date),
+                               self.__Call(self.GetSecurities), self.__Call(self.HasRolled, date)),
+                timeout=self.Timeout)
+        except asyncio.TimeoutError:
+            self.Logger.error('Strategy data not fetched within %s seconds' % self.Timeout)
+            return
+
+        if not arrived:
+            self.Logger.warn('Need both spot and future to run the strategy')
+            return
+        if rolled:
+            self.Logger.info('Already ran for %s' % symbols)
+            return
+
+        # the conditional write still guards against a concurrent run of the same day
+        signal = self.Signal(date, days_left)
+        if not await self.__Call(self.RecordRoll, signal):
+            self.Logger.info('Already ran for %s' % symbols)
+            return
+
+        await self.__Call(self.Trade, date, expiry, signal.Roll, position, securities)
+
+
+async def RunAll(loop, logger, event):
+    for t, quotes in CoalesceRecords(event, logger).items():
+        today = datetime.datetime.strptime(t, '%Y%m%d')
+        vix = AsyncVixTrader(logger, today, loop=loop)
+        for image in quotes.values():
+            vix.AddQuote(image)
+        await vix.RunAsync(quotes.keys())
+
+
+def CoalesceRecords(event, logger):
+    """Group the INSERT records of a batch by trading date: {date: {symbol: NewImage}}"""
+    dates = collections.OrderedDict()
+    for record in event['Records']:
+        if record['eventName'] == 'INSERT':
+            keys = record['dynamodb']['Keys']
+            symbol = keys['Symbol']['S']
+            logger.info('New Quote received Symbol: %s', symbol)
+            image = record['dynamodb'].get('NewImage', keys)
+            dates.setdefault(keys['Date']['S'], collections.OrderedDict())[symbol] = image
         else:
-            if 'Items' in response:
-                return response['Items']
+            logger.info('Not INSERT event is ignored')
+    return dates
 
 
 def main(event, context):
@@ -311,16 +485,8 @@ def main(event, context):
 
     response = {'State': 'OK'}
     try:
-        for record in event['Records']:
-            if record['eventName'] == 'INSERT':
-                t = record['dynamodb']['Keys']['Date']['S']
-                today = datetime.datetime.strptime(t, '%Y%m%d')
-                symbol = record['dynamodb']['Keys']['Symbol']['S']
-                logger.info('New Quote received Symbol: %s', symbol)
-                vix = VixTrader(logger, today)
-                vix.Run(symbol)
-            else:
-                logger.info('Not INSERT event is ignored')
+        app_loop = asyncio.get_event_loop()
+        app_loop.run_until_complete(RunAll(app_loop, logger, event))
 
         logger.info('Stop VIX trader')
 
@@ -333,6 +499,7 @@ def main(event, context):
 
 def lambda_handler(event, context):
     res = main(event, context)
+    Connection.EmitMetrics('VixRollTrader')
     return json.dumps(res)
 
 
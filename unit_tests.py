@@ -1,7 +1,37 @@
 import unittest
 import contracts as cont
+import utils
+import logging
+from strategies import vix_roll_backtest as bt
+import regression as reg
+import indicators as ind
+from strategies import vix_roll_trader as vrt
+from executors import ig_executor as ige
+import ledger
+import roll_history as rh
+import notifier
+import records
+import io
+import json
+from benchmarks import pipeline, standins, suite
+import tempfile
+import asyncio
+import time
+from botocore.exceptions import ClientError
+import decimal
 import datetime
+import csv
+import os
+import numpy as np
 from dateutil.relativedelta import relativedelta
+from aiohttp import web
+
+EVENTS = os.path.dirname(os.path.abspath(__file__))
+HISTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'R', 'vix', 'vix_sp500_front_futures.csv')
+
+
+# the IG client tests talk to local stand-ins and must not wait on the real allowances
+Unlimited = ige.RateLimiter(600000, 600000)
 
 
 class TestUtils(unittest.TestCase):
@@ -86,5 +116,1512 @@ class TestUtils(unittest.TestCase):
         pass
 
 
+class TestTtlCache(unittest.TestCase):
+
+    def test_expiry_and_size(self):
+        now = [0]
+        cache = utils.TtlCache(maxSize=2, ttl=10, clock=lambda: now[0])
+        cache.Put('a', 1)
+        cache.Put('b', 2)
+        self.assertEqual(cache.Get('a'), 1)
+        cache.Put('c', 3)
+        # b was the least recently used
+        self.assertIsNone(cache.Get('b'))
+        now[0] = 10
+        self.assertIsNone(cache.Get('a'))
+        self.assertEqual(len(cache), 1)
+
+
+class TestConnection(unittest.TestCase):
+
+    class Client(object):
+        def __init__(self, failures):
+            self.Failures = list(failures)
+            self.Calls = 0
+
+        def attempt(self):
+            self.Calls += 1
+            if len(self.Failures) > 0:
+                failure = self.Failures.pop(0)
+                if failure is None:
+                    return None
+                raise failure
+            return 'OK'
+
+        @utils.Connection.reliable
+        def Call(self):
+            return self.attempt()
+
+        @utils.Connection.ioreliable
+        async def CallAsync(self):
+            await asyncio.sleep(0)
+            return self.attempt()
+
+    def setUp(self):
+        self.settings = (utils.Connection.backoff, utils.Connection.deadline)
+        utils.Connection.backoff = 0.01
+        utils.Connection.ResetMetrics()
+
+    def test_classification(self):
+        throttled = ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException', 'Message': ''}}, 'Query')
+        invalid = ClientError({'Error': {'Code': 'ValidationException', 'Message': ''},
+                               'ResponseMetadata': {'HTTPStatusCode': 400}}, 'Query')
+        self.assertTrue(utils.Connection.IsRetryable(throttled))
+        self.assertTrue(utils.Connection.IsRetryable(asyncio.TimeoutError()))
+        self.assertFalse(utils.Connection.IsRetryable(invalid))
+        self.assertFalse(utils.Connection.IsRetryable(KeyError('CST')))
+        self.assertFalse(utils.Connection.IsRetryable(utils.FatalError('sent')))
+
+    def test_sync_retries(self):
+        client = self.Client([None, utils.RetryableError('503')])
+        self.assertEqual(client.Call(), 'OK')
+        client = self.Client([KeyError('CST'), None])
+        # a fatal error is raised at once, not turned into None
+        with self.assertRaises(KeyError):
+            client.Call()
+        self.assertEqual(client.Calls, 1)
+        name = self.Client.Call.__qualname__
+        self.assertEqual(utils.Connection.Metrics()[name], {'calls': 2, 'retries': 2, 'fatal': 1})
+
+    def test_async_retries_do_not_block(self):
+        async def run():
+            clients = [self.Client([None, None, None]) for _ in range(20)]
+            started = time.monotonic()
+            results = await asyncio.gather(*[c.CallAsync() for c in clients])
+            return results, time.monotonic() - started
+
+        loop = asyncio.new_event_loop()
+        try:
+            results, elapsed = loop.run_until_complete(run())
+        finally:
+            loop.close()
+        self.assertEqual(results, ['OK'] * 20)
+        # three waits of at most 0.01, 0.02 and 0.04 seconds, overlapping across the 20 calls
+        self.assertLess(elapsed, 0.5)
+
+    def test_deadline(self):
+        utils.Connection.deadline = 0.05
+        client = self.Client([None] * 10)
+        self.assertIsNone(client.Call())
+        self.assertLess(client.Calls, 6)
+        name = self.Client.Call.__qualname__
+        self.assertEqual(utils.Connection.Metrics()[name]['failures'], 1)
+
+    def test_unknown_deal_outcome(self):
+        # CreatePosition gives up without an answer: the order stays PENDING and is reported as possibly executed
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            with pipeline.Offline(limits=Unlimited) as offline:
+                offline.IG.Fail('POST', '/positions/otc', 400)
+                timings, statuses = offline.Run()
+                self.assertEqual([status for _, status in statuses], ['PENDING'])
+                self.assertEqual(len(offline.IG.Deals), 0)
+                self.assertTrue(ige.Notifications.Flush(5))
+                self.assertIn('it may have been executed and is left PENDING', offline.Smtp.Messages[0])
+        finally:
+            loop.close()
+            asyncio.set_event_loop(None)
+
+
+    def test_emit_metrics(self):
+        self.Client([None]).Call()
+        with self.assertRaises(KeyError):
+            self.Client([KeyError('CST')]).Call()
+        stream = io.StringIO()
+        utils.Connection.EmitMetrics('Test', stream)
+        lines = [json.loads(x) for x in stream.getvalue().splitlines()]
+        self.assertEqual(len(lines), 1)
+        line = lines[0]
+        self.assertEqual((line['Function'], line['calls'], line['retries'], line['fatal'], line['failures']),
+                         (self.Client.Call.__qualname__, 2, 1, 1, 0))
+        self.assertEqual(len(line['Latency']), 2)
+        self.assertEqual(line['_aws']['CloudWatchMetrics'][0]['Namespace'], 'Test')
+        self.assertIn({'Name': 'Latency', 'Unit': 'Milliseconds'}, line['_aws']['CloudWatchMetrics'][0]['Metrics'])
+        # the next invocation starts from zero
+        self.assertEqual((utils.Connection.Metrics(), utils.Connection.Latencies()), ({}, {}))
+
+    def test_position_unknown(self):
+        class Orders(object):
+            def query(self, **kwargs):
+                raise utils.RetryableError('503')
+
+        environ = dict(os.environ)
+        os.environ.update({'QUOTES_TABLE': 'Quotes.EOD', 'SECURITIES_TABLE': 'Securities', 'ORDERS_TABLE': 'Orders',
+                           'DEBUG_FOLDER': 'debug', 'ROLL_FILE': 'roll.csv', 'BACK_TEST': 'True', 'STD_SIZE': '100'})
+        utils.Connection.deadline = 0.1
+        try:
+            resources = vrt.Resources(standins.MemoryDb(), standins.MemoryS3())
+            resources.Orders, resources.Positions = Orders(), None
+            trader = vrt.VixTrader(logging.getLogger(), datetime.datetime(2018, 3, 9), resources)
+            with self.assertRaises(utils.RetryableError):
+                trader.GetCurrentPosition(datetime.date(2018, 3, 9))
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+
+    def test_batch_get_resumes(self):
+        class Db(object):
+            """Holds back all but the first key of every request"""
+            def __init__(self):
+                self.Requests = []
+
+            def batch_get_item(self, RequestItems):
+                keys = RequestItems['Quotes']['Keys']
+                self.Requests.append(len(keys))
+                response = {'Responses': {'Quotes': keys[:1]}}
+                if len(keys) > 1:
+                    response['UnprocessedKeys'] = {'Quotes': {'Keys': keys[1:]}}
+                return response
+
+        db = Db()
+        keys = [{'Symbol': 'VX%s' % i, 'Date': '20180309'} for i in range(4)]
+        self.assertEqual(utils.BatchGet(db, 'Quotes', keys).Run(), keys)
+        # every retry sends only the keys still unprocessed
+        self.assertEqual(db.Requests, [4, 3, 2, 1])
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertEqual(loop.run_until_complete(utils.BatchGet(db, 'Quotes', keys).RunAsync(loop)), keys)
+        finally:
+            loop.close()
+
+    def tearDown(self):
+        utils.Connection.backoff, utils.Connection.deadline = self.settings
+
+
+class TestSecurityDefinition(unittest.TestCase):
+
+    def setUp(self):
+        self.sec = cont.SecurityDefinition()
+
+    def test_shared_calendar(self):
+        self.assertIs(cont.VixCalendar.instance(), cont.VixCalendar.instance())
+        self.assertEqual(len(cont.VixCalendar.instance().Expiries),
+                         (cont.VixCalendar.LastYear - cont.VixCalendar.FirstYear + 1) * 12)
+
+    def test_holiday_adjusted_expiry(self):
+        # Good Friday on the 3rd Friday of the following month
+        self.assertEqual(self.sec.get_vix_expiry_date(datetime.date(2008, 2, 1)), datetime.date(2008, 2, 19))
+        self.assertEqual(self.sec.get_vix_expiry_date(datetime.date(2014, 3, 1)), datetime.date(2014, 3, 18))
+        # Juneteenth on the settlement Wednesday
+        self.assertEqual(self.sec.get_vix_expiry_date(datetime.date(2024, 6, 1)), datetime.date(2024, 6, 18))
+        # Juneteenth on the 3rd Friday of the following month
+        self.assertEqual(self.sec.get_vix_expiry_date(datetime.date(2026, 5, 1)), datetime.date(2026, 5, 19))
+
+    def test_next_expiry(self):
+        self.assertEqual(self.sec.get_next_expiry_date('VX', datetime.date(2017, 11, 14)), datetime.date(2017, 11, 15))
+        self.assertEqual(self.sec.get_next_expiry_date('VX', datetime.date(2017, 11, 15)), datetime.date(2017, 12, 20))
+        self.assertEqual(self.sec.get_front_month_future('VX', datetime.date(2017, 11, 15)), 'VXZ7')
+        self.assertEqual(self.sec.get_futures('VX', 3, datetime.date(2017, 12, 29)), ['VXF8', 'VXG8', 'VXH8'])
+        self.assertIsNone(self.sec.get_next_expiry_date('ES', datetime.date(2017, 11, 14)))
+
+    def test_outside_calendar(self):
+        self.assertEqual(self.sec.get_next_expiry_date('VX', datetime.date(2070, 1, 5)), datetime.date(2070, 1, 22))
+        self.assertEqual(self.sec.get_futures('VX', 3, datetime.date(2060, 12, 20)), ['VXZ0', 'VXF1', 'VXG1'])
+
+    def test_batch_matches_history(self):
+        with open(HISTORY) as f:
+            rows = list(csv.DictReader(f))
+        dates = np.array([r['DATE'] for r in rows], dtype='datetime64[D]')
+        expiries, days_left, codes = self.sec.get_front_month_futures('VX', dates)
+        self.assertTrue((days_left == np.array([int(r['VIX_DAYS_LEFT']) for r in rows])).all())
+        self.assertTrue((codes == np.array(['VX%s%s' % (r['VIX_NAME'][4], r['VIX_NAME'][6]) for r in rows])).all())
+        self.assertEqual(expiries[0], np.datetime64('2008-01-16'))
+
+    def test_batch_matches_scalar(self):
+        days = [datetime.date(2017, 11, 14), datetime.date(2017, 11, 15), datetime.date(2017, 12, 29)]
+        self.assertEqual(list(self.sec.get_next_expiry_dates('VX', days).astype(object)),
+                         [self.sec.get_next_expiry_date('VX', d) for d in days])
+        self.assertEqual(self.sec.get_futures_batch('VX', 3, days).tolist(),
+                         [self.sec.get_futures('VX', 3, d) for d in days])
+        self.assertIsNone(self.sec.get_next_expiry_dates('VX', ['2080-01-01']))
+
+
+class TestVixRollBacktest(unittest.TestCase):
+
+    def setUp(self):
+        self.backtest = bt.VixRollBacktest(logging.getLogger(), HISTORY)
+
+    def loop(self, backtest):
+        # row by row port of the R trading loop
+        r = backtest.Returns
+        roll = backtest.Roll()
+        trades = []
+        position_open = False
+        for row in range(len(roll)):
+            if r['DATE'][row] < backtest.Start:
+                continue
+            tts = r['VIX_TTS'][row]
+            if ((backtest.ExitRoll is not None and roll[row] < backtest.ExitRoll)
+                    or (backtest.ExitDays is not None and tts < backtest.ExitDays)) and position_open:
+                position_open = False
+                trades.append((row, bt.Action.Close))
+            if roll[row] > backtest.MaxRoll and (backtest.EntryDays is None or tts > backtest.EntryDays) \
+                    and not position_open:
+                position_open = True
+                trades.append((row, bt.Action.Open))
+        return trades
+
+    def test_signals_match_loop(self):
+        rows, actions = self.backtest.Signals()
+        self.assertEqual(list(zip(rows.tolist(), actions.tolist())), self.loop(self.backtest))
+        live = bt.VixRollBacktest(logging.getLogger(), HISTORY, exitRoll=None, exitDays=2, entryDays=None)
+        rows, actions = live.Signals()
+        self.assertEqual(list(zip(rows.tolist(), actions.tolist())), self.loop(live))
+
+    def test_pnl(self):
+        results = self.backtest.Run()
+        self.assertEqual(results['ACTION'][0], bt.Action.Open)
+        self.assertTrue((results['ACTION'][::2] == bt.Action.Open).all())
+        self.assertTrue((results['ACTION'][1::2] == bt.Action.Close).all())
+        closed = results[results['ACTION'] == bt.Action.Close]
+        opened = results[results['ACTION'] == bt.Action.Open][:len(closed)]
+        self.assertTrue(np.allclose(closed['unhedgedPnL'],
+                                    np.round(np.cumsum(100 * (opened['VIX_FUT_PRICE'] - closed['VIX_FUT_PRICE'])), 2)))
+        self.assertAlmostEqual(results['hedgedPnL'][-1], results['totalReturn'].sum())
+
+
+class TestRegression(unittest.TestCase):
+
+    def setUp(self):
+        self.returns = bt.VixRollBacktest.Load(HISTORY)
+        r = self.returns
+        self.x = reg.HedgeRatioModel.Features(r['spx'], r['VIX_TTS'])
+        self.y = r['vix']
+
+    def test_expanding_matches_refit(self):
+        r = self.returns
+        ratios = reg.HedgeRatioModel.Expanding(r['spx'], r['vix'], r['VIX_TTS'], r['SP_CLOSE'])
+        for row in [10, 250, 1000, len(self.y) - 1]:
+            b = np.linalg.lstsq(self.x[:row + 1], self.y[:row + 1], rcond=None)[0]
+            expected = (b[1] * 100 + b[2] * r['VIX_TTS'][row] * 100) / (0.01 * r['SP_CLOSE'][row])
+            self.assertAlmostEqual(ratios[row], expected, places=8)
+        self.assertTrue(np.isnan(ratios[:2]).all())
+
+    def test_streaming_matches_expanding(self):
+        r = self.returns
+        model = reg.HedgeRatioModel()
+        self.assertIsNone(model.HedgeRatio(r['VIX_TTS'][0], r['SP_CLOSE'][0]))
+        for row in range(500):
+            model.Update(r['spx'][row], r['vix'][row], r['VIX_TTS'][row])
+        ratios = reg.HedgeRatioModel.Expanding(r['spx'], r['vix'], r['VIX_TTS'], r['SP_CLOSE'])
+        self.assertAlmostEqual(model.HedgeRatio(r['VIX_TTS'][499], r['SP_CLOSE'][499]), ratios[499], places=8)
+
+    def test_window_and_forgetting(self):
+        window, forgetting = 100, 0.98
+        fit = reg.OnlineLeastSquares(3, window, forgetting)
+        for row in range(400):
+            fit.Update(self.x[row], self.y[row])
+        weights = np.sqrt(forgetting ** np.arange(window - 1, -1, -1))
+        b = np.linalg.lstsq(self.x[300:400] * weights[:, None], self.y[300:400] * weights, rcond=None)[0]
+        self.assertTrue(np.allclose(fit.Coefficients(), b, rtol=1e-6, atol=1e-9))
+        self.assertEqual(fit.Count, window)
+
+
+class TestMomersion(unittest.TestCase):
+
+    def test_small_window(self):
+        returns = [float('nan'), 0.01, 0.02, -0.01, -0.03, 0.02, 0.0, 0.01]
+        # flags from the 3rd return: 1, 0, 1, 0, 0, 0
+        expected = [None, None, None, None, 100 * 2 / 3.0, 100 / 3.0, 100 / 3.0, 0.0]
+        indicator = ind.Momersion(3)
+        self.assertEqual([indicator.Update(r) for r in returns], expected)
+        batch = ind.momersion(returns, 3)
+        self.assertTrue(np.isnan(batch[:4]).all())
+        self.assertTrue(np.allclose(batch[4:], expected[4:]))
+
+    def test_streaming_matches_batch(self):
+        returns = np.random.RandomState(7).normal(0, 0.02, 2000)
+        returns[:3] = np.nan
+        batch = ind.momersion(returns, 252, returnLag=2)
+        indicator = ind.Momersion(252, returnLag=2)
+        streamed = np.array([indicator.Update(r) for r in returns], dtype=float)
+        self.assertTrue(np.array_equal(np.isnan(batch), np.isnan(streamed)))
+        self.assertTrue(np.allclose(batch[~np.isnan(batch)], streamed[~np.isnan(streamed)]))
+
+    def test_interior_gap(self):
+        returns = np.random.RandomState(11).normal(0, 0.02, 300)
+        returns[[0, 100, 101, 180]] = np.nan
+        for lag in (1, 2):
+            batch = ind.momersion(returns, 20, returnLag=lag)
+            indicator = ind.Momersion(20, returnLag=lag)
+            streamed = np.array([indicator.Update(None if i == 180 else r) for i, r in enumerate(returns)],
+                                dtype=float)
+            self.assertTrue(np.array_equal(np.isnan(batch), np.isnan(streamed)))
+            self.assertTrue(np.allclose(batch[~np.isnan(batch)], streamed[~np.isnan(streamed)]))
+            # no value while a window holds a flag paired with the gap, then it recovers
+            self.assertTrue(np.isnan(streamed[100:100 + 20 + lag]).all())
+            self.assertFalse(np.isnan(streamed[101 + 20 + lag:180]).any())
+
+
+class TestVixTrader(unittest.TestCase):
+
+    def setUp(self):
+        self.environ = dict(os.environ)
+        os.environ.update({'QUOTES_TABLE': 'Quotes.EOD', 'SECURITIES_TABLE': 'Securities', 'ORDERS_TABLE': 'Orders',
+                           'DEBUG_FOLDER': 'debug', 'ROLL_FILE': 'roll.csv', 'BACK_TEST': 'True', 'STD_SIZE': '100'})
+        vrt.ResetResources()
+
+    def test_resources_reused(self):
+        first = vrt.VixTrader(logging.getLogger(), datetime.datetime(2018, 3, 9))
+        second = vrt.VixTrader(logging.getLogger(), datetime.datetime(2018, 3, 12))
+        self.assertIs(first.secDef, second.secDef)
+        resources = vrt.GetResources()
+        self.assertIs(resources, vrt.GetResources())
+        vrt.ResetResources()
+        self.assertIsNot(resources, vrt.GetResources())
+
+    def quote(self, symbol, date, close):
+        return {'eventName': 'INSERT', 'dynamodb': {
+            'Keys': {'Symbol': {'S': symbol}, 'Date': {'S': date}},
+            'NewImage': {'Symbol': {'S': symbol}, 'Date': {'S': date},
+                         'Details': {'M': {'Close': {'N': close}}}}}}
+
+    def test_coalesce_by_date(self):
+        event = {'Records': [self.quote('VIX', '20180309', '14.64'), self.quote('VXH8', '20180309', '15.43'),
+                             self.quote('VIX', '20180312', '15.78'), {'eventName': 'MODIFY'}]}
+        dates = vrt.CoalesceRecords(event, logging.getLogger())
+        self.assertEqual(list(dates.keys()), ['20180309', '20180312'])
+        self.assertEqual(list(dates['20180309'].keys()), ['VIX', 'VXH8'])
+
+    def test_quotes_from_event_and_cache(self):
+        class Db(object):
+            def __init__(self):
+                self.Requests = []
+
+            def batch_get_item(self, RequestItems):
+                self.Requests.append(RequestItems)
+                return {'Responses': {'Quotes.EOD': [{'Symbol': 'VXH8', 'Date': '20180309',
+                                                      'Details': {'Close': decimal.Decimal('15.43')}}]}}
+
+        resources = vrt.GetResources()
+        resources.Db = Db()
+        trader = vrt.VixTrader(logging.getLogger(), datetime.datetime(2018, 3, 9), resources)
+        self.assertTrue(trader.AddQuote(self.quote('VIX', '20180309', '14.64')['dynamodb']['NewImage']))
+        self.assertFalse(trader.AddQuote(self.quote('VIX', '20180312', '15.78')['dynamodb']['NewImage']))
+        self.assertTrue(trader.BothQuotesArrived())
+        self.assertEqual(resources.Db.Requests,
+                         [{'Quotes.EOD': {'Keys': [{'Symbol': 'VXH8', 'Date': '20180309'}]}}])
+        # a later run in the same container is served from the cache
+        trader = vrt.VixTrader(logging.getLogger(), datetime.datetime(2018, 3, 9), resources)
+        self.assertTrue(trader.BothQuotesArrived())
+        self.assertEqual(len(resources.Db.Requests), 1)
+
+    def test_position_from_paginated_index(self):
+        class Orders(object):
+            def __init__(self):
+                self.Queries = []
+
+            def query(self, **kwargs):
+                self.Queries.append(kwargs)
+                if 'ExclusiveStartKey' not in kwargs:
+                    return {'Items': [{'Status': 'FILLED', 'Trade': {'Side': 'SELL', 'FilledSize': 100}}],
+                            'LastEvaluatedKey': {'OrderId': '1'}}
+                return {'Items': [{'Status': 'FILLED', 'Trade': {'Side': 'BUY', 'FilledSize': 30}}]}
+
+        resources = vrt.GetResources()
+        resources.Orders = Orders()
+        trader = vrt.VixTrader(logging.getLogger(), datetime.datetime(2018, 3, 9), resources)
+        self.assertEqual(trader.GetCurrentPosition(datetime.date(2018, 3, 9)), -70)
+        self.assertEqual(len(resources.Orders.Queries), 2)
+        self.assertEqual(resources.Orders.Queries[0]['IndexName'], vrt.ORDERS_INDEX)
+
+    def test_run_async(self):
+        class Table(object):
+            def __init__(self, items):
+                self.Items = items
+                self.Updates = []
+
+            def query(self, **kwargs):
+                return {'Items': self.Items}
+
+            def update_item(self, **kwargs):
+                self.Updates.append(kwargs)
+                return {'Attributes': {}}
+
+        with tempfile.TemporaryDirectory() as folder:
+            resources = vrt.GetResources()
+            resources.Orders = Table([])
+            resources.Securities = Table([{'TradingEnabled': True, 'Risk': {'MaxPosition': 1000}}])
+            resources.Rolls = rh.FileRollHistory(os.path.join(folder, 'roll.csv'))
+            loop = asyncio.new_event_loop()
+            try:
+                for _ in range(2):
+                    trader = vrt.AsyncVixTrader(logging.getLogger(), datetime.datetime(2018, 3, 9), resources, loop)
+                    trader.AddQuote(self.quote('VIX', '20180309', '14.64')['dynamodb']['NewImage'])
+                    trader.AddQuote(self.quote('VXH8', '20180309', '17.00')['dynamodb']['NewImage'])
+                    loop.run_until_complete(trader.RunAsync(['VIX', 'VXH8']))
+            finally:
+                loop.close()
+            # the second run of the day finds the roll already recorded
+            self.assertEqual(len(resources.Orders.Updates), 1)
+            order = resources.Orders.Updates[0]['ExpressionAttributeValues']
+            self.assertEqual((order[':m'], order[':o']['Side'], order[':st']), ('201803', 'SELL', 'FILLED'))
+            self.assertEqual([x.Line() for x in resources.Rolls.Export()], ['20180309,VXH8,17.00,14.64,12,0.20\n'])
+
+    def test_back_test_fill_and_position(self):
+        os.environ['POSITIONS_TABLE'] = 'Positions'
+        db = standins.MemoryDb()
+        resources = vrt.Resources(db, standins.MemoryS3())
+        loop = asyncio.new_event_loop()
+        try:
+            trader = vrt.AsyncVixTrader(logging.getLogger(), datetime.datetime(2018, 3, 9), resources, loop)
+            trader.AddQuote(self.quote('VIX', '20180309', '14.64')['dynamodb']['NewImage'])
+            trader.AddQuote(self.quote('VXH8', '20180309', '17.00')['dynamodb']['NewImage'])
+            db.Table('Securities').put_item(Item={'Symbol': 'VX', 'Broker': 'IG', 'TradingEnabled': True,
+                                                  'Risk': {'MaxPosition': 1000}})
+            loop.run_until_complete(trader.RunAsync(['VIX', 'VXH8']))
+        finally:
+            loop.close()
+        orders = db.Table('Orders').scan()['Items']
+        self.assertEqual([(x['Status'], x['Trade']['Side']) for x in orders], [('FILLED', 'SELL')])
+        # the fill and its position were written in one transaction
+        self.assertEqual(resources.Positions.Get('VX', '201803', 'IG'), -orders[0]['Trade']['FilledSize'])
+
+    def tearDown(self):
+        vrt.ResetResources()
+        os.environ.clear()
+        os.environ.update(self.environ)
+
+
+class TestPositionLedger(unittest.TestCase):
+
+    class Positions(object):
+        def __init__(self):
+            self.Items = {}
+
+        def update_item(self, Key, ExpressionAttributeValues, **kwargs):
+            item = self.Items.setdefault((Key['Symbol'], Key['Contract']), dict(Key, NetPosition=0))
+            item['NetPosition'] += ExpressionAttributeValues[':q']
+            return {'Attributes': {'NetPosition': item['NetPosition']}}
+
+        def get_item(self, Key, **kwargs):
+            key = (Key['Symbol'], Key['Contract'])
+            return {'Item': self.Items[key]} if key in self.Items else {}
+
+        def put_item(self, Item):
+            self.Items[(Item['Symbol'], Item['Contract'])] = Item
+
+    class Orders(object):
+        def scan(self, **kwargs):
+            if 'ExclusiveStartKey' not in kwargs:
+                return {'Items': [{'Maturity': '201803', 'Trade': {'Side': 'SELL', 'FilledSize': decimal.Decimal(100)}},
+                                  {'Maturity': '201804', 'Trade': {'Side': 'SELL', 'FilledSize': decimal.Decimal(50)}}],
+                        'LastEvaluatedKey': {'OrderId': '2'}}
+            return {'Items': [{'Maturity': '201803', 'Trade': {'Side': 'BUY', 'FilledSize': decimal.Decimal(40)}}]}
+
+    def test_record_and_get(self):
+        positions = ledger.PositionLedger(self.Positions())
+        self.assertEqual(positions.Get('VX', '201803', 'IG'), 0)
+        positions.Record('VX', '201803', 'IG', 'SELL', 100)
+        self.assertEqual(positions.Record('VX', '201803', 'IG', 'BUY', 40.0), -60)
+        self.assertEqual(positions.Get('VX', '201803', 'IG'), -60)
+        self.assertEqual(positions.Get('VX', '201803', 'IB'), 0)
+
+    def test_reconcile(self):
+        table = standins.MemoryDb().Table('Positions')
+        positions = ledger.PositionLedger(table)
+        positions.Record('VX', '201803', 'IG', 'SELL', 10)
+        # a maturity with no fill left in Orders, and one of another broker
+        positions.Record('VX', '201805', 'IG', 'BUY', 5)
+        positions.Record('VX', '201805', 'IB', 'BUY', 3)
+        self.assertEqual(positions.Reconcile(self.Orders(), 'VX', 'IG'), {'201803': -60, '201804': -50})
+        self.assertEqual(positions.Get('VX', '201803', 'IG'), -60)
+        self.assertEqual(positions.Get('VX', '201804', 'IG'), -50)
+        self.assertEqual(positions.Get('VX', '201805', 'IG'), 0)
+        self.assertEqual(positions.Get('VX', '201805', 'IB'), 3)
+        self.assertEqual(sorted(x['Contract'] for x in table.scan()['Items']),
+                         ['201803#IG', '201804#IG', '201805#IB'])
+
+    def test_reconcile_keeps_a_fill_landing_meanwhile(self):
+        table = standins.MemoryDb().Table('Positions')
+
+        class Racing(object):
+            name = table.name
+
+            def __getattr__(self, name):
+                return getattr(table, name)
+
+            def query(self, **kwargs):
+                response = table.query(**kwargs)
+                ledger.PositionLedger(table).Record('VX', '201805', 'IG', 'BUY', 1)
+                return response
+
+        positions = ledger.PositionLedger(Racing())
+        positions.Record('VX', '201805', 'IG', 'BUY', 5)
+        positions.Reconcile(self.Orders(), 'VX', 'IG')
+        self.assertEqual(positions.Get('VX', '201805', 'IG'), 6)
+
+    def test_record_with(self):
+        db = standins.MemoryDb()
+        orders = db.Table('Orders')
+        orders.put_item(Item={'OrderId': 'O1', 'TransactionTime': '1520607600', 'Status': 'PENDING'})
+        positions = ledger.PositionLedger(db.Table('Positions'))
+        fill = {'TableName': 'Orders', 'Key': {'OrderId': 'O1', 'TransactionTime': '1520607600'},
+                'UpdateExpression': "set #s = :s", 'ConditionExpression': "#s = :p",
+                'ExpressionAttributeNames': {'#s': 'Status'},
+                'ExpressionAttributeValues': {':s': 'FILLED', ':p': 'PENDING'}}
+        self.assertEqual(positions.RecordWith(fill, 'VX', '201803', 'IG', 'SELL', 2), -2)
+        # the order is no longer PENDING: neither the order nor the position is written again
+        with self.assertRaises(ClientError) as e:
+            positions.RecordWith(fill, 'VX', '201803', 'IG', 'SELL', 2)
+        self.assertEqual(e.exception.response['Error']['Code'], 'TransactionCanceledException')
+        self.assertIn('ConditionalCheckFailed', e.exception.response['Error']['Message'])
+        self.assertEqual(positions.Get('VX', '201803', 'IG'), -2)
+        self.assertEqual(orders.get_item(Key=fill['Key'])['Item']['Status'], 'FILLED')
+
+
+class TestRollHistory(unittest.TestCase):
+
+    def test_file_history(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'roll.csv')
+            history = rh.FileRollHistory(path)
+            self.assertTrue(history.Add(rh.RollSignal('20180312', 'VXH8', 15.6, 15.78, 9, -0.02)))
+            self.assertTrue(history.Add(rh.RollSignal('20180309', 'VXH8', 15.43, 14.64, 12, 0.07)))
+            self.assertFalse(history.Add(rh.RollSignal('20180309', 'VXH8', 15.5, 14.64, 12, 0.07)))
+            # a new process sees what the previous one wrote
+            history = rh.FileRollHistory(path)
+            self.assertFalse(history.Add(rh.RollSignal('20180312', 'VXH8', 15.6, 15.78, 9, -0.02)))
+            self.assertEqual([x.Line() for x in history.Export()],
+                             ['20180309,VXH8,15.43,14.64,12,0.07\n', '20180312,VXH8,15.6,15.78,9,-0.02\n'])
+
+    def test_dynamo_history(self):
+        class Rolls(object):
+            def __init__(self):
+                self.Items = {}
+
+            def put_item(self, Item, **kwargs):
+                if (Item['Date'], Item['Contract']) in self.Items:
+                    raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException', 'Message': ''}},
+                                      'PutItem')
+                self.Items[(Item['Date'], Item['Contract'])] = Item
+
+            def scan(self, **kwargs):
+                return {'Items': list(self.Items.values())}
+
+        history = rh.DynamoRollHistory(Rolls())
+        self.assertTrue(history.Add(rh.RollSignal('20180309', 'VXH8', 15.43, 14.64, 12, 0.07)))
+        self.assertFalse(history.Add(rh.RollSignal('20180309', 'VXH8', 15.43, 14.64, 12, 0.07)))
+        self.assertEqual(history.Export()[0].Roll, decimal.Decimal('0.07'))
+
+    def test_s3_history(self):
+        environ = dict(os.environ)
+        os.environ.update({'QUOTES_TABLE': 'Quotes.EOD', 'SECURITIES_TABLE': 'Securities', 'ORDERS_TABLE': 'Orders',
+                           'DEBUG_FOLDER': 'debug', 'ROLL_FILE': 'vix_roll'})
+        os.environ.pop('ROLL_TABLE', None)
+        s3 = standins.MemoryS3()
+        bucket = s3.Bucket('debug')
+        # the ROLL_FILE object the strategy appended to before the per-day objects
+        bucket.put_object(Key='vix_roll', Body=b'20180308,VXH8,15.1,14.2,13,0.07\n')
+        try:
+            history = vrt.Resources(standins.MemoryDb(), s3).Rolls
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+        self.assertTrue(history.Contains('20180308', 'VXH8'))
+        self.assertFalse(history.Add(rh.RollSignal('20180308', 'VXH8', 15.1, 14.2, 13, 0.07)))
+        self.assertFalse(history.Contains('20180309', 'VXH8'))
+        self.assertTrue(history.Add(rh.RollSignal('20180312', 'VXH8', 15.6, 15.78, 9, -0.02)))
+        self.assertTrue(history.Add(rh.RollSignal('20180309', 'VXH8', 15.43, 14.64, 12, 0.07)))
+        self.assertFalse(history.Add(rh.RollSignal('20180309', 'VXH8', 15.5, 14.64, 12, 0.07)))
+        self.assertTrue(history.Contains('20180309', 'VXH8'))
+        # ROLL_FILE is the prefix of the per-day objects in the debug bucket
+        self.assertEqual(sorted(o.key for o in bucket.objects.filter(Prefix='vix_roll/')),
+                         ['vix_roll/20180309/VXH8.csv', 'vix_roll/20180312/VXH8.csv'])
+        self.assertEqual([x.Line() for x in history.Export()],
+                         ['20180308,VXH8,15.1,14.2,13,0.07\n', '20180309,VXH8,15.43,14.64,12,0.07\n',
+                          '20180312,VXH8,15.6,15.78,9,-0.02\n'])
+
+    def test_no_legacy_file(self):
+        history = rh.FallbackRollHistory(rh.FileRollHistory(os.devnull),
+                                         rh.LegacyRollFile(standins.MemoryS3().Bucket('debug'), 'roll.csv'))
+        self.assertFalse(history.Contains('20180309', 'VXH8'))
+        self.assertEqual(history.Export(), [])
+
+
+class TestIGSession(unittest.TestCase):
+
+    class Broker(object):
+        """Session endpoints of the IG REST API, tokens stay valid until Expire"""
+
+        def __init__(self):
+            self.Logins = 0
+            self.Token = None
+            self.app = web.Application()
+            self.app.router.add_post('/session', self.login)
+            self.app.router.add_get('/positions', self.positions)
+            self.app.router.add_get('/accounts', self.accounts)
+
+        def Expire(self):
+            self.Token = None
+
+        async def login(self, request):
+            self.Logins += 1
+            self.Token = 'CST-%s' % self.Logins
+            return web.json_response({'currentAccountId': 'A1', 'accountInfo': {'available': 1000.0},
+                                      'currencyIsoCode': 'GBP'},
+                                     headers={'CST': self.Token, 'X-SECURITY-TOKEN': 'XST-%s' % self.Logins})
+
+        async def positions(self, request):
+            await asyncio.sleep(0.01)
+            if self.Token is None or request.headers.get('CST') != self.Token:
+                return web.json_response({'errorCode': 'error.security.client-token-invalid'}, status=401)
+            return web.json_response({'positions': []})
+
+        async def accounts(self, request):
+            return web.json_response({'accounts': [{'accountId': 'A1', 'balance': {'available': 800.0},
+                                                    'currency': 'GBP'}]})
+
+    class Sessions(object):
+        def __init__(self):
+            self.Items = {}
+
+        def get_item(self, Key, **kwargs):
+            return {'Item': self.Items[Key['SessionKey']]} if Key['SessionKey'] in self.Items else {}
+
+        def put_item(self, Item):
+            self.Items[Item['SessionKey']] = Item
+
+        def delete_item(self, Key):
+            self.Items.pop(Key['SessionKey'], None)
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.broker = self.Broker()
+        self.runner = web.AppRunner(self.broker.app)
+        self.loop.run_until_complete(self.runner.setup())
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        self.loop.run_until_complete(site.start())
+        self.params = ige.IGParams()
+        self.params.Url = 'http://127.0.0.1:%s' % self.runner.addresses[0][1]
+        self.params.Identifier = 'user'
+
+    def connect(self, cache, calls):
+        async def run():
+            async with ige.IGClient(self.params, logging.getLogger(), self.loop, cache, Unlimited) as client:
+                session = await client.Connect()
+                results = await asyncio.gather(*[call(client) for call in calls])
+                return session, results
+        return self.loop.run_until_complete(run())
+
+    def test_warm_invocation_skips_login(self):
+        cache = ige.SessionCache()
+        first, _ = self.connect(cache, [lambda c: c.GetPositions()])
+        second, results = self.connect(cache, [lambda c: c.GetPositions()])
+        self.assertEqual(self.broker.Logins, 1)
+        self.assertIs(first, second)
+        self.assertEqual(results, [{'positions': []}])
+        self.assertEqual((second.AccountId, second.Balance.Amount, second.Balance.Ccy), ('A1', 1000.0, 'GBP'))
+
+    def test_relogin_on_401(self):
+        cache = ige.SessionCache()
+        self.connect(cache, [])
+        self.broker.Expire()
+        # concurrent requests rejected with the old tokens share one new login
+        session, results = self.connect(cache, [lambda c: c.GetPositions()] * 3)
+        self.assertEqual(results, [{'positions': []}] * 3)
+        self.assertEqual(self.broker.Logins, 2)
+        self.assertEqual(cache.Get('user@%s' % self.params.Url).Tokens['CST'], 'CST-2')
+
+    def test_balance_refresh(self):
+        cache = ige.SessionCache()
+        session, results = self.connect(cache, [lambda c: c.RefreshBalance()])
+        self.assertEqual(results[0].Amount, 800.0)
+        self.assertTrue(session.IsBalanceFresh(ige.Scheduler.BalanceTtl))
+        session.ExpireBalance()
+        self.assertFalse(session.IsBalanceFresh(ige.Scheduler.BalanceTtl))
+
+    def test_shared_store_and_expiry(self):
+        table = self.Sessions()
+        self.connect(ige.SessionCache(ige.DynamoSessionStore(table)), [])
+        # a cold container finds the session in the store
+        session, _ = self.connect(ige.SessionCache(ige.DynamoSessionStore(table)), [])
+        self.assertEqual(self.broker.Logins, 1)
+        self.assertEqual(session.Tokens, {'CST': 'CST-1', 'X-SECURITY-TOKEN': 'XST-1'})
+        self.assertTrue(session.IsValid())
+        self.assertFalse(session.IsValid(session.Used + ige.IGSession.Lifetime))
+        self.assertFalse(session.IsValid(session.Created + ige.IGSession.MaxAge))
+
+        key = list(table.Items)[0]
+        table.Items[key]['Used'] = decimal.Decimal(str(time.time() - ige.IGSession.Lifetime))
+        self.connect(ige.SessionCache(ige.DynamoSessionStore(table)), [])
+        self.assertEqual(self.broker.Logins, 2)
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.runner.cleanup())
+        self.loop.close()
+
+
+class TestEpicCache(unittest.TestCase):
+
+    markets = {'markets': [
+        {'epic': 'VX.MAR', 'instrumentName': 'Volatility Index', 'instrumentType': 'INDICES', 'expiry': 'MAR-18'},
+        {'epic': 'VX.APR', 'instrumentName': 'Volatility Index', 'instrumentType': 'INDICES', 'expiry': 'APR-18'},
+        {'epic': 'VX.DUP1', 'instrumentName': 'Mini', 'instrumentType': 'INDICES', 'expiry': 'MAR-18'},
+        {'epic': 'VX.DUP2', 'instrumentName': 'Mini', 'instrumentType': 'INDICES', 'expiry': 'MAR-18'}
+    ]}
+
+    class Epics(object):
+        def __init__(self):
+            self.Items = {}
+
+        def scan(self, **kwargs):
+            return {'Items': list(self.Items.values())}
+
+        def batch_writer(self):
+            table = self
+
+            class Batch(object):
+                def __enter__(self):
+                    return self
+
+                def __exit__(self, *args):
+                    pass
+
+                def put_item(self, Item):
+                    table.Items[Item['Market']] = Item
+            return Batch()
+
+    def setUp(self):
+        self.searches = 0
+        # 2018-03-01, the March VX contract settles on 2018-03-21
+        self.now = 1519862400.0
+        self.loop = asyncio.new_event_loop()
+
+    async def search(self, term):
+        self.searches += 1
+        await asyncio.sleep(0.01)
+        return self.markets
+
+    def resolve(self, cache, *contracts):
+        async def run():
+            return await asyncio.gather(*[cache.Resolve('VX', name, 'INDICES', expiry, self.search)
+                                          for name, expiry in contracts])
+        return self.loop.run_until_complete(run())
+
+    def test_shared_lookup(self):
+        cache = ige.EpicCache(clock=lambda: self.now)
+        march = ('Volatility Index', 'MAR-18')
+        self.assertEqual(self.resolve(cache, march, march, march), ['VX.MAR'] * 3)
+        self.assertEqual(self.resolve(cache, ('Volatility Index', 'APR-18')), ['VX.APR'])
+        self.assertEqual(self.searches, 1)
+        self.assertEqual(self.resolve(cache, ('Mini', 'MAR-18')), [None])
+
+    def test_invalidated_at_expiry(self):
+        cache = ige.EpicCache(clock=lambda: self.now)
+        self.assertEqual(ige.EpicCache.Expires('VX', 'MAR-18'), datetime.date(2018, 3, 21))
+        self.resolve(cache, ('Volatility Index', 'MAR-18'))
+        self.now += 20 * 86400
+        self.assertEqual(cache.Get(('VX', 'Volatility Index', 'INDICES', 'MAR-18')), 'VX.MAR')
+        self.now += 86400
+        self.assertIsNone(cache.Get(('VX', 'Volatility Index', 'INDICES', 'MAR-18')))
+        self.assertEqual(cache.Get(('VX', 'Volatility Index', 'INDICES', 'APR-18')), 'VX.APR')
+
+    def test_warm_from_store(self):
+        table = self.Epics()
+        self.resolve(ige.EpicCache(ige.DynamoEpicStore(table), clock=lambda: self.now),
+                     ('Volatility Index', 'MAR-18'))
+        self.assertEqual(len(table.Items), 2)
+        cache = ige.EpicCache(ige.DynamoEpicStore(table), clock=lambda: self.now + 30 * 86400)
+        self.assertEqual(cache.Warm(), 1)
+        self.assertEqual(self.resolve(cache, ('Volatility Index', 'APR-18')), ['VX.APR'])
+        self.assertEqual(self.searches, 1)
+
+    def tearDown(self):
+        self.loop.close()
+
+
+class TestConfirmations(unittest.TestCase):
+
+    class Broker(object):
+        """Confirm, positions and activity endpoints; a confirm shows up after Delay polls or never if None"""
+
+        def __init__(self, deals):
+            self.Deals = deals
+            self.Calls = {'confirms': 0, 'positions': 0, 'activity': 0}
+            self.app = web.Application()
+            self.app.router.add_post('/session', self.login)
+            self.app.router.add_get('/confirms/{ref}', self.confirms)
+            self.app.router.add_get('/positions', self.positions)
+            self.app.router.add_get('/history/activity', self.activity)
+
+        async def login(self, request):
+            return web.json_response({'currentAccountId': 'A1', 'accountInfo': {'available': 1000.0},
+                                      'currencyIsoCode': 'GBP'}, headers={'CST': 'CST', 'X-SECURITY-TOKEN': 'XST'})
+
+        async def confirms(self, request):
+            self.Calls['confirms'] += 1
+            deal = self.Deals[request.match_info['ref']]
+            if deal['Delay'] is None or deal['Delay'] > 0:
+                if deal['Delay'] is not None:
+                    deal['Delay'] -= 1
+                return web.json_response({'errorCode': 'error.confirms.deal-not-found'}, status=404)
+            return web.json_response({'dealStatus': deal['Status'], 'dealId': deal['Id'], 'date': '2018-03-09T15:00:00',
+                                      'level': 17.0, 'size': 1.0})
+
+        async def positions(self, request):
+            self.Calls['positions'] += 1
+            return web.json_response({'positions': [
+                {'position': {'dealReference': ref, 'dealId': deal['Id'], 'createdDateUTC': '2018-03-09T15:00:00',
+                              'level': 17.0, 'size': 1.0}}
+                for ref, deal in self.Deals.items() if deal['Where'] == 'positions']})
+
+        async def activity(self, request):
+            self.Calls['activity'] += 1
+            return web.json_response({'activities': [
+                {'dealId': deal['Id'], 'date': '2018-03-09T15:00:00', 'status': deal['Status'],
+                 'details': {'dealReference': ref, 'level': 17.0, 'size': 1.0}}
+                for ref, deal in self.Deals.items() if deal['Where'] == 'activities']})
+
+    def setUp(self):
+        self.backoff = ige.Confirmations.Backoff
+        ige.Confirmations.Backoff = 0.01
+        self.loop = asyncio.new_event_loop()
+
+    def confirm(self, deals):
+        broker = self.Broker(deals)
+        runner = web.AppRunner(broker.app)
+        self.loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        self.loop.run_until_complete(site.start())
+        params = ige.IGParams()
+        params.Url = 'http://127.0.0.1:%s' % runner.addresses[0][1]
+
+        async def run():
+            async with ige.IGClient(params, logging.getLogger(), self.loop, limits=Unlimited) as client:
+                await client.Login()
+                confirmations = ige.Confirmations(client, logging.getLogger())
+                orders = [ige.Order(ref, '1520607600', 'VX', 'SELL', 1, 'MARKET', '201803', 'VIX', 'INDICES',
+                                    0.1, 10, None) for ref in deals]
+                sources = await asyncio.gather(*[confirmations.Confirm(o, o.OrderId) for o in orders])
+                return [(o.OrderId, o.Status, o.BrokerReferenceId, source) for o, source in zip(orders, sources)]
+        try:
+            return broker, self.loop.run_until_complete(run())
+        finally:
+            self.loop.run_until_complete(runner.cleanup())
+
+    def test_confirms_without_snapshots(self):
+        broker, results = self.confirm({
+            'R1': {'Id': 'D1', 'Delay': 0, 'Status': 'ACCEPTED', 'Where': None},
+            'R2': {'Id': 'D2', 'Delay': 2, 'Status': 'ACCEPTED', 'Where': None},
+            'R3': {'Id': 'D3', 'Delay': 1, 'Status': 'REJECTED', 'Where': None}})
+        self.assertEqual(results, [('R1', 'FILLED', 'D1', 'confirm'), ('R2', 'FILLED', 'D2', 'confirm'),
+                                   ('R3', 'FAILED', 'D3', 'confirm')])
+        self.assertEqual(broker.Calls, {'confirms': 6, 'positions': 0, 'activity': 0})
+
+    def test_shared_snapshots(self):
+        broker, results = self.confirm({
+            'R1': {'Id': 'D1', 'Delay': None, 'Status': 'ACCEPTED', 'Where': 'positions'},
+            'R2': {'Id': 'D2', 'Delay': None, 'Status': 'ACCEPTED', 'Where': 'positions'},
+            'R3': {'Id': 'D3', 'Delay': None, 'Status': 'ACCEPTED', 'Where': 'activities'},
+            'R4': {'Id': 'D4', 'Delay': None, 'Status': 'ACCEPTED', 'Where': None}})
+        self.assertEqual(results, [('R1', 'FILLED', 'D1', 'positions'), ('R2', 'FILLED', 'D2', 'positions'),
+                                   ('R3', 'FILLED', 'D3', 'activities'), ('R4', 'FAILED', '', None)])
+        # one positions and one activity download for the whole batch
+        self.assertEqual(broker.Calls, {'confirms': 4 * ige.Confirmations.Polls, 'positions': 1, 'activity': 1})
+
+    def tearDown(self):
+        ige.Confirmations.Backoff = self.backoff
+        self.loop.close()
+
+
+class TestStoreManager(unittest.TestCase):
+
+    class Db(object):
+        """
+        A fill's transaction takes Latency seconds and is cancelled for orders no longer PENDING; it
+        writes the order update and the position together
+        """
+        Latency = 0.05
+        name = 'Orders'
+
+        def __init__(self, filled):
+            self.Filled = filled
+            self.Updates = []
+            self.Fills = []
+            self.meta = self.client = self
+
+        def Table(self, name):
+            return self
+
+        def transact_write_items(self, TransactItems):
+            time.sleep(self.Latency)
+            order, fill = [x['Update'] for x in TransactItems]
+            if order['Key']['OrderId']['S'] in self.Filled or order.get('ConditionExpression') != '#s = :p':
+                raise ClientError({'Error': {'Code': 'TransactionCanceledException',
+                                             'Message': 'Transaction cancelled [ConditionalCheckFailed, None]'}},
+                                  'TransactWriteItems')
+            self.Updates.append(order['Key']['OrderId']['S'])
+            self.Fills.append(fill['Key'])
+
+    def order(self, orderId):
+        order = ige.Order(orderId, '1520607600', 'VX', 'SELL', 1, 'MARKET', '201803', 'VIX', 'INDICES', 0.1, 10, None)
+        order.Status, order.FillTime, order.FillPrice, order.FillSize = 'FILLED', '2018-03-09T15:00:00', 17.0, 1
+        return order
+
+    def test_write_behind(self):
+        db = self.Db(['O3'])
+        loop = asyncio.new_event_loop()
+
+        async def run():
+            ticks = 0
+            async with ige.StoreManager(logging.getLogger(), loop, db) as store:
+                started = time.monotonic()
+                for i in range(8):
+                    store.Enqueue(self.order('O%s' % i))
+                flush = asyncio.ensure_future(store.Flush())
+                while not flush.done():
+                    ticks += 1
+                    await asyncio.sleep(0.005)
+                return flush.result(), time.monotonic() - started, ticks
+        try:
+            updates, elapsed, ticks = loop.run_until_complete(run())
+        finally:
+            loop.close()
+        self.assertEqual(list(updates.keys()), ['O%s' % i for i in range(8)])
+        self.assertEqual([k for k, (saved, _) in updates.items() if not saved], ['O3'])
+        self.assertIn('ConditionalCheckFailed', updates['O3'][1])
+        self.assertEqual(sorted(db.Updates), ['O0', 'O1', 'O2', 'O4', 'O5', 'O6', 'O7'])
+        self.assertEqual(len(db.Fills), 7)
+        # the writes overlap on the pool and the loop keeps running meanwhile
+        self.assertLess(elapsed, 8 * 2 * self.Db.Latency)
+        self.assertGreater(ticks, 5)
+
+    def test_exit_leaves_hung_writes(self):
+        db = self.Db([])
+        db.Latency = 1.0
+        loop = asyncio.new_event_loop()
+
+        async def write():
+            async with ige.StoreManager(logging.getLogger(), loop, db) as store:
+                store.Enqueue(self.order('O1'))
+                updates = await store.Flush(0.05)
+            return updates, time.monotonic()
+        try:
+            started = time.monotonic()
+            updates, exited = loop.run_until_complete(write())
+        finally:
+            loop.close()
+        self.assertFalse(updates['O1'][0])
+        # leaving does not wait for the write still running on the container's pool
+        self.assertLess(exited - started, 0.5)
+        self.assertIs(ige.GetWriters(), ige.GetWriters())
+
+
+class TestDispatcher(unittest.TestCase):
+
+    class Scheduler(object):
+        """SendOrder takes Latency seconds per stage, or forever for the OrderIds in Stuck"""
+        Latency = 0.01
+        Unfinished = staticmethod(ige.Scheduler.Unfinished)
+
+        def __init__(self, stuck=()):
+            self.Stuck = stuck
+            self.Running = set()
+            self.MaxRunning = 0
+            self.Overlaps = 0
+
+        async def SendOrder(self, order):
+            contract = (order.Symbol, order.Maturity)
+            if contract in [(o.Symbol, o.Maturity) for o in self.Running]:
+                self.Overlaps += 1
+            self.Running.add(order)
+            self.MaxRunning = max(self.MaxRunning, len(self.Running))
+            try:
+                for stage in (ige.Stage.Lookup, ige.Stage.Create):
+                    order.Stage = stage
+                    await asyncio.sleep(3600 if order.OrderId in self.Stuck and stage == ige.Stage.Create
+                                        else self.Latency)
+                return order.OrderId, 'Sent'
+            finally:
+                self.Running.discard(order)
+
+    def order(self, orderId, maturity):
+        return ige.Order(orderId, '1520607600', 'VX', 'SELL', 1, 'MARKET', maturity, 'VIX', 'INDICES', 0.1, 10, None)
+
+    def dispatch(self, scheduler, orders, concurrency, timeout):
+        loop = asyncio.new_event_loop()
+        try:
+            dispatcher = ige.Dispatcher(scheduler, logging.getLogger(), concurrency, timeout)
+            return loop.run_until_complete(dispatcher.Run(orders))
+        finally:
+            loop.close()
+
+    def test_concurrency_and_sequencing(self):
+        scheduler = self.Scheduler()
+        orders = [self.order('O%s' % i, '2018%02d' % (1 + i % 6)) for i in range(60)]
+        results, unfinished = self.dispatch(scheduler, orders, 4, 10)
+        self.assertEqual(results, [('O%s' % i, 'Sent') for i in range(60)])
+        self.assertEqual(unfinished, [])
+        self.assertEqual(scheduler.MaxRunning, 4)
+        self.assertEqual(scheduler.Overlaps, 0)
+
+    def test_unfinished_orders_are_cancelled(self):
+        scheduler = self.Scheduler(stuck=['O1'])
+        orders = [self.order('O0', '201803'), self.order('O1', '201804'), self.order('O2', '201804'),
+                  self.order('O3', '201805')]
+        started = time.monotonic()
+        results, unfinished = self.dispatch(scheduler, orders, 2, 0.2)
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(unfinished, ['O1', 'O2'])
+        results = dict(results)
+        self.assertEqual((results['O0'], results['O3']), ('Sent', 'Sent'))
+        self.assertIn('stopped at create, it may have been executed', results['O1'])
+        self.assertIn('Order not sent', results['O2'])
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    class Broker(object):
+        """GET /positions answers the allowance error to the first Throttled requests"""
+
+        def __init__(self, throttled):
+            self.Throttled = throttled
+            self.Requests = 0
+            self.app = web.Application()
+            self.app.router.add_get('/positions', self.positions)
+
+        async def positions(self, request):
+            self.Requests += 1
+            if self.Requests <= self.Throttled:
+                return web.json_response({'errorCode': 'error.public-api.exceeded-account-allowance'}, status=403)
+            return web.json_response({'positions': []})
+
+    def test_bucket(self):
+        now = [0.0]
+        bucket = utils.TokenBucket(1.0, 2, recovery=10, clock=lambda: now[0])
+        self.assertEqual([bucket.Reserve() for _ in range(4)], [0, 0, 1, 2])
+        now[0] = 3.0
+        self.assertEqual(bucket.Reserve(), 0)
+        bucket.Slow()
+        self.assertEqual(bucket.Rate, 0.5)
+        self.assertEqual(bucket.Reserve(), 2)
+        # the rate climbs back to nominal over the recovery period
+        now[0] = 8.0
+        bucket.Reserve()
+        self.assertEqual(bucket.Rate, 1.0)
+        metrics = bucket.Metrics()
+        self.assertEqual((metrics['requests'], metrics['slowdowns'], metrics['wait'], metrics['maxWait']),
+                         (7, 1, 5, 2))
+
+    def test_allowance_limits(self):
+        limits = ige.RateLimiter(6000, 6000)
+        self.assertEqual((limits.Trading.Capacity, limits.Trading.Rate), (600, 90))
+        limits = ige.RateLimiter()
+        # a burst plus a minute of refill stays within the allowance
+        self.assertLessEqual(limits.NonTrading.Capacity + 60 * limits.NonTrading.Rate, 30)
+        self.assertLessEqual(limits.Trading.Capacity + 60 * limits.Trading.Rate, 100)
+
+    def test_paced_client(self):
+        backoff = utils.Connection.backoff
+        utils.Connection.backoff = 0.01
+        loop = asyncio.new_event_loop()
+        broker = self.Broker(throttled=1)
+        runner = web.AppRunner(broker.app)
+        params = ige.IGParams()
+        limits = ige.RateLimiter()
+        limits.NonTrading = utils.TokenBucket(100.0, 5)
+
+        async def run():
+            await runner.setup()
+            site = web.TCPSite(runner, '127.0.0.1', 0)
+            await site.start()
+            params.Url = 'http://127.0.0.1:%s' % runner.addresses[0][1]
+            async with ige.IGClient(params, logging.getLogger(), loop, limits=limits) as client:
+                started = time.monotonic()
+                results = await asyncio.gather(*[client.GetPositions() for _ in range(20)])
+                return results, time.monotonic() - started
+        try:
+            results, elapsed = loop.run_until_complete(run())
+        finally:
+            loop.run_until_complete(runner.cleanup())
+            loop.close()
+            utils.Connection.backoff = backoff
+        self.assertEqual(results, [{'positions': []}] * 20)
+        metrics = limits.Metrics()['nonTrading']
+        self.assertEqual((metrics['requests'], metrics['slowdowns']), (21, 1))
+        # 15 requests beyond the burst at no more than 100 a second
+        self.assertGreater(elapsed, 0.14)
+        self.assertGreater(metrics['maxWait'], 0.14)
+
+
+class TestRiskEngine(unittest.TestCase):
+
+    trades = {'positions': [
+        {'market': {'expiry': 'MAR-18', 'instrumentName': 'VIX', 'instrumentType': 'INDICES'},
+         'position': {'direction': 'BUY', 'size': 3.0}},
+        {'market': {'expiry': 'MAR-18', 'instrumentName': 'VIX', 'instrumentType': 'INDICES'},
+         'position': {'direction': 'SELL', 'size': 1.0}},
+        {'market': {'expiry': 'APR-18', 'instrumentName': 'VIX', 'instrumentType': 'INDICES'},
+         'position': {'direction': 'SELL', 'size': 5.0}}]}
+
+    def order(self, orderId, side, size, maturity='201803', maxPos=10):
+        return ige.Order(orderId, '1520607600', 'VX', side, size, 'MARKET', maturity, 'VIX', 'INDICES',
+                         decimal.Decimal('0.1'), decimal.Decimal(maxPos), None)
+
+    def test_batch_is_netted(self):
+        engine = ige.RiskEngine(self.trades, ige.Money(1000.0, 'USD'), logging.getLogger())
+        self.assertEqual(engine.Position(self.order('O', 'BUY', 1)), 2)
+        self.assertEqual(engine.Position(self.order('O', 'BUY', 1, '201804')), -5)
+        self.assertEqual(engine.Position(self.order('O', 'BUY', 1, '201805')), 0)
+
+        orders = [self.order('O1', 'BUY', 5), self.order('O2', 'BUY', 5), self.order('O3', 'SELL', 4),
+                  self.order('O4', 'BUY', 2), self.order('O5', 'SELL', 6, '201804'), self.order('O6', 'BUY', 200)]
+        passed, failed = engine.Run(orders)
+        # O2 alone would pass against the snapshot but not on top of O1
+        self.assertEqual([o.OrderId for o in passed], ['O1', 'O3', 'O4'])
+        self.assertEqual([o.OrderId for o in failed], ['O2', 'O5', 'O6'])
+        self.assertEqual(engine.Position(self.order('O', 'BUY', 1)), 5)
+
+    def test_errors_fail_the_order(self):
+        engine = ige.RiskEngine(None, ige.Money(0, 'USD'), logging.getLogger())
+        order = self.order('O1', 'BUY', 1)
+        self.assertEqual(engine.Run([order]), ([], [order]))
+
+
+class TestValidateOrders(unittest.TestCase):
+
+    class Db(object):
+        """Securities keyed by (Symbol, Broker); the first batch answer leaves one key unprocessed"""
+
+        def __init__(self, securities):
+            self.Securities = securities
+            self.Requests = []
+            self.name = 'Securities'
+
+        def Table(self, name):
+            return self
+
+        def batch_get_item(self, RequestItems):
+            keys = RequestItems['Securities']['Keys']
+            self.Requests.append(len(keys))
+            served = keys if len(self.Requests) > 1 else keys[1:]
+            response = {'Responses': {'Securities': [self.Securities[(k['Symbol'], k['Broker'])] for k in served
+                                                     if (k['Symbol'], k['Broker']) in self.Securities]}}
+            if len(served) < len(keys):
+                response['UnprocessedKeys'] = {'Securities': {'Keys': keys[:1]}}
+            return response
+
+    @staticmethod
+    def security(symbol, broker='IG', enabled=True):
+        return {'Symbol': symbol, 'Broker': broker, 'TradingEnabled': enabled,
+                'Description': {'Name': '%s Name' % symbol, 'MarketGroup': 'INDICES'},
+                'Risk': {'RiskFactor': decimal.Decimal('0.1'), 'MaxPosition': decimal.Decimal(10)}}
+
+    @staticmethod
+    def image(orderId, symbol, broker='IG'):
+        return {'OrderId': {'S': orderId}, 'TransactionTime': {'S': '1520607600'}, 'Symbol': {'S': symbol},
+                'Broker': {'S': broker}, 'Maturity': {'S': '201803'},
+                'Order': {'M': {'Side': {'S': 'SELL'}, 'Size': {'N': '1'}, 'OrdType': {'S': 'MARKET'}}}}
+
+    def test_batch_get_distinct_keys(self):
+        db = self.Db(dict(((x['Symbol'], x['Broker']), x) for x in
+                          [self.security('VX'), self.security('ES'), self.security('NQ', enabled=False)]))
+        keys = [('VX', 'IG'), ('ES', 'IG'), ('NQ', 'IG'), ('CL', 'IG')] * 100
+        loop = asyncio.new_event_loop()
+
+        async def run():
+            async with ige.StoreManager(logging.getLogger(), loop, db) as store:
+                return await store.GetSecurities(keys)
+        try:
+            securities = loop.run_until_complete(run())
+        finally:
+            loop.close()
+        self.assertEqual(db.Requests, [4, 1])
+        self.assertEqual(sorted(x['Symbol'] for x in securities), ['ES', 'NQ', 'VX'])
+
+    def test_join(self):
+        orders = [self.image('O1', 'VX'), self.image('O2', 'NQ'), self.image('O3', 'ES'), self.image('O4', 'VX', 'IB'),
+                  self.image('O5', 'VX')]
+        securities = [self.security('VX'), self.security('ES'), self.security('NQ', enabled=False),
+                      self.security('ES', 'IB')]
+        valid, invalid = ige.Scheduler.Validate([ige.Order.FromImage(x) for x in orders], securities)
+        self.assertEqual([(o.OrderId, o.Name, o.MaxPosition) for o in valid],
+                         [('O1', 'VX Name', 10), ('O3', 'ES Name', 10), ('O5', 'VX Name', 10)])
+        self.assertEqual(invalid, [('NQ', 'IG'), ('VX', 'IB')])
+        self.assertEqual(ige.Scheduler.Validate([ige.Order.FromImage(orders[0])], None), ([], [('VX', 'IG')]))
+
+
+class TestNotifier(unittest.TestCase):
+
+    def setUp(self):
+        self.window = notifier.Notifier.Window
+        notifier.Notifier.Window = 0.2
+
+    def start(self, **kwargs):
+        self.server = standins.SmtpStandIn(**kwargs)
+        port = self.server.Start()
+        self.notifier = notifier.Notifier('127.0.0.1', port, '', '', 'ig@example.com', ['ig@example.com'],
+                                          logging.getLogger(), starttls=False)
+
+    def test_digest_over_one_connection(self):
+        self.start(latency=0.3)
+        started = time.monotonic()
+        for i in range(3):
+            self.notifier.Notify('report %s' % i)
+        # queuing does not wait for the slow server
+        self.assertLess(time.monotonic() - started, 0.05)
+        self.assertTrue(self.notifier.Flush(5))
+        self.assertEqual(len(self.server.Messages), 1)
+        self.assertIn('(3 reports)', self.server.Messages[0])
+        self.assertTrue(all('report %s' % i in self.server.Messages[0] for i in range(3)))
+
+        self.notifier.Notify('report 3')
+        self.assertTrue(self.notifier.Flush(5))
+        self.assertEqual(len(self.server.Messages), 2)
+        self.assertEqual(self.server.Connections, 1)
+        self.assertEqual((self.notifier.Sent, self.notifier.Failed), (2, 0))
+
+    def test_reconnects(self):
+        self.start(dropAfterMessage=True)
+        for i in range(2):
+            self.notifier.Notify('report %s' % i)
+            self.assertTrue(self.notifier.Flush(5))
+        self.assertEqual(len(self.server.Messages), 2)
+        self.assertEqual(self.server.Connections, 2)
+        self.assertTrue(self.notifier.Flush(0))
+
+    def test_pending(self):
+        notifier.Notifier.Window = 0
+        self.start(latency=0.3)
+        self.assertEqual(self.notifier.Pending, 0)
+        # nothing queued: no wait for the worker
+        started = time.monotonic()
+        self.assertTrue(self.notifier.Flush(5))
+        self.assertLess(time.monotonic() - started, 0.05)
+        self.notifier.Notify('report 0')
+        time.sleep(0.1)
+        self.notifier.Notify('report 1')
+        self.notifier.Notify('report 2')
+        self.assertEqual(self.notifier.Pending, 3)
+        self.assertTrue(self.notifier.Flush(5))
+        self.assertEqual(self.notifier.Pending, 0)
+        # without a window the reports queued during the first send still share the next message
+        self.assertEqual(len(self.server.Messages), 2)
+        self.assertIn('(2 reports)', self.server.Messages[1])
+
+    def test_digest_across_invocations(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            maturity = (datetime.date.today() + relativedelta(months=+1)).strftime('%Y%m')
+            with pipeline.Offline(limits=Unlimited) as offline:
+                self.notifier = ige.Notifications
+                self.server = offline.Smtp
+                self.notifier.Window = 1
+                orders = offline.Db.Table('Orders')
+                for i in range(2):
+                    orders.put_item(Item={'OrderId': 'O%s' % i, 'TransactionTime': str(time.time()), 'Symbol': 'VX',
+                                          'Broker': 'IG', 'Maturity': maturity, 'Status': 'PENDING',
+                                          'ProductType': 'SPREAD', 'Trade': {},
+                                          'Order': {'Side': 'SELL', 'Size': 1, 'OrdType': 'MARKET'},
+                                          'Strategy': {'Name': 'TEST', 'Reason': 'OPEN'}})
+                    started = time.monotonic()
+                    ige.lambda_handler(orders.Drain(), None)
+                    # the handler does not wait for the mail
+                    self.assertLess(time.monotonic() - started, self.notifier.Window)
+                self.assertEqual((self.notifier.Pending, len(offline.Smtp.Messages)), (2, 0))
+                deadline = time.monotonic() + 5
+                while self.notifier.Pending > 0 and time.monotonic() < deadline:
+                    time.sleep(0.05)
+                self.assertEqual(len(offline.Smtp.Messages), 1)
+                self.assertIn('(2 reports)', offline.Smtp.Messages[0])
+                # a digest frozen past its window is sent by the next invocation
+                self.notifier.Notify('report')
+                self.notifier.Window = 0
+                self.assertTrue(self.notifier.Overdue)
+                ige.lambda_handler({'Records': []}, None)
+                self.assertEqual(len(offline.Smtp.Messages), 2)
+        finally:
+            loop.close()
+            asyncio.set_event_loop(None)
+
+
+    def test_undeliverable(self):
+        self.start()
+        self.server.Stop()
+        self.notifier.Notify('report')
+        self.assertTrue(self.notifier.Flush(5))
+        self.assertEqual((self.notifier.Sent, self.notifier.Failed), (0, 1))
+
+    def tearDown(self):
+        notifier.Notifier.Window = self.window
+        self.notifier.Close()
+        self.server.Stop()
+
+
+class TestRecords(unittest.TestCase):
+    def image(self, folder):
+        with open(os.path.join(EVENTS, folder, 'event.json')) as f:
+            return json.load(f)['Records'][0]['dynamodb']['NewImage']
+
+    def test_order(self):
+        order = records.Order.FromImage(self.image('executors'))
+        self.assertEqual(order.OrderId, '111fc487ecc748bc9f9b9f1afa9d58ee')
+        self.assertEqual((order.Symbol, order.Broker, order.Maturity, order.Status), ('VX', 'IG', '201806', 'PENDING'))
+        self.assertEqual((order.Side, order.Size, order.OrdType), ('SELL', decimal.Decimal(100), 'MARKET'))
+        self.assertEqual(order.StopDistance, decimal.Decimal(4))
+        self.assertEqual((order.Strategy, order.Reason), ('VIX ROLL', 'OPEN'))
+        self.assertIsNone(order.Trade)
+        self.assertFalse(hasattr(order, '__dict__'))
+
+    def test_trade(self):
+        image = self.image('executors')
+        image['Trade'] = {'M': {'FillTime': {'S': '1520607600'}, 'Side': {'S': 'SELL'}, 'FilledSize': {'N': '100'},
+                                'Price': {'N': '15.25'}, 'StopDistance': {'S': '4'},
+                                'Broker': {'M': {'Name': {'S': 'IG'}, 'RefType': {'S': 'dealId'},
+                                                 'Ref': {'S': 'DIAAAA'}}}}}
+        trade = records.Order.FromImage(image).Trade
+        self.assertEqual((trade.FilledSize, trade.Price), (decimal.Decimal(100), decimal.Decimal('15.25')))
+        self.assertEqual((trade.Broker, trade.RefType, trade.Ref), ('IG', 'dealId', 'DIAAAA'))
+        self.assertIsNone(trade.StopDistance)
+
+    def test_quote(self):
+        quote = records.Quote.FromImage(self.image('strategies'))
+        self.assertEqual((quote.Symbol, quote.Date, quote.Source), ('VIX', '20180310', 'IB'))
+        self.assertEqual((quote.Close, quote.Count), (decimal.Decimal('9.43'), decimal.Decimal(771)))
+        item = {'Symbol': 'VIX', 'Date': '20180310', 'Source': 'IB',
+                'Details': {'High': decimal.Decimal('9.74'), 'Low': decimal.Decimal('9.39'),
+                            'Volume': decimal.Decimal(0), 'Close': decimal.Decimal('9.43'),
+                            'Count': decimal.Decimal(771), 'Open': decimal.Decimal('9.63')}}
+        self.assertEqual(records.Quote.FromItem(item), quote)
+        self.assertIsNone(records.Quote.FromImage({'Symbol': {'S': 'VIX'}, 'Date': {'S': '20180310'}}).Close)
+        self.assertEqual((quote.Open, quote.High, quote.Volume), (decimal.Decimal('9.63'), decimal.Decimal('9.74'), 0))
+        self.assertEqual(records.Quote('VIX', '20180310', quote.Close, open=quote.Open).Open, quote.Open)
+        self.assertIsNone(records.Quote('VIX').Low)
+
+    def test_plain(self):
+        self.assertEqual(records.plain({'M': {'A': {'N': '1.5'}, 'B': {'L': [{'S': 'x'}, {'NULL': True}]}}}),
+                         {'A': decimal.Decimal('1.5'), 'B': ['x', None]})
+
+    def test_ig_order(self):
+        order = ige.Order.FromImage(self.image('executors'))
+        self.assertEqual((order.Maturity, order.Size, order.StopDistance), ('JUN-18', 100.0, 4.0))
+        self.assertEqual((order.Status, order.Epic, order.Name), (ige.OrderStatus.Pending, '', None))
+        self.assertNotEqual(order, ige.Order.FromImage(self.image('executors')))
+
+
+class TestStandIns(unittest.TestCase):
+
+    def setUp(self):
+        self.environ = dict(os.environ)
+        os.environ.update({'QUOTES_TABLE': 'Quotes.EOD', 'SECURITIES_TABLE': 'Securities', 'ORDERS_TABLE': 'Orders',
+                           'DEBUG_FOLDER': 'debug', 'ROLL_FILE': 'roll.csv', 'BACK_TEST': 'True', 'STD_SIZE': '100'})
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+
+    def test_memory_table(self):
+        db = standins.MemoryDb()
+        orders = db.Table('Orders')
+        key = {'OrderId': '1', 'TransactionTime': '1520607600'}
+        with self.assertRaises(TypeError):
+            orders.put_item(Item=dict(key, Size=1.5))
+        orders.update_item(Key=key, UpdateExpression='set #s = :s, Symbol = :y, Maturity = :m',
+                           ExpressionAttributeNames={'#s': 'Status'},
+                           ExpressionAttributeValues={':s': 'PENDING', ':y': 'VX', ':m': '201803'})
+        update = dict(Key=key, UpdateExpression='set #s = :s', ConditionExpression='#s = :p',
+                      ExpressionAttributeNames={'#s': 'Status'},
+                      ExpressionAttributeValues={':s': 'FILLED', ':p': 'PENDING'}, ReturnValues='UPDATED_NEW')
+        self.assertEqual(orders.update_item(**update), {'Attributes': {'Status': 'FILLED'}})
+        with self.assertRaises(ClientError) as e:
+            orders.update_item(**update)
+        self.assertEqual(e.exception.response['Error']['Code'], 'ConditionalCheckFailedException')
+        with self.assertRaises(ClientError) as e:
+            orders.update_item(**dict(update, ConditionExpression='size(#s) > :p'))
+        self.assertEqual(e.exception.response['Error']['Code'], 'ValidationException')
+        self.assertIn('size(#s) > :p', e.exception.response['Error']['Message'])
+        with self.assertRaises(ClientError) as e:
+            db.meta.client.transact_write_items(TransactItems=[{'Get': {'TableName': 'Orders', 'Key': key}}])
+        self.assertIn('Get', e.exception.response['Error']['Message'])
+        self.assertEqual([x['eventName'] for x in orders.Drain()['Records']], ['INSERT', 'MODIFY'])
+        self.assertEqual(orders.Stream, [])
+
+        positions = ledger.PositionLedger(db.Table('Positions'))
+        positions.Record('VX', '201803', 'IG', 'BUY', 3)
+        self.assertEqual(positions.Record('VX', '201803', 'IG', 'SELL', 1), decimal.Decimal(2))
+        self.assertEqual(positions.Get('VX', '201804', 'IG'), 0)
+
+    def test_paged_index_query(self):
+        db = standins.MemoryDb()
+        orders = db.Table('Orders')
+        orders.PageSize = 3
+        for i in range(10):
+            orders.put_item(Item={'OrderId': str(i), 'TransactionTime': '1520607600', 'Symbol': 'VX',
+                                  'Maturity': '201803' if i % 2 else '201804', 'Broker': 'IG', 'Status': 'FILLED',
+                                  'Trade': {'Side': 'BUY', 'FilledSize': i}})
+        resources = vrt.Resources(db, standins.MemoryS3())
+        trader = vrt.VixTrader(logging.getLogger(), datetime.datetime(2018, 3, 9), resources)
+        items = trader.GetOrders('VX', 'IG', '201803')
+        self.assertEqual(sorted(x['Trade']['FilledSize'] for x in items), [1, 3, 5, 7, 9])
+        self.assertEqual(set(items[0].keys()), {'Status', 'Trade'})
+        db.Unprocessed = 1
+        self.assertEqual(len(trader.GetSecurities()), 0)
+
+    def test_bucket_roll_history(self):
+        history = rh.S3RollHistory(standins.MemoryS3().Bucket('debug'), 'roll')
+        signal = rh.RollSignal('20180309', 'VXH8', 15.43, 14.64, 12, 0.07)
+        self.assertFalse(history.Contains('20180309', 'VXH8'))
+        self.assertTrue(history.Add(signal))
+        self.assertFalse(history.Add(signal))
+        self.assertTrue(history.Contains('20180309', 'VXH8'))
+        self.assertEqual([x.Key for x in history.Export()], [signal.Key])
+
+    def test_offline_pipeline(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            with pipeline.Offline(limits=Unlimited) as offline:
+                offline.IG.Fail('GET', '/positions', 503)
+                timings, statuses = offline.Run()
+                self.assertEqual(timings['orders'], 1)
+                self.assertEqual([status for _, status in statuses], ['FILLED'])
+                self.assertEqual(len(offline.IG.Deals), 1)
+                self.assertEqual(offline.IG.Requests[('GET', '/positions')], 2)
+                self.assertTrue(ige.Notifications.Flush(5))
+                self.assertEqual(len(offline.Smtp.Messages), 1)
+                # the same day again is not traded twice
+                timings, statuses = offline.Run()
+                self.assertEqual(timings['orders'], 0)
+                self.assertEqual(len(offline.IG.Deals), 1)
+            self.assertIsNone(ige.Db)
+        finally:
+            loop.close()
+            asyncio.set_event_loop(None)
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def test_measure_and_compare(self):
+        calls = []
+        timing = suite.measure(calls.append, 3, lambda: (len(calls),))
+        self.assertEqual(calls, [0, 1, 2])
+        self.assertEqual(timing['repeat'], 3)
+        self.assertLessEqual(timing['best'], timing['median'])
+        baseline = {'a': {'best': 1.0}, 'b': {'best': 1.0}}
+        rows = suite.compare({'a': {'best': 1.2}, 'b': {'best': 2.0}, 'c': {'best': 5.0}}, baseline, 1.5)
+        self.assertEqual([(name, regressed) for name, _, _, _, regressed in rows], [('a', False), ('b', True)])
+        # on a host twice as slow, as measured by the calibration case, b did not regress
+        baseline[suite.CALIBRATION] = {'best': 0.1}
+        rows = suite.compare({'a': {'best': 1.2}, 'b': {'best': 2.0}, suite.CALIBRATION: {'best': 0.2}}, baseline, 1.5)
+        self.assertEqual([(name, ratio, regressed) for name, _, _, ratio, regressed in rows],
+                         [('a', 0.6, False), ('b', 1.0, False)])
+
+    def test_results_file(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'results.json')
+            suite.save({'a': {'best': 1.0, 'median': 1.0, 'repeat': 1}}, path)
+            with open(path) as f:
+                report = json.load(f)
+        self.assertEqual(report['results']['a']['best'], 1.0)
+        self.assertIn('commit', report)
+        self.assertEqual(report['host'], suite.host())
+        self.assertEqual(suite.differences(report), [])
+        report['host']['python'] = 'CPython 2.7.18'
+        self.assertEqual(suite.differences(report), ['python: CPython 2.7.18 != %s' % suite.host()['python']])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,6 +1,12 @@
+import sys
 import decimal
 import time
 import json
+import collections
+import asyncio
+import functools
+import random
+import threading
 
 
 class DecimalEncoder(json.JSONEncoder):
@@ -13,36 +19,315 @@ class DecimalEncoder(json.JSONEncoder):
         return super(DecimalEncoder, self).default(o)
 
 
+class TtlCache(object):
+    """Bounded LRU cache whose entries expire ttl seconds after they were stored"""
+
+    def __init__(self, maxSize=256, ttl=600, clock=time.monotonic):
+        self.MaxSize = maxSize
+        self.Ttl = ttl
+        self.__clock = clock
+        self.__items = collections.OrderedDict()
+        # shared by the strategy's executor threads
+        self.__lock = threading.Lock()
+
+    def Get(self, key):
+        with self.__lock:
+            if key not in self.__items:
+                return None
+            expires, value = self.__items[key]
+            if expires <= self.__clock():
+                del self.__items[key]
+                return None
+            self.__items.move_to_end(key)
+            return value
+
+    def Put(self, key, value):
+        with self.__lock:
+            self.__items[key] = (self.__clock() + self.Ttl, value)
+            self.__items.move_to_end(key)
+            while len(self.__items) > self.MaxSize:
+                self.__items.popitem(last=False)
+
+    def Clear(self):
+        with self.__lock:
+            self.__items.clear()
+
+    def __len__(self):
+        return len(self.__items)
+
+
+class TokenBucket(object):
+    """
+    Asyncio rate limiter: Rate tokens per second up to Capacity. Acquire reserves a token and sleeps until
+    it is due, so waiters are served in arrival order without a lock and the bucket works on any loop.
+    Slow cuts the rate by factor and drops the saved tokens; the rate then climbs back to Nominal
+    over Recovery seconds.
+    """
+
+    def __init__(self, rate, capacity, recovery=60, floor=0.125, clock=time.monotonic):
+        self.Nominal = rate
+        self.Rate = rate
+        self.Capacity = capacity
+        self.Recovery = recovery
+        self.Floor = floor
+        self.__clock = clock
+        self.__tokens = capacity
+        self.__updated = clock()
+        self.__metrics = collections.Counter()
+        self.__maxWait = 0
+
+    def __Refill(self):
+        now = self.__clock()
+        elapsed = now - self.__updated
+        self.__updated = now
+        self.__tokens = min(self.Capacity, self.__tokens + elapsed * self.Rate)
+        self.Rate = min(self.Nominal, self.Rate + self.Nominal * elapsed / self.Recovery)
+
+    def Reserve(self):
+        """Take a token, returns the seconds until it is due"""
+        self.__Refill()
+        self.__tokens -= 1
+        wait = 0 if self.__tokens >= 0 else -self.__tokens / self.Rate
+        self.__metrics['requests'] += 1
+        self.__metrics['wait'] += wait
+        self.__maxWait = max(self.__maxWait, wait)
+        return wait
+
+    async def Acquire(self):
+        wait = self.Reserve()
+        if wait > 0:
+            try:
+                await asyncio.sleep(wait)
+            except asyncio.CancelledError:
+                self.__tokens += 1
+                raise
+        return wait
+
+    def Slow(self, factor=0.5):
+        self.__Refill()
+        self.Rate = max(self.Nominal * self.Floor, self.Rate * factor)
+        self.__tokens = min(self.__tokens, 0)
+        self.__metrics['slowdowns'] += 1
+
+    def Metrics(self):
+        """{'requests', 'slowdowns', 'wait': total seconds queued, 'maxWait', 'rate'}"""
+        return {'requests': self.__metrics['requests'], 'slowdowns': self.__metrics['slowdowns'],
+                'wait': self.__metrics['wait'], 'maxWait': self.__maxWait, 'rate': self.Rate}
+
+
+class RetryableError(Exception):
+    """A transient failure (throttling, 5xx, timeout) worth another attempt"""
+    pass
+
+
+class FatalError(Exception):
+    """A failure that must not be retried, e.g. a request that may already have had its effect"""
+    pass
+
+
 class Connection(object):
+    """
+    Retry decorators for calls that return None when an attempt failed; the decorated call returns
+    None once the retries or the deadline (seconds) run out. Exceptions are retried only if IsRetryable.
+    A fatal one is raised by reliable. ioreliable returns None instead, so an order stage can report
+    what it knows. Waits grow exponentially with jitter. Counters and call durations per decorated
+    function are available from Metrics() and Latencies(), and EmitMetrics writes them as CloudWatch
+    embedded metric format lines.
+    """
     retries = 5
+    backoff = 0.5
+    maxBackoff = 8
+    deadline = 30
+    throttling = frozenset(['Throttling', 'ThrottlingException', 'ThrottledException', 'RequestLimitExceeded',
+                            'ProvisionedThroughputExceededException', 'RequestThrottled', 'TooManyRequestsException',
+                            'SlowDown', 'error.public-api.exceeded-api-key-allowance',
+                            'error.public-api.exceeded-account-allowance',
+                            'error.public-api.exceeded-account-trading-allowance'])
+    __metrics = collections.Counter()
+    __latencies = collections.defaultdict(list)
+    __lock = threading.Lock()
 
     def __init__(self):
         pass
 
+    @staticmethod
+    def IsRetryable(e):
+        if isinstance(e, FatalError):
+            return False
+        if isinstance(e, RetryableError):
+            return True
+        if isinstance(e, (asyncio.TimeoutError, TimeoutError, ConnectionError)):
+            return True
+        response = getattr(e, 'response', None)
+        if isinstance(response, dict):
+            # botocore ClientError
+            code = response.get('Error', {}).get('Code', '')
+            status = response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+            return code in Connection.throttling or status >= 500
+        status = getattr(e, 'status', None)
+        if isinstance(status, int):
+            # aiohttp ClientResponseError
+            return status == 429 or status >= 500
+        # botocore connection and read timeouts
+        return type(e).__name__ in ('EndpointConnectionError', 'ConnectTimeoutError', 'ReadTimeoutError',
+                                    'ConnectionClosedError')
+
+    @staticmethod
+    def Delay(tries):
+        delay = min(Connection.maxBackoff, Connection.backoff * 2 ** tries)
+        return delay * random.uniform(0.5, 1.0)
+
+    @staticmethod
+    def Count(name, event):
+        with Connection.__lock:
+            Connection.__metrics[(name, event)] += 1
+
+    @staticmethod
+    def Metrics():
+        """{function: {'calls', 'retries', 'failures', 'fatal': count}}"""
+        with Connection.__lock:
+            metrics = {}
+            for (name, event), count in Connection.__metrics.items():
+                metrics.setdefault(name, {})[event] = count
+            return metrics
+
+    @staticmethod
+    def Time(name, seconds):
+        with Connection.__lock:
+            Connection.__latencies[name].append(seconds)
+
+    @staticmethod
+    def Latencies():
+        """{function: [seconds of each call, retries and waits included]}"""
+        with Connection.__lock:
+            return dict((name, list(x)) for name, x in Connection.__latencies.items())
+
+    @staticmethod
+    def ResetMetrics():
+        with Connection.__lock:
+            Connection.__metrics.clear()
+            Connection.__latencies.clear()
+
+    @staticmethod
+    def EmitMetrics(namespace, stream=None):
+        """
+        Write the metrics gathered since the last reset to stdout, one CloudWatch embedded metric format
+        line per function, then reset them. Call it once per invocation, before the handler returns.
+        """
+        metrics, latencies = Connection.Metrics(), Connection.Latencies()
+        Connection.ResetMetrics()
+        stream = sys.stdout if stream is None else stream
+        timestamp = int(time.time() * 1000)
+        for name in sorted(set(metrics) | set(latencies)):
+            counts = dict((x, metrics.get(name, {}).get(x, 0)) for x in ('calls', 'retries', 'failures', 'fatal'))
+            line = dict(counts, Function=name, Latency=[round(x * 1000, 3) for x in latencies.get(name, [])][:100])
+            line['_aws'] = {'Timestamp': timestamp, 'CloudWatchMetrics': [{
+                'Namespace': namespace, 'Dimensions': [['Function']],
+                'Metrics': [{'Name': x, 'Unit': 'Count'} for x in sorted(counts)] +
+                           [{'Name': 'Latency', 'Unit': 'Milliseconds'}]}]}
+            stream.write(json.dumps(line, sort_keys=True) + '\n')
+        stream.flush()
+
     @staticmethod
     def ioreliable(func):
+        name = func.__qualname__
+
+        @functools.wraps(func)
         async def _decorator(self, *args, **kwargs):
+            Connection.Count(name, 'calls')
+            started = time.monotonic()
+            end = started + Connection.deadline
             tries = 0
-            result = await func(self, *args, **kwargs)
-            if result is None:
-                while result is None and tries < Connection.retries:
+            try:
+                while True:
+                    try:
+                        remaining = end - time.monotonic()
+                        if remaining <= 0:
+                            raise asyncio.TimeoutError()
+                        result = await asyncio.wait_for(func(self, *args, **kwargs), timeout=remaining)
+                        if result is not None:
+                            return result
+                    except Exception as e:
+                        if not Connection.IsRetryable(e):
+                            Connection.Count(name, 'fatal')
+                            return None
+                    delay = Connection.Delay(tries)
                     tries += 1
-                    time.sleep(2 ** tries)
-                    result = await func(self, *args, **kwargs)
-            return result
+                    if tries > Connection.retries or time.monotonic() + delay >= end:
+                        Connection.Count(name, 'failures')
+                        return None
+                    Connection.Count(name, 'retries')
+                    await asyncio.sleep(delay)
+            finally:
+                Connection.Time(name, time.monotonic() - started)
 
         return _decorator
 
     @staticmethod
     def reliable(func):
+        name = func.__qualname__
+
+        @functools.wraps(func)
         def _decorator(self, *args, **kwargs):
+            Connection.Count(name, 'calls')
+            started = time.monotonic()
+            end = started + Connection.deadline
             tries = 0
-            result = func(self, *args, **kwargs)
-            if result is None:
-                while result is None and tries < Connection.retries:
+            try:
+                while True:
+                    try:
+                        result = func(self, *args, **kwargs)
+                        if result is not None:
+                            return result
+                    except Exception as e:
+                        if not Connection.IsRetryable(e):
+                            Connection.Count(name, 'fatal')
+                            raise
+                    delay = Connection.Delay(tries)
                     tries += 1
-                    time.sleep(2 ** tries)
-                    result = func(self, *args, **kwargs)
-            return result
+                    if tries > Connection.retries or time.monotonic() + delay >= end:
+                        Connection.Count(name, 'failures')
+                        return None
+                    Connection.Count(name, 'retries')
+                    time.sleep(delay)
+            finally:
+                Connection.Time(name, time.monotonic() - started)
 
         return _decorator
+
+
+class BatchGet(object):
+    """
+    BatchGetItem of any number of keys of one table, at most Size keys per request. Each Step sends one
+    request and keeps the UnprocessedKeys and the items found, so a retry resumes where the last one stopped.
+    Run and RunAsync retry the steps under Connection's backoff and deadline.
+    """
+    Size = 100
+
+    def __init__(self, db, table, keys):
+        self.__db = db
+        self.__table = table
+        self.__keys = list(keys)
+        self.__request = {}
+        self.Items = []
+
+    def Step(self):
+        """Send the next request, returns the items once every key has been read, else None"""
+        if len(self.__request) == 0:
+            self.__request = {self.__table: {'Keys': self.__keys[:self.Size]}}
+            self.__keys = self.__keys[self.Size:]
+        response = self.__db.batch_get_item(RequestItems=self.__request)
+        self.Items.extend(response['Responses'].get(self.__table, []))
+        self.__request = response.get('UnprocessedKeys', {})
+        if len(self.__request) > 0 or len(self.__keys) > 0:
+            return None
+        return self.Items
+
+    @Connection.reliable
+    def Run(self):
+        return self.Step()
+
+    @Connection.ioreliable
+    async def RunAsync(self, loop):
+        """The same on the loop's executor, the waits between retries do not block the loop"""
+        return await loop.run_in_executor(None, self.Step)